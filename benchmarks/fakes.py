@@ -0,0 +1,206 @@
+"""
+ベンチマーク・負荷試験用の、ネットワークに接続しない Discord オブジェクトの代替品。
+Cog が実際に参照する属性・メソッドだけを実装し、送信や編集は記録するだけで何もしない。
+
+このモジュールを最初に import すると、DBはメモリ上の SQLite（DB_BACKEND=sqlite, SQLITE_PATH=:memory:）になり、
+本番のデータベースには接続しない。また、ボット本体のログ（print）は標準エラー出力に送り、
+標準出力には write_report で書く結果のJSONだけを出す（パイプで json.load できるように）。
+"""
+import os
+import sys
+import itertools
+from datetime import datetime, timezone
+
+# config.py / db_handler.py を読み込む前に、ベンチマーク用の設定にしておく
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("GUILD_ID", "0")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db_handler.py などが import 時・実行時に出すログが、結果のJSONに混ざらないようにする
+REPORT_STDOUT = sys.stdout
+sys.stdout = sys.stderr
+
+import discord
+
+_ids = itertools.count(10**17)
+
+def write_report(output: str, path: str | None = None, echo: bool = False):
+    """結果のJSONを path に保存する。path がない場合（または echo=True）は、本来の標準出力にも出す"""
+    if path:
+        with open(path, "w", encoding="utf-8") as f: f.write(output + "\n")
+    if not path or echo:
+        REPORT_STDOUT.write(output + "\n")
+        REPORT_STDOUT.flush()
+
+def next_id() -> int:
+    return next(_ids)
+
+class FakeRole:
+    def __init__(self, name: str, role_id: int | None = None):
+        self.id = role_id or next_id()
+        self.name = name
+        self.mention = f"<@&{self.id}>"
+
+class FakeMember:
+    def __init__(self, member_id: int | None = None, name: str | None = None, bot: bool = False, guild=None):
+        self.id = member_id or next_id()
+        self.name = name or f"user{self.id % 100000}"
+        self.display_name = self.name
+        self.bot = bot
+        self.guild = guild
+        self.roles = []
+        self.mention = f"<@{self.id}>"
+
+    async def add_roles(self, *roles, reason=None):
+        self.roles.extend(roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        self.roles = [role for role in self.roles if role not in roles]
+
+class FakeMessage:
+    def __init__(self, content: str = "", author: FakeMember | None = None, channel=None, guild=None, embeds=None, message_id: int | None = None):
+        self.id = message_id or next_id()
+        self.content = content
+        self.author = author or FakeMember()
+        self.channel = channel
+        self.guild = guild
+        self.embeds = list(embeds or [])
+        self.reactions = []
+
+    async def edit(self, content=None, embed=None, embeds=None, view=None, **kwargs):
+        if content is not None: self.content = content
+        if embed is not None: self.embeds = [embed]
+        if embeds is not None: self.embeds = list(embeds)
+        return self
+
+    async def reply(self, content=None, **kwargs):
+        return FakeMessage(content or "", channel=self.channel, guild=self.guild)
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+class FakeChannel:
+    def __init__(self, channel_id: int | None = None, name: str = "general", guild=None):
+        self.id = channel_id or next_id()
+        self.name = name
+        self.guild = guild
+        self.mention = f"<#{self.id}>"
+        self.messages = {}
+
+    async def send(self, content=None, embed=None, embeds=None, view=None, file=None, **kwargs):
+        message = FakeMessage(content or "", channel=self, guild=self.guild, embeds=[embed] if embed else embeds)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id: int):
+        if message_id not in self.messages: raise discord.NotFound(_FakeResponse(404), "Unknown Message")
+        return self.messages[message_id]
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id: int | None = None, name: str = "VC", members=None):
+        self.id = channel_id or next_id()
+        self.name = name
+        self.members = list(members or [])
+
+class FakeVoiceState:
+    def __init__(self, channel: FakeVoiceChannel | None = None):
+        self.channel = channel
+
+class FakeGuild:
+    def __init__(self, guild_id: int | None = None, members=None):
+        self.id = guild_id or next_id()
+        self.members = {}
+        self.roles = {}
+        self.voice_channels = []
+        for member in members or []:
+            self.add_member(member)
+
+    def add_member(self, member: FakeMember) -> FakeMember:
+        member.guild = self
+        self.members[member.id] = member
+        return member
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    def get_role(self, role_id: int):
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id: int):
+        return None
+
+class _FakeResponse:
+    """discord.HTTPException に渡すための最小限のレスポンス"""
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = ""
+
+class FakeInteractionResponse:
+    def __init__(self):
+        self._done = False
+        self.sent = []
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, ephemeral: bool = False, thinking: bool = False):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.sent.append((content, kwargs))
+
+    async def send_modal(self, modal):
+        self._done = True
+        self.sent.append(("modal", {"modal": modal}))
+
+class FakeFollowup:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+class FakeInteraction:
+    def __init__(self, user: FakeMember, guild: FakeGuild | None = None, channel: FakeChannel | None = None, message: FakeMessage | None = None, client=None):
+        self.id = next_id()
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id if guild else None
+        self.channel = channel
+        self.channel_id = channel.id if channel else None
+        self.message = message
+        self.client = client
+        self.command = None
+        self.created_at = datetime.now(timezone.utc)
+        self.response = FakeInteractionResponse()
+        self.followup = FakeFollowup()
+        self.data = {}
+
+class FakeChoice:
+    """app_commands.Choice の代わり（name と value だけを使う）"""
+    def __init__(self, name: str, value):
+        self.name, self.value = name, value
+
+class FakeBot:
+    def __init__(self, guilds=None):
+        self.guilds = list(guilds or [])
+        self.user = FakeMember(name="bot", bot=True)
+        self.views = []
+        self.cogs = {}
+
+    def add_view(self, view, message_id=None):
+        self.views.append(view)
+
+    def get_cog(self, name: str):
+        return self.cogs.get(name)
+
+    async def wait_until_ready(self):
+        pass
+
+    async def fetch_channel(self, channel_id: int):
+        raise discord.NotFound(_FakeResponse(404), "Unknown Channel")
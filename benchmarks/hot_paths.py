@@ -0,0 +1,305 @@
+"""
+ネットワークもトークンも使わずに、各Cogの処理の速さを計測するベンチマーク。
+DBはメモリ上の SQLite、Discord のオブジェクトは benchmarks/fakes.py の代替品を使う。
+
+使い方:
+    python -m benchmarks.hot_paths                               # 全ケースを実行し、JSONを標準出力に出す
+    python -m benchmarks.hot_paths --quick --output before.json  # 規模を小さくして実行し、ファイルに保存
+    python -m benchmarks.hot_paths --compare before.json         # 保存した結果と比べ、遅くなったケースがあれば終了コード1
+    python -m benchmarks.hot_paths --only ranking                # 名前に ranking を含むケースだけ実行
+
+結果は ケース名 → {p50_ms, p95_ms, mean_ms, min_ms, ops_per_sec, ...} のJSON。比較には p50_ms を使う。
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from benchmarks import fakes
+from benchmarks.fakes import FakeBot, FakeChannel, FakeChoice, FakeGuild, FakeInteraction, FakeMember, FakeMessage
+
+import discord
+from db_handler import db
+from message_router import router
+import guilds
+from cogs import activity, events, shift
+
+# 比較時に「遅くなった」とみなす p50 の増加率
+DEFAULT_THRESHOLD = 0.25
+
+def summarize(timings: list, **extra) -> dict:
+    """1回ごとの所要時間（秒）のリストを集計する"""
+    ordered = sorted(timings)
+    result = {
+        "iterations": len(ordered),
+        "p50_ms": round(statistics.median(ordered) * 1000, 4),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 4),
+        "min_ms": round(ordered[0] * 1000, 4),
+        "ops_per_sec": round(len(ordered) / sum(ordered), 1) if sum(ordered) else None,
+    }
+    result.update(extra)
+    return result
+
+async def measure(func, repeat: int, **extra) -> dict:
+    """コルーチン関数 func() を repeat 回実行して集計する"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+    return summarize(timings, **extra)
+
+def clear_prefix(p_str: str):
+    db.delete_many(list(db.prefix(p_str)))
+
+def seed_profiles(guild_id: int, user_ids) -> None:
+    """各ユーザーに、主ロール（順番に割り当て）とランダムな副ロールを持つプロフィールを登録する"""
+    profiles = {}
+    for i, user_id in enumerate(user_ids):
+        primary = events.ROLES[i % len(events.ROLES)]
+        secondary = random.choice([role for role in events.ROLES if role != primary])
+        profiles[guilds.key("profile", guild_id, user_id)] = {"role_priority": [primary, secondary]}
+    db.set_many(profiles)
+
+def make_activity_cog(bot: FakeBot) -> activity.ActivityCog:
+    cog = activity.ActivityCog(bot)
+    # 定期タスクはベンチマークの邪魔になるため止めておく
+    cog.check_and_reset_activity.cancel()
+    cog.flush_activity.cancel()
+    return cog
+
+# --- 各ケース ---
+
+async def bench_activity_on_message(scale: dict) -> dict:
+    guild = FakeGuild(members=[FakeMember() for _ in range(scale["active_users"])])
+    channel = FakeChannel(guild=guild)
+    cog = make_activity_cog(FakeBot([guild]))
+    members = list(guild.members.values())
+    messages = [FakeMessage("hello", author=random.choice(members), channel=channel, guild=guild) for _ in range(scale["messages"])]
+    timings = []
+    for message in messages:
+        started = time.perf_counter()
+        await router.dispatch(message)
+        timings.append(time.perf_counter() - started)
+    results = {f"activity.on_message[users={len(members)}]": summarize(timings)}
+
+    # 溜まった加算値をまとめてDBに書き込む時間（flush_activity 1回分）
+    timings = []
+    for _ in range(scale["flush_repeat"]):
+        for member in members: cog._add_pending(guild.id, member.id, member.display_name, "message_count", 1)
+        started = time.perf_counter()
+        cog.flush_pending()
+        timings.append(time.perf_counter() - started)
+    results[f"activity.flush[users={len(members)}]"] = summarize(timings)
+    clear_prefix("activity_")
+    return results
+
+async def bench_update_participant_data(scale: dict) -> dict:
+    results = {}
+    for participants in scale["participants"]:
+        guild = FakeGuild(members=[FakeMember() for _ in range(participants + scale["rsvp_repeat"])])
+        channel = FakeChannel(guild=guild)
+        members = list(guild.members.values())
+        seed_profiles(guild.id, [member.id for member in members])
+        message = await channel.send(embed=discord.Embed(title="event"))
+        event_id = str(message.id)
+        existing = {str(m.id): {"name": m.display_name, "roles": ["gold"], "status": "参加", "timestamp": datetime.now().isoformat(), "time": ""} for m in members[:participants]}
+        db.set(guilds.key("active_events", guild.id), {event_id: {"summary": "bench", "start_time": "21:00", "notes": "", "limit": None, "participants": existing, "channel_id": channel.id, "guild_id": guild.id}})
+        view = events.EventView(event_id=event_id)
+        responders = iter(members[participants:])
+
+        async def rsvp():
+            interaction = FakeInteraction(next(responders), guild=guild, channel=channel, message=message)
+            await interaction.response.defer()
+            await view.update_participant_data(interaction, "参加")
+        results[f"events.update_participant_data[participants={participants}]"] = await measure(rsvp, scale["rsvp_repeat"])
+        view.stop()
+        db.delete(guilds.key("active_events", guild.id))
+    clear_prefix("profile_")
+    return results
+
+async def bench_solvers(scale: dict) -> dict:
+    results = {}
+    cog = events.EventsCog(FakeBot())
+    guild = FakeGuild()
+    for players in scale["shuffle_players"]:
+        user_ids = [str(fakes.next_id()) for _ in range(players)]
+        seed_profiles(guild.id, user_ids)
+        pool = {uid: {"name": uid, "status": "参加", "timestamp": datetime.now().isoformat()} for uid in user_ids}
+        solved = 0
+        timings = []
+        for _ in range(scale["solver_repeat"]):
+            started = time.perf_counter()
+            result = cog._solve_matches(guild.id, pool, {})
+            if result: solved += result["matches"]
+            timings.append(time.perf_counter() - started)
+        results[f"events.solve_matches[players={players}]"] = summarize(timings, matches=round(solved / len(timings), 3))
+    for players in scale["assign_players"]:
+        participants = {}
+        for i in range(players):
+            roles = random.sample(events.ROLES, k=random.randint(1, 3))
+            participants[str(fakes.next_id())] = {"name": f"p{i}", "roles": roles, "status": "参加", "timestamp": f"2024-01-01T20:{i // 60 % 60:02}:{i % 60:02}"}
+        timings = []
+        for _ in range(scale["solver_repeat"]):
+            started = time.perf_counter()
+            cog._solve_assignment(participants, {})
+            timings.append(time.perf_counter() - started)
+        results[f"events.solve_assignment[players={players}]"] = summarize(timings)
+    clear_prefix("profile_")
+    return results
+
+SCHEDULE_SAMPLES = [
+    "月 21:00~23:00 参加\n火 休み\n水~金 22:00から 一時参加\n土曜 参加\n日 23:00まで",
+    "月曜 参加\n火曜 参加\n水曜 無理\n木曜 21:30~24:00\n金曜 不参加",
+    "月~日 参加",
+    "今週はよろしくお願いします\n土 20:00~22:00 参加\n日 休み",
+]
+
+async def bench_parse_schedule(scale: dict) -> dict:
+    samples = SCHEDULE_SAMPLES * (scale["parse_repeat"] // len(SCHEDULE_SAMPLES))
+    timings = []
+    for content in samples:
+        started = time.perf_counter()
+        shift.parse_schedule_message(content)
+        timings.append(time.perf_counter() - started)
+    return {"shift.parse_schedule_message": summarize(timings)}
+
+def seed_schedules(guild_id: int, users: int):
+    statuses = ["21:00~23:00 (参加)", "終日 (参加)", "22:00から (一時参加)", "終日 (休み)", "23:00まで (一時参加)"]
+    schedules = {}
+    for i in range(users):
+        schedule = {f"day_{day}": random.choice(statuses) for day in shift.DAYS_JP if random.random() < 0.85}
+        schedules[str(fakes.next_id())] = {"name": f"メンバー{i:03}", "thread_id": str(fakes.next_id()), "schedule": schedule}
+    db.set(guilds.key("shift_schedules", guild_id), schedules)
+
+async def bench_excel_exports(scale: dict) -> dict:
+    if importlib.util.find_spec("openpyxl") is None: return {}
+    results = {}
+    cog = shift.ShiftCog(FakeBot())
+    guild = FakeGuild()
+    for users in scale["schedule_users"]:
+        seed_schedules(guild.id, users)
+
+        async def export_week():
+            interaction = FakeInteraction(FakeMember(), guild=guild, channel=FakeChannel(guild=guild))
+            await cog.export_excel.callback(cog, interaction)
+
+        async def export_day():
+            interaction = FakeInteraction(FakeMember(), guild=guild, channel=FakeChannel(guild=guild))
+            await cog.export_day_excel.callback(cog, interaction, FakeChoice("金曜日", "金"))
+        results[f"shift.export_excel[users={users}]"] = await measure(export_week, scale["export_repeat"])
+        results[f"shift.export_day_excel[users={users}]"] = await measure(export_day, scale["export_repeat"])
+    db.delete(guilds.key("shift_schedules", guild.id))
+    return results
+
+async def bench_ranking(scale: dict) -> dict:
+    results = {}
+    guild = FakeGuild()
+    cog = make_activity_cog(FakeBot([guild]))
+    type_choice, period_choice = FakeChoice("チャット回数", "message_count"), FakeChoice("総合", "total")
+    for users in scale["ranking_users"]:
+        clear_prefix("activity_")
+        db.set_many({guilds.key("activity", guild.id, 10**17 + i): {"name": f"user{i}", "message_count": {"total": random.randint(0, 5000), "monthly": 0, "weekly": 0}, "vc_seconds": {"total": random.randint(0, 10**6), "monthly": 0, "weekly": 0}} for i in range(users)})
+
+        async def ranking_command():
+            interaction = FakeInteraction(FakeMember(), guild=guild, channel=FakeChannel(guild=guild))
+            await cog.ranking.callback(cog, interaction, type_choice, period_choice)
+
+        async def ranking_cold():
+            cog.ranking_cache.clear()
+            await ranking_command()
+
+        async def ranking_page():
+            await cog.get_ranking_page(guild.id, "message_count", "total", 5, users)
+
+        async def my_rank():
+            await cog.format_my_rank(guild.id, 10**17 + random.randrange(users), "message_count", "total")
+        repeat = scale["ranking_repeat"]
+        results[f"activity.ranking_cold[users={users}]"] = await measure(ranking_cold, repeat)
+        results[f"activity.ranking_warm[users={users}]"] = await measure(ranking_command, repeat)
+        results[f"activity.ranking_page[users={users}]"] = await measure(ranking_page, repeat)
+        results[f"activity.rank_of[users={users}]"] = await measure(my_rank, repeat)
+    clear_prefix("activity_")
+    return results
+
+CASES = {
+    "activity_on_message": bench_activity_on_message,
+    "update_participant_data": bench_update_participant_data,
+    "solvers": bench_solvers,
+    "parse_schedule": bench_parse_schedule,
+    "excel_exports": bench_excel_exports,
+    "ranking": bench_ranking,
+}
+
+SCALES = {
+    "full": {"messages": 20000, "active_users": 500, "flush_repeat": 20, "participants": (10, 50, 200), "rsvp_repeat": 50,
+             "shuffle_players": (10, 14, 20, 30, 50, 100), "assign_players": (10, 100, 1000), "solver_repeat": 30, "parse_repeat": 4000,
+             "schedule_users": (30, 200), "export_repeat": 10, "ranking_users": (1000, 10000, 100000), "ranking_repeat": 20},
+    "quick": {"messages": 2000, "active_users": 100, "flush_repeat": 5, "participants": (10, 50), "rsvp_repeat": 10,
+              "shuffle_players": (10, 20, 50), "assign_players": (10, 100), "solver_repeat": 5, "parse_repeat": 400,
+              "schedule_users": (30,), "export_repeat": 3, "ranking_users": (1000, 10000), "ranking_repeat": 5},
+}
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+async def run(selected: list, scale_name: str, seed: int) -> dict:
+    scale = SCALES[scale_name]
+    results = {}
+    for name in selected:
+        random.seed(seed)
+        print(f"▶ {name}", file=sys.stderr)
+        results.update(await CASES[name](scale))
+    return {
+        "meta": {"scale": scale_name, "seed": seed, "git": git_revision(), "python": platform.python_version(), "platform": platform.platform(), "created_at": datetime.now().isoformat(timespec="seconds")},
+        "results": results,
+    }
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """p50 が threshold 以上増えたケースの一覧を返し、比較表を表示する"""
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before or not before.get("p50_ms"): continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        mark = "❌" if change > threshold else ("✅" if change < -threshold else "  ")
+        print(f"{mark} {name:60} {before['p50_ms']:>10.3f}ms → {result['p50_ms']:>10.3f}ms ({change:+.1%})", file=sys.stderr)
+        if change > threshold: regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="規模を小さくして短時間で実行する")
+    parser.add_argument("--only", action="append", default=[], help="名前にこの文字列を含むケースだけ実行する（複数指定可）")
+    parser.add_argument("--output", help="結果のJSONを保存するファイル")
+    parser.add_argument("--compare", help="比較対象の結果JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="遅くなったとみなす p50 の増加率（0.25 = 25%%）")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    selected = [name for name in CASES if not args.only or any(pattern in name for pattern in args.only)]
+    report = asyncio.run(run(selected, "quick" if args.quick else "full", args.seed))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    fakes.write_report(output, args.output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: baseline = json.load(f)
+        if baseline.get("meta", {}).get("scale") != report["meta"]["scale"]:
+            print("⚠ 比較対象と規模（--quick の有無）が異なります。", file=sys.stderr)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)}件のケースが遅くなりました。", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+ピーク時（金曜夜など）のゲートウェイイベントを再現し、Cogのリスナーに流し込む負荷試験。
+DBはメモリ上の SQLite、Discord のオブジェクトは benchmarks/fakes.py の代替品を使う（ネットワーク・トークン不要）。
+
+使い方:
+    python -m benchmarks.load_replay                                   # 合成したイベントを最速で流す
+    python -m benchmarks.load_replay --message-rate 500 --duration 120 --record peak.jsonl
+    python -m benchmarks.load_replay --replay peak.jsonl --realtime    # 記録したイベントを実際の時間間隔で流す
+    python -m benchmarks.load_replay --output result.json
+
+イベントは1行1件のJSON（t はストリーム開始からの秒数）:
+    {"t": 0.12, "type": "message", "user": 1, "channel": 1, "content": "..."}
+    {"t": 3.0, "type": "voice", "user": 1, "before": null, "after": 2}
+    {"t": 20.1, "type": "rsvp", "user": 1, "status": "参加"}
+
+結果として、スループット、イベント種別ごとの処理時間（p50 / p99）、1イベントあたりのDB操作数、
+最終的なカウンター（チャット数・VC滞在時間・参加表明）が期待値と一致するかを出力する。
+一致しない場合は終了コード1。
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from benchmarks import fakes
+from benchmarks.fakes import FakeBot, FakeChannel, FakeGuild, FakeInteraction, FakeMember, FakeVoiceChannel, FakeVoiceState
+
+import discord
+import metrics
+from db_handler import db
+from message_router import router
+import guilds
+from cogs import activity, events, management, shift
+
+# シミュレーション上の開始時刻（金曜の夜）
+SIM_START = datetime(2024, 1, 5, 21, 0, 0)
+RSVP_STATUSES = {"参加": 0.6, "空いていれば参加": 0.25, "辞退": 0.15}
+
+class SimClock:
+    """Cog が datetime.now() で読む時刻を、イベントストリーム上の時刻に合わせる"""
+    def __init__(self):
+        self.offset = 0.0
+
+    def now(self, tz=None) -> datetime:
+        current = SIM_START + timedelta(seconds=self.offset)
+        return current.replace(tzinfo=tz) if tz else current
+
+clock = SimClock()
+
+class _SimDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return clock.now(tz)
+
+# --- イベントストリーム ---
+
+def generate_events(args) -> list:
+    """ピーク時を想定した合成イベント（チャット・VCの出入り・参加表明の集中）を作る"""
+    rng = random.Random(args.seed)
+    events_list = []
+    for _ in range(int(args.message_rate * args.duration)):
+        events_list.append({"t": round(rng.uniform(0, args.duration), 4), "type": "message", "user": rng.randrange(args.users), "channel": rng.randrange(args.channels), "content": "gg" * rng.randint(1, 20)})
+    # VC: 開始時点で一部のユーザーが参加しており、以降は毎秒 voice_rate 件の出入りが起きる
+    in_voice = {}
+    for user in rng.sample(range(args.users), k=min(args.users, args.initial_voice)):
+        in_voice[user] = rng.randrange(args.voice_channels)
+        events_list.append({"t": 0, "type": "voice", "user": user, "before": None, "after": in_voice[user]})
+    for second in range(1, int(args.duration)):
+        for _ in range(int(args.voice_rate)):
+            user = rng.randrange(args.users)
+            if user in in_voice:
+                events_list.append({"t": second, "type": "voice", "user": user, "before": in_voice.pop(user), "after": None})
+            else:
+                in_voice[user] = rng.randrange(args.voice_channels)
+                events_list.append({"t": second, "type": "voice", "user": user, "before": None, "after": in_voice[user]})
+    # 参加表明: rsvp_interval 秒ごとに、2秒間で rsvp_burst 件のクリックが集中する
+    statuses, weights = list(RSVP_STATUSES), list(RSVP_STATUSES.values())
+    burst_start = args.rsvp_interval
+    while burst_start < args.duration:
+        for _ in range(args.rsvp_burst):
+            events_list.append({"t": round(burst_start + rng.uniform(0, 2), 4), "type": "rsvp", "user": rng.randrange(args.users), "status": rng.choices(statuses, weights)[0]})
+        burst_start += args.rsvp_interval
+    events_list.sort(key=lambda event: event["t"])
+    return events_list
+
+def load_events(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda event: event["t"])
+
+def save_events(path: str, events_list: list):
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events_list: f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+def expected_counters(events_list: list, end: float) -> dict:
+    """イベントストリームから、最終的に期待されるカウンターを計算する"""
+    messages, vc_seconds, sessions, rsvp = defaultdict(int), defaultdict(float), {}, {}
+    for event in events_list:
+        if event["type"] == "message": messages[event["user"]] += 1
+        elif event["type"] == "voice":
+            if event["before"] is None and event["after"] is not None: sessions[event["user"]] = event["t"]
+            elif event["before"] is not None and event["after"] is None and event["user"] in sessions:
+                vc_seconds[event["user"]] += event["t"] - sessions.pop(event["user"])
+        elif event["type"] == "rsvp": rsvp[event["user"]] = event["status"]
+    for user, since in sessions.items(): vc_seconds[user] += end - since
+    return {"messages": dict(messages), "vc_seconds": dict(vc_seconds), "sessions": len(sessions), "attending": {user for user, status in rsvp.items() if status != "辞退"}}
+
+# --- 負荷をかける環境 ---
+
+class Harness:
+    """Cogを読み込み、discord.py と同じようにイベントを各Cogのリスナーへ配る"""
+    def __init__(self, user_count: int, channel_count: int, voice_channel_count: int):
+        self.guild = FakeGuild()
+        self.members = [self.guild.add_member(FakeMember(member_id=10**17 + i, name=f"user{i}")) for i in range(user_count)]
+        self.channels = [FakeChannel(guild=self.guild, name=f"text{i}") for i in range(channel_count)]
+        self.voice_channels = [FakeVoiceChannel(name=f"vc{i}") for i in range(voice_channel_count)]
+        self.bot = FakeBot([self.guild])
+        self.listeners = defaultdict(list)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def setup(self):
+        activity.datetime = _SimDatetime
+        self.activity = activity.ActivityCog(self.bot)
+        self.events = events.EventsCog(self.bot)
+        self.shift = shift.ShiftCog(self.bot)
+        self.management = management.ManagementCog(self.bot)
+        # 定期タスクは Harness が時刻に合わせて直接呼ぶ
+        self.activity.check_and_reset_activity.cancel(); self.activity.flush_activity.cancel()
+        self.management.trial_reminder_task.cancel()
+        await self.shift.cog_load()
+        for cog in (self.activity, self.events, self.shift, self.management):
+            self.bot.cogs[type(cog).__name__] = cog
+            for name, listener in cog.get_listeners():
+                self.listeners[name].append(listener)
+        db.set_many({guilds.key("profile", self.guild.id, m.id): {"role_priority": [events.ROLES[m.id % len(events.ROLES)]]} for m in self.members})
+        self.event_message = await self.channels[0].send(embed=discord.Embed(title="金曜カスタム"))
+        self.event_id = str(self.event_message.id)
+        db.set(guilds.key("active_events", self.guild.id), {self.event_id: {"summary": "金曜カスタム", "start_time": "22:00", "notes": "", "limit": None, "participants": {}, "channel_id": self.channels[0].id, "guild_id": self.guild.id}})
+        self.event_view = events.EventView(event_id=self.event_id)
+
+    async def dispatch(self, event_name: str, *args):
+        """discord.py の dispatch と同じく、登録されたリスナーを順に呼ぶ（例外は数えて続行する）"""
+        for listener in self.listeners.get(event_name, ()):
+            try: await listener(*args)
+            except Exception as e:
+                self.errors[f"{event_name}: {type(e).__name__}: {e}"] += 1
+
+    async def handle(self, event: dict):
+        member = self.members[event["user"]]
+        if event["type"] == "message":
+            message = fakes.FakeMessage(event.get("content", ""), author=member, channel=self.channels[event.get("channel", 0) % len(self.channels)], guild=self.guild)
+            # main.py の MyBot.on_message と同じく、router が各Cogのハンドラーに振り分ける
+            await router.dispatch(message)
+        elif event["type"] == "voice":
+            before = FakeVoiceState(None if event["before"] is None else self.voice_channels[event["before"] % len(self.voice_channels)])
+            after = FakeVoiceState(None if event["after"] is None else self.voice_channels[event["after"] % len(self.voice_channels)])
+            await self.dispatch("on_voice_state_update", member, before, after)
+        elif event["type"] == "rsvp":
+            button = {"参加": self.event_view.attend_button, "空いていれば参加": self.event_view.if_free_button, "辞退": self.event_view.leave_button}[event["status"]]
+            interaction = FakeInteraction(member, guild=self.guild, channel=self.channels[0], message=self.event_message, client=self.bot)
+            interaction.data = {"custom_id": button.custom_id, "component_type": 2}
+            await self.dispatch("on_interaction", interaction)
+            await button.callback(interaction)
+
+    async def timed(self, event: dict, scheduled: float):
+        try:
+            await self.handle(event)
+        except Exception as e:
+            self.errors[f"{event['type']}: {type(e).__name__}: {e}"] += 1
+        self.latencies[event["type"]].append(time.perf_counter() - scheduled)
+
+    async def flush(self):
+        await self.activity.flush_activity()
+
+async def run(args, events_list: list) -> dict:
+    harness = Harness(args.users, args.channels, args.voice_channels)
+    await harness.setup()
+    duration = max(args.duration, events_list[-1]["t"] if events_list else 0)
+    ops_before = metrics.DB_OPERATIONS.snapshot()
+    handlers_before = metrics.MESSAGE_HANDLER_LATENCY.snapshot()
+    flush_at = activity.ACTIVITY_FLUSH_INTERVAL_SECONDS
+    started = time.perf_counter()
+
+    if args.realtime:
+        # 記録された時間間隔どおりに、イベントごとのタスクとして並行に処理する（ゲートウェイと同じ）
+        tasks = []
+        for event in events_list:
+            delay = started + event["t"] - time.perf_counter()
+            if delay > 0: await asyncio.sleep(delay)
+            clock.offset = time.perf_counter() - started
+            if clock.offset >= flush_at:
+                await harness.flush(); flush_at += activity.ACTIVITY_FLUSH_INTERVAL_SECONDS
+            tasks.append(asyncio.create_task(harness.timed(event, started + event["t"])))
+        await asyncio.gather(*tasks)
+    else:
+        # できるだけ速く、1件ずつ処理する（処理時間 = ハンドラーの実行時間）
+        for event in events_list:
+            while event["t"] >= flush_at:
+                clock.offset = flush_at
+                await harness.flush(); flush_at += activity.ACTIVITY_FLUSH_INTERVAL_SECONDS
+            clock.offset = event["t"]
+            await harness.timed(event, time.perf_counter())
+    elapsed = time.perf_counter() - started
+    clock.offset = duration
+    await harness.flush()
+
+    ops_after = metrics.DB_OPERATIONS.snapshot()
+    db_ops = defaultdict(int)  # 操作の種類ごと（ラベルは operation, prefix, status の順）
+    for labels, count in ops_after.items():
+        db_ops[labels[0]] += count - ops_before.get(labels, 0)
+    total_ops = sum(db_ops.values())
+    # メッセージのハンドラーごとの実行回数と平均時間（ラベルは handler, status の順）
+    message_handlers = {}
+    for labels, (counts, total) in metrics.MESSAGE_HANDLER_LATENCY.snapshot().items():
+        before_counts, before_total = handlers_before.get(labels, ([0] * len(counts), 0.0))
+        count = sum(counts) - sum(before_counts)
+        if count: message_handlers["/".join(labels)] = {"count": count, "avg_ms": round((total - before_total) / count * 1000, 4)}
+    latencies = {}
+    for event_type, values in harness.latencies.items():
+        ordered = sorted(values)
+        latencies[event_type] = {"count": len(ordered), "p50_ms": round(statistics.median(ordered) * 1000, 4), "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 4), "max_ms": round(ordered[-1] * 1000, 4)}
+    return {
+        "events": len(events_list),
+        "stream_seconds": duration,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_events_per_sec": round(len(events_list) / elapsed, 1) if elapsed else None,
+        "mode": "realtime" if args.realtime else "max_speed",
+        "latency": latencies,
+        "message_handlers": message_handlers,
+        "db_ops_total": total_ops,
+        "db_ops_per_event": round(total_ops / len(events_list), 4) if events_list else 0,
+        "db_ops": dict(db_ops),
+        "errors": dict(harness.errors),
+        "correctness": check_counters(harness, expected_counters(events_list, duration)),
+    }
+
+def check_counters(harness: Harness, expected: dict) -> dict:
+    """DBとCogの最終状態を、イベントストリームから計算した期待値と比べる"""
+    stored = db.get_many([guilds.key("activity", harness.guild.id, m.id) for m in harness.members])
+    message_mismatch, vc_mismatch = [], []
+    for index, member in enumerate(harness.members):
+        data = stored.get(guilds.key("activity", harness.guild.id, member.id), {})
+        counted = data.get("message_count", {}).get("total", 0)
+        if counted != expected["messages"].get(index, 0): message_mismatch.append(index)
+        # 1秒未満の端数は次回に持ち越すため、最大1秒の差は許容する
+        seconds = data.get("vc_seconds", {}).get("total", 0)
+        if abs(seconds - expected["vc_seconds"].get(index, 0)) > 1: vc_mismatch.append(index)
+    participants = db.get(guilds.key("active_events", harness.guild.id), {}).get(harness.event_id, {}).get("participants", {})
+    attending = {int(user_id) - 10**17 for user_id in participants}
+    return {
+        "ok": not message_mismatch and not vc_mismatch and attending == expected["attending"] and len(harness.activity.vc_sessions) == expected["sessions"],
+        "message_count_mismatches": len(message_mismatch),
+        "vc_seconds_mismatches": len(vc_mismatch),
+        "open_vc_sessions": {"expected": expected["sessions"], "actual": len(harness.activity.vc_sessions)},
+        "rsvp_attending": {"expected": len(expected["attending"]), "actual": len(attending), "missing": len(expected["attending"] - attending), "unexpected": len(attending - expected["attending"])},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", help="記録済みのイベントストリーム（JSONL）")
+    parser.add_argument("--record", help="合成したイベントストリームを保存するファイル")
+    parser.add_argument("--realtime", action="store_true", help="イベントの時刻どおりに並行して流す（指定しない場合は最速で1件ずつ）")
+    parser.add_argument("--output", help="結果のJSONを保存するファイル")
+    parser.add_argument("--duration", type=float, default=60, help="合成するストリームの秒数")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--voice-channels", type=int, default=10)
+    parser.add_argument("--message-rate", type=float, default=300, help="1秒あたりのメッセージ数")
+    parser.add_argument("--initial-voice", type=int, default=150, help="開始時点でVCにいる人数")
+    parser.add_argument("--voice-rate", type=float, default=5, help="1秒あたりのVCの出入り")
+    parser.add_argument("--rsvp-interval", type=float, default=20, help="参加表明が集中する間隔（秒）")
+    parser.add_argument("--rsvp-burst", type=int, default=150, help="1回の集中で押されるボタンの数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    events_list = load_events(args.replay) if args.replay else generate_events(args)
+    if args.replay:
+        args.users = max([args.users] + [event["user"] + 1 for event in events_list])
+        args.duration = events_list[-1]["t"] if events_list else 0
+    if args.record: save_events(args.record, events_list)
+    result = asyncio.run(run(args, events_list))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    fakes.write_report(output, args.output, echo=True)
+    if not result["correctness"]["ok"]: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
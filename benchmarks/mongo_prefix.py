@@ -0,0 +1,84 @@
+"""
+MongoDBHandler のプレフィックス検索を、旧来の正規表現クエリと _id 範囲クエリで比較するベンチマーク。
+
+使い方:
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.mongo_prefix [--keys 100000] [--repeat 20]
+
+ベンチマーク用の一時コレクションを作成し、終了時に削除する（本番のデータには触れない）。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+# config.py の必須項目はベンチマークでは使わないため、ダミー値で埋める
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("GUILD_ID", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pymongo
+import db_handler
+
+# 実際のキー構成に近い割合で、プレフィックスごとのキーを作る
+KEY_MIX = {"activity_": 0.6, "profile_": 0.3, "trial_": 0.05, "management_": 0.05}
+
+def seed(collection, total_keys: int):
+    collection.drop()
+    docs = []
+    for p_str, ratio in KEY_MIX.items():
+        for i in range(int(total_keys * ratio)):
+            docs.append({"_id": f"{p_str}{10**17 + i}", "data": {"name": f"user{i}", "message_count": {"total": i % 500}}})
+    for start in range(0, len(docs), 10000):
+        collection.insert_many(docs[start:start + 10000], ordered=False)
+    return len(docs)
+
+def measure(func, repeat: int) -> dict:
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {"mean_ms": round(statistics.mean(timings), 3), "p50_ms": round(statistics.median(timings), 3), "min_ms": round(min(timings), 3), "result_count": len(result)}
+
+def keys_examined(collection, query: dict) -> int:
+    explain = collection.find(query, {"_id": 1}).explain()
+    return explain.get("executionStats", {}).get("totalKeysExamined", -1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--prefix", default="trial_")
+    args = parser.parse_args()
+
+    handler = db_handler.db
+    if not getattr(handler, "client", None):
+        sys.exit("MongoDBに接続できませんでした。MONGO_URI を確認してください。")
+    collection = handler.db.get_collection(f"bench_prefix_{os.getpid()}")
+    handler.collection = collection
+    try:
+        total = seed(collection, args.keys)
+        p_str = args.prefix
+        regex_query = {"_id": {"$regex": f"^{p_str}"}}
+        range_query = db_handler._prefix_filter(p_str)
+
+        results = {
+            "keys": total,
+            "prefix": p_str,
+            # 旧実装: 正規表現でキーだけ取得し、値はキーごとに get する
+            "regex_ids": measure(lambda: [d["_id"] for d in collection.find(regex_query, {"_id": 1})], args.repeat),
+            "regex_ids_then_get": measure(lambda: [handler.get(d["_id"]) for d in collection.find(regex_query, {"_id": 1})], max(1, args.repeat // 10)),
+            # 新実装: _id の範囲検索。値も同じクエリで取得できる
+            "range_ids": measure(lambda: handler.prefix(p_str), args.repeat),
+            "range_with_data": measure(lambda: handler.prefix(p_str, include_data=True, projection=["name"]), args.repeat),
+            "keys_examined": {"regex": keys_examined(collection, regex_query), "range": keys_examined(collection, range_query)},
+        }
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    finally:
+        collection.drop()
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,25 @@
 import discord
-from discord import app_commands
+from discord import app_commands, ui, ButtonStyle
 from discord.ext import commands, tasks
-from db_handler import db
+from db_handler import db, DatabaseUnavailableError
+import metrics
+import sharding
+import guilds
+from message_router import router, MessageContext
+import time
+import asyncio
 from datetime import datetime, timezone, timedelta
 
+# 活動記録をDBへ書き込む間隔（秒）。クラッシュ時に失われるのは最大でこの時間分だけ
+ACTIVITY_FLUSH_INTERVAL_SECONDS = 60
+# ランキングキャッシュに保持する上位人数（= 1ページあたりの表示人数）
+RANKING_SIZE = 10
+# 複数プロセスで動いている場合のランキングキャッシュの有効期間（秒）。他のプロセスの加算はキャッシュに反映されないため
+RANKING_CACHE_TTL_SECONDS = ACTIVITY_FLUSH_INTERVAL_SECONDS
+PERIODS = ("total", "monthly", "weekly")
+RANKING_TYPE_NAMES = {"message_count": "💬 チャット回数", "vc_seconds": "🎤 VC滞在時間"}
+RANKING_PERIOD_NAMES = {"total": "👑 総合", "monthly": "🌙 月間", "weekly": "📅 週間"}
+
 def format_seconds(seconds: int) -> str:
     """秒を、人間が読みやすい「X時間Y分」や「Y分」の形式に変換する"""
     if seconds < 60:
@@ -16,28 +32,241 @@ def format_seconds(seconds: int) -> str:
     else:
         return f"{minutes}分"
 
+def build_ranking_embed(metric: str, period: str, entries: list[dict], page: int = 0, total_count: int | None = None) -> discord.Embed:
+    """ランキングの1ページ分のユーザーリストからEmbedを作成する"""
+    embed = discord.Embed(
+        title=f"🏆 {RANKING_PERIOD_NAMES[period]} {RANKING_TYPE_NAMES[metric]} ランキング",
+        description="サーバー内での活動ランキングです。",
+        color=discord.Color.gold()
+    )
+
+    rank_text = ""
+    for i, user in enumerate(entries):
+        rank = page * RANKING_SIZE + i + 1
+        name = user["name"]
+        score = user["score"]
+
+        score_display = format_seconds(score) if metric == "vc_seconds" else f"{score} 回"
+
+        if rank == 1: rank_text += f"🥇 **{rank}位:** {name} - **{score_display}**\n"
+        elif rank == 2: rank_text += f"🥈 **{rank}位:** {name} - **{score_display}**\n"
+        elif rank == 3: rank_text += f"🥉 **{rank}位:** {name} - **{score_display}**\n"
+        else: rank_text += f"**{rank}位:** {name} - {score_display}\n"
+
+    if not rank_text:
+        rank_text = "まだ誰もランクインしていません。"
+
+    first_rank = page * RANKING_SIZE + 1
+    field_name = f"Top {RANKING_SIZE}" if page == 0 else f"{first_rank}位 〜 {first_rank + RANKING_SIZE - 1}位"
+    embed.add_field(name=field_name, value=rank_text)
+    if total_count is not None:
+        embed.set_footer(text=f"ページ {page + 1}/{max(1, -(-total_count // RANKING_SIZE))} ・ 全{total_count}人")
+    return embed
+
+class RankingView(ui.View):
+    """ランキングのページ送りと、自分の順位の確認を行うView"""
+    def __init__(self, cog: "ActivityCog", guild_id: int, metric: str, period: str, total_count: int):
+        super().__init__(timeout=300)
+        self.cog = cog
+        self.guild_id = guild_id
+        self.metric = metric
+        self.period = period
+        self.total_count = total_count
+        self.page = 0
+        self.update_buttons()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-self.total_count // RANKING_SIZE))
+
+    def update_buttons(self):
+        self.prev_button.disabled = self.page <= 0
+        self.next_button.disabled = self.page >= self.page_count - 1
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        self.page = max(0, min(page, self.page_count - 1))
+        self.update_buttons()
+        embed = await self.cog.get_ranking_page(self.guild_id, self.metric, self.period, self.page, self.total_count)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @ui.button(label="◀ 前へ", style=ButtonStyle.secondary)
+    async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @ui.button(label="次へ ▶", style=ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+    @ui.button(label="🙋 自分の順位", style=ButtonStyle.primary)
+    async def my_rank_button(self, interaction: discord.Interaction, button: ui.Button):
+        await interaction.response.send_message(await self.cog.format_my_rank(self.guild_id, interaction.user.id, self.metric, self.period), ephemeral=True)
+
 class ActivityCog(commands.Cog):
     """サーバー内の活動（チャット、VC参加）を記録し、ランキング化する機能"""
     help_category = "活動記録"
     help_description = "サーバー内のチャット・VC活動履歴やランキングを記録・表示します。"
     command_helps = {
-        "ranking": "サーバー内の活動ランキングを表示します（チャット回数/VC滞在時間・総合/月間/週間）",
+        "ranking": "サーバー内の活動ランキングを表示します（チャット回数/VC滞在時間・総合/月間/週間）。ボタンでページ送りや自分の順位の確認ができます",
     }
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        # ボイスチャンネルのセッションを一時的に保存する辞書 { user_id: join_time }
+        # ボイスチャンネルのセッションを一時的に保存する辞書 { (guild_id, user_id): {"since": 最後に加算した時刻, "name": 表示名} }
+        # シャードごとに別のプロセスで動く場合も、ギルドごとに区別して記録する
         self.vc_sessions = {}
-        # 1時間ごとにリセット処理をチェックするタスクを開始
-        self.check_and_reset_activity.start()
+        # まだDBに書き込んでいない加算値 { "activity_<guild_id>_<user_id>": {"message_count.total": 3, ...} } と表示名
+        self.pending_increments = {}
+        self.pending_names = {}
+        # 加算値の書き込みと週間・月間のリセットを同時に行わないためのロック（リセット前の加算が新しい期間に入らないようにする）
+        self.flush_lock = asyncio.Lock()
+        # ランキング上位のキャッシュ { (guild_id, metric, period): {"entries": [...], "embed": Embed | None, "cached_at": time.monotonic()} }
+        self.ranking_cache = {}
+        # キャッシュを書き換えるたびに増える番号。DBの集計中にキャッシュが変わったかを判定する
+        self.ranking_generation = 0
+        # 1時間ごとにリセット処理をチェックするタスクを開始（複数プロセスの場合はクラスター0だけが行う）
+        if sharding.is_primary():
+            self.check_and_reset_activity.start()
+        # 一定間隔で活動記録をまとめてDBに加算するタスクを開始
+        self.flush_activity.start()
+        router.subscribe("activity", self.handle_message)
 
     def cog_unload(self):
+        router.unsubscribe("activity")
         # Cogがアンロードされるときにタスクを安全に停止する
         self.check_and_reset_activity.cancel()
-
-    def get_activity_db(self, user_id: str) -> dict:
+        self.flush_activity.cancel()
+        # 停止前に、未反映の活動記録を書き込んでおく
+        self.flush_pending()
+
+    def _add_pending(self, guild_id: int, user_id: int, name: str, metric: str, amount: int):
+        """まだDBに書き込んでいない加算値を、3つの集計期間すべてに積み上げる"""
+        key = guilds.key("activity", guild_id, user_id)
+        increments = self.pending_increments.setdefault(key, {})
+        for period in PERIODS:
+            path = f"{metric}.{period}"
+            increments[path] = increments.get(path, 0) + amount
+        self.pending_names[key] = {"name": name}
+
+    def _credit_session(self, session_key: tuple, now: datetime):
+        """1人分のVCセッションについて、前回加算以降の経過秒数を未反映の加算値に追加する"""
+        session = self.vc_sessions[session_key]
+        seconds = int((now - session["since"]).total_seconds())
+        if seconds <= 0:
+            return
+        # 端数の秒は次回に持ち越すため、加算した秒数分だけ起点を進める
+        session["since"] += timedelta(seconds=seconds)
+        self._add_pending(*session_key, session["name"], "vc_seconds", seconds)
+
+    def _take_pending(self) -> tuple[dict, dict]:
+        """参加中の全員の滞在時間を加算値に含めたうえで、未反映の加算値を取り出す"""
+        now = datetime.now()
+        for session_key in list(self.vc_sessions.keys()):
+            self._credit_session(session_key, now)
+        increments, names = self.pending_increments, self.pending_names
+        self.pending_increments, self.pending_names = {}, {}
+        return increments, names
+
+    def _restore_pending(self, increments: dict, names: dict):
+        """書き込みに失敗した加算値を未反映の加算値に戻す（取り出した後に積まれた分と合算する）"""
+        for key, fields in increments.items():
+            pending = self.pending_increments.setdefault(key, {})
+            for path, amount in fields.items():
+                pending[path] = pending.get(path, 0) + amount
+        for key, name in names.items():
+            self.pending_names.setdefault(key, name)
+
+    def flush_pending(self):
+        """参加中の全員の滞在時間とチャット数を、1回のバルク書き込みでDBに加算する"""
+        increments, names = self._take_pending()
+        if not increments: return
+        try:
+            db.increment_many(increments, names)
+        except Exception as e:
+            self._restore_pending(increments, names)
+            print(f"ERROR: 活動記録の書き込みに失敗しました（{len(increments)}件を保留中）: {e}")
+            return
+        self._apply_to_ranking_cache(increments, names)
+
+    def _apply_to_ranking_cache(self, increments: dict, names: dict):
+        """書き込んだ加算値をランキングキャッシュに反映し、反映できないものは破棄する"""
+        self.ranking_generation += 1
+        for cache_key in list(self.ranking_cache.keys()):
+            guild_id, metric, period = cache_key
+            path, prefix = f"{metric}.{period}", guilds.key("activity", guild_id, "")
+            changed = {key: inc[path] for key, inc in increments.items() if key.startswith(prefix) and inc.get(path)}
+            if not changed:
+                continue
+            cached = self.ranking_cache[cache_key]
+            entries = {entry["key"]: entry for entry in cached["entries"]}
+            # 上位に満たない場合は、キャッシュ外のユーザーは0点だったと確定できる
+            is_complete = len(entries) < RANKING_SIZE
+            if not is_complete and any(key not in entries for key in changed):
+                # キャッシュ外のユーザーの現在値は不明なので、このエントリだけ作り直す
+                del self.ranking_cache[cache_key]
+                continue
+            for key, amount in changed.items():
+                entry = entries.setdefault(key, {"key": key, "name": "", "score": 0})
+                entry["score"] += amount
+                entry["name"] = names.get(key, {}).get("name") or entry["name"]
+            sorted_entries = sorted(entries.values(), key=lambda x: x["score"], reverse=True)
+            # 新しくランクインした人数分だけ総人数も増える
+            total_count = cached.get("total_count", 0) + len(entries) - len(cached["entries"])
+            self.ranking_cache[cache_key] = {"entries": sorted_entries[:RANKING_SIZE], "embed": None, "total_count": total_count, "cached_at": cached["cached_at"]}
+
+    def invalidate_ranking_cache(self, period: str):
+        """指定した集計期間のランキングキャッシュだけを破棄する"""
+        self.ranking_generation += 1
+        for cache_key in [k for k in self.ranking_cache if k[2] == period]:
+            del self.ranking_cache[cache_key]
+
+    def _fetch_ranking_entries(self, guild_id: int, metric: str, period: str, page: int) -> list[dict]:
+        """DBのランキング用インデックスから、ギルド内の指定ページのユーザーを取得する"""
+        field = f"{metric}.{period}"
+        entries = []
+        for key, user_data in db.ranked(guilds.key("activity", guild_id, ""), field, offset=page * RANKING_SIZE, limit=RANKING_SIZE):
+            if user_data and user_data.get("name"):
+                entries.append({"key": key, "name": user_data["name"], "score": user_data.get(metric, {}).get(period, 0)})
+        return entries
+
+    async def get_ranking(self, guild_id: int, metric: str, period: str) -> dict:
+        """ランキング上位をキャッシュから取得し、なければDBから集計する"""
+        cache_key = (guild_id, metric, period)
+        cached = self.ranking_cache.get(cache_key)
+        if cached is not None and sharding.is_clustered() and time.monotonic() - cached["cached_at"] > RANKING_CACHE_TTL_SECONDS:
+            cached = None
+        metrics.cache_result("ranking", cached is not None)
+        if cached is None:
+            generation = self.ranking_generation
+            entries = await db.run(self._fetch_ranking_entries, guild_id, metric, period, 0)
+            total_count = await db.run(db.count_ranked, guilds.key("activity", guild_id, ""), f"{metric}.{period}")
+            cached = {"entries": entries, "embed": None, "total_count": total_count, "cached_at": time.monotonic()}
+            # 集計中に書き込みやリセットがあった場合、古い結果をキャッシュに残さない
+            if generation == self.ranking_generation:
+                self.ranking_cache[cache_key] = cached
+        if cached["embed"] is None:
+            cached["embed"] = build_ranking_embed(metric, period, cached["entries"], 0, cached.get("total_count"))
+        return cached
+
+    async def get_ranking_page(self, guild_id: int, metric: str, period: str, page: int, total_count: int) -> discord.Embed:
+        """ランキングの指定ページのEmbedを返す。1ページ目はキャッシュを使う"""
+        if page == 0:
+            return (await self.get_ranking(guild_id, metric, period))["embed"]
+        entries = await db.run(self._fetch_ranking_entries, guild_id, metric, period, page)
+        return build_ranking_embed(metric, period, entries, page, total_count)
+
+    async def format_my_rank(self, guild_id: int, user_id: int, metric: str, period: str) -> str:
+        """ユーザー自身のギルド内の順位をインデックスから検索して文章にする"""
+        result = await db.run(db.rank_of, guilds.key("activity", guild_id, ""), f"{metric}.{period}", guilds.key("activity", guild_id, user_id))
+        title = f"{RANKING_PERIOD_NAMES[period]} {RANKING_TYPE_NAMES[metric]}"
+        if not result:
+            return f"{title} ランキングに、まだあなたの記録はありません。"
+        rank, score = result
+        score_display = format_seconds(score) if metric == "vc_seconds" else f"{score} 回"
+        return f"{title} ランキングでのあなたの順位は **{rank}位** です。（{score_display}）"
+
+    def get_activity_db(self, guild_id: int, user_id: str) -> dict:
         """ユーザーの活動記録データをDBから取得または初期化する"""
-        key = f"activity_{user_id}"
+        key = guilds.key("activity", guild_id, user_id)
         default_data = {
             "name": "",
             "message_count": {"total": 0, "monthly": 0, "weekly": 0},
@@ -61,24 +290,14 @@ class ActivityCog(commands.Cog):
             for channel in guild.voice_channels:
                 for member in channel.members:
                     if not member.bot:
-                        self.vc_sessions[member.id] = datetime.now()
+                        # 再接続でon_readyが再度呼ばれても、計測中のセッションは維持する
+                        self.vc_sessions.setdefault((guild.id, member.id), {"since": datetime.now(), "name": member.display_name})
         print(f"現在 {len(self.vc_sessions)} 人がVCに参加中です。")
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        """メッセージが投稿されるたびに呼ばれ、チャット数をカウントする"""
-        if not message.guild or message.author.bot:
-            return
-
-        user_id = str(message.author.id)
-        user_activity = self.get_activity_db(user_id)
-
-        user_activity["name"] = message.author.display_name
-        user_activity["message_count"]["total"] += 1
-        user_activity["message_count"]["monthly"] += 1
-        user_activity["message_count"]["weekly"] += 1
-
-        db.set(f"activity_{user_id}", user_activity)
+    async def handle_message(self, context: MessageContext):
+        """メッセージが投稿されるたびに呼ばれ、チャット数をカウントする（ボット・DMは router が除外済み）"""
+        # DBへの書き込みは flush_activity でまとめて行う
+        self._add_pending(context.guild_id, context.user_id, context.display_name, "message_count", 1)
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
@@ -86,25 +305,18 @@ class ActivityCog(commands.Cog):
         if member.bot:
             return
 
-        user_id = member.id
+        session_key = (member.guild.id, member.id)
 
         # VCに参加した時
         if before.channel is None and after.channel is not None:
-            self.vc_sessions[user_id] = datetime.now()
+            self.vc_sessions[session_key] = {"since": datetime.now(), "name": member.display_name}
 
-        # VCから退出した時
+        # VCから退出した時（定期加算されていない残りの時間だけを加算する）
         elif before.channel is not None and after.channel is None:
-            if user_id in self.vc_sessions:
-                join_time = self.vc_sessions.pop(user_id)
-                duration_seconds = int((datetime.now() - join_time).total_seconds())
-
-                user_activity = self.get_activity_db(str(user_id))
-                user_activity["name"] = member.display_name
-                user_activity["vc_seconds"]["total"] += duration_seconds
-                user_activity["vc_seconds"]["monthly"] += duration_seconds
-                user_activity["vc_seconds"]["weekly"] += duration_seconds
-
-                db.set(f"activity_{str(user_id)}", user_activity)
+            if session_key in self.vc_sessions:
+                self.vc_sessions[session_key]["name"] = member.display_name
+                self._credit_session(session_key, datetime.now())
+                del self.vc_sessions[session_key]
 
     @app_commands.command(name="ranking", description="サーバー内の活動ランキングを表示します。")
     @app_commands.describe(
@@ -112,89 +324,66 @@ class ActivityCog(commands.Cog):
         period="集計期間を選択してください。"
     )
     @app_commands.choices(
-        type=[
-            discord.app_commands.Choice(name="💬 チャット回数", value="message_count"),
-            discord.app_commands.Choice(name="🎤 VC滞在時間", value="vc_seconds"),
-        ],
-        period=[
-            discord.app_commands.Choice(name="👑 総合", value="total"),
-            discord.app_commands.Choice(name="🌙 月間", value="monthly"),
-            discord.app_commands.Choice(name="📅 週間", value="weekly"),
-        ]
+        type=[discord.app_commands.Choice(name=name, value=value) for value, name in RANKING_TYPE_NAMES.items()],
+        period=[discord.app_commands.Choice(name=name, value=value) for value, name in RANKING_PERIOD_NAMES.items()]
     )
     async def ranking(self, interaction: discord.Interaction, type: discord.app_commands.Choice[str], period: discord.app_commands.Choice[str]):
         await interaction.response.defer()
-
-        all_data = db.all()
-        all_users_data = []
-        for key, user_data in all_data.items():
-            if key.startswith("activity_"):
-                if user_data and user_data.get("name"):
-                    score = user_data.get(type.value, {}).get(period.value, 0)
-                    if score > 0:
-                        all_users_data.append({"name": user_data["name"], "score": score})
-
-        sorted_users = sorted(all_users_data, key=lambda x: x["score"], reverse=True)
-
-        embed = discord.Embed(
-            title=f"🏆 {period.name} {type.name} ランキング",
-            description="サーバー内での活動ランキングです。",
-            color=discord.Color.gold()
-        )
-
-        rank_text = ""
-        for i, user in enumerate(sorted_users[:10]):
-            rank = i + 1
-            name = user["name"]
-            score = user["score"]
-
-            score_display = format_seconds(score) if type.value == "vc_seconds" else f"{score} 回"
-
-            if rank == 1: rank_text += f"🥇 **{rank}位:** {name} - **{score_display}**\n"
-            elif rank == 2: rank_text += f"🥈 **{rank}位:** {name} - **{score_display}**\n"
-            elif rank == 3: rank_text += f"🥉 **{rank}位:** {name} - **{score_display}**\n"
-            else: rank_text += f"**{rank}位:** {name} - {score_display}\n"
-
-        if not rank_text:
-            rank_text = "まだ誰もランクインしていません。"
-
-        embed.add_field(name="Top 10", value=rank_text)
-        await interaction.followup.send(embed=embed)
+        # 同じ種類・期間のランキングは、活動記録が反映されるまでキャッシュから返す
+        ranking = await self.get_ranking(interaction.guild_id, type.value, period.value)
+        view = RankingView(self, interaction.guild_id, type.value, period.value, ranking.get("total_count", 0))
+        await interaction.followup.send(embed=ranking["embed"], view=view)
+
+    def reset_period(self, period: str, batch_size: int = 500):
+        """全員の指定期間の記録を0に戻す。キーを順に走査し、batch_size 件ごとにまとめて書き込む"""
+        reset_fields = {"message_count." + period: 0, "vc_seconds." + period: 0}
+        operations = []
+        for key, _ in db.scan("activity_", projection=[], batch_size=batch_size):
+            operations.append(("update", key, {}, reset_fields))
+            if len(operations) >= batch_size:
+                db.bulk_write(operations); operations = []
+        if operations:
+            db.bulk_write(operations)
 
     @tasks.loop(hours=1.0)
+    @metrics.timed_task("check_and_reset_activity")
     async def check_and_reset_activity(self):
         """週間・月間の活動記録をリセットする必要があるかチェックする"""
         now = datetime.now(timezone(timedelta(hours=+9), 'JST'))
         tracker_key = "_internal_tracker"
-        tracker = db.get(tracker_key, {"weekly": "", "monthly": ""})
+        tracker = await db.run(db.get, tracker_key, {"weekly": "", "monthly": ""})
 
         current_week = now.strftime("%Y-%U")
         current_month = now.strftime("%Y-%m")
 
+        if tracker.get("weekly") == current_week and tracker.get("monthly") == current_month: return
+        async with self.flush_lock:
+            # 前の期間の加算値を先に書き込む（リセット後に書き込むと新しい期間の記録になってしまう）
+            if not await self._flush(): return print("ERROR: リセット前の活動記録の書き込みに失敗したため、リセットを次回に延期します。")
+            await self._reset_periods(tracker, current_week, current_month)
+
+    async def _reset_periods(self, tracker: dict, current_week: str, current_month: str):
+        """週間・月間の記録のうち、期間が変わった方を0に戻して tracker を進める"""
+        tracker_key = "_internal_tracker"
         # --- 週間リセットのチェック ---
         if tracker.get("weekly") != current_week:
             print(f"新しい週 ({current_week}) を検出しました。週間活動記録をリセットします。")
-            all_data = db.all()
-            for key, user_data in all_data.items():
-                if key.startswith("activity_"):
-                    user_data["message_count"]["weekly"] = 0
-                    user_data["vc_seconds"]["weekly"] = 0
-                    db.set(key, user_data)
+            # 全員をリセットできなかった場合は記録を進めず、次回（1時間後）にやり直す
+            try: await db.run(self.reset_period, "weekly")
+            except DatabaseUnavailableError as e: return print(f"ERROR: 週間活動記録のリセットに失敗しました（次回に再試行します）: {e}")
             tracker["weekly"] = current_week
-            db.set(tracker_key, tracker)
+            await db.run(db.set, tracker_key, tracker)
+            self.invalidate_ranking_cache("weekly")
             print("週間活動記録のリセットが完了しました。")
 
         # --- 月間リセットのチェック ---
         if tracker.get("monthly") != current_month:
             print(f"新しい月 ({current_month}) を検出しました。月間活動記録をリセットします。")
-            all_data = db.all()
-            for key, user_data in all_data.items():
-                 if key.startswith("activity_"):
-                    user_data["message_count"]["monthly"] = 0
-                    user_data["vc_seconds"]["monthly"] = 0
-                    db.set(key, user_data)
+            try: await db.run(self.reset_period, "monthly")
+            except DatabaseUnavailableError as e: return print(f"ERROR: 月間活動記録のリセットに失敗しました（次回に再試行します）: {e}")
             tracker["monthly"] = current_month
-            db.set(tracker_key, tracker)
+            await db.run(db.set, tracker_key, tracker)
+            self.invalidate_ranking_cache("monthly")
             print("月間活動記録のリセットが完了しました。")
 
     @check_and_reset_activity.before_loop
@@ -202,6 +391,31 @@ class ActivityCog(commands.Cog):
         # ボットが完全に起動するまで待つ
         await self.bot.wait_until_ready()
 
+    @tasks.loop(seconds=ACTIVITY_FLUSH_INTERVAL_SECONDS)
+    @metrics.timed_task("flush_activity")
+    async def flush_activity(self):
+        """VC滞在時間とチャット数を定期的にDBへ反映し、ランキングをほぼリアルタイムに保つ"""
+        async with self.flush_lock:
+            await self._flush()
+
+    async def _flush(self) -> bool:
+        """未反映の加算値をDBに書き込む。失敗した場合は加算値を戻して False を返す"""
+        increments, names = self._take_pending()
+        if not increments: return True
+        try:
+            await db.run(db.increment_many, increments, names)
+        except Exception as e:
+            # ループを止めず、加算値は次回にまとめて書き込む
+            self._restore_pending(increments, names)
+            print(f"ERROR: 活動記録の書き込みに失敗しました（{len(increments)}件を次回に再試行します）: {e}")
+            return False
+        self._apply_to_ranking_cache(increments, names)
+        return True
+
+    @flush_activity.before_loop
+    async def before_flush_activity(self):
+        await self.bot.wait_until_ready()
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(ActivityCog(bot))
\ No newline at end of file
@@ -1,6 +1,7 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
+from db_handler import db
 
 class CoreCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -9,7 +10,11 @@ class CoreCog(commands.Cog):
     @app_commands.command(name="ping", description="ボットの応答速度をテストします。")
     async def ping(self, interaction: discord.Interaction):
         latency = self.bot.latency * 1000
-        await interaction.response.send_message(f"🏓 Pong! \n応答速度: {latency:.2f}ms")
+        status = db.health()
+        db_line = f"DB: {status['backend']} ({status['state']})"
+        if status.get("queued_writes"):
+            db_line += f" / 保留中の書き込み: {status['queued_writes']}件"
+        await interaction.response.send_message(f"🏓 Pong! \n応答速度: {latency:.2f}ms\n{db_line}")
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(CoreCog(bot))
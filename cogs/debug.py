@@ -0,0 +1,29 @@
+import io
+import discord
+from discord import app_commands
+from discord.ext import commands
+import profiler
+
+class DebugCog(commands.Cog):
+    """稼働中のボットを調査するための管理者用コマンド（ヘルプには表示しない）"""
+    debug = app_commands.Group(name="debug", description="【管理者用】ボットの調査用コマンド", guild_only=True, default_permissions=discord.Permissions(administrator=True))
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @debug.command(name="profile", description="【管理者用】指定秒数のあいだイベントループをプロファイルし、結果を添付します。")
+    @app_commands.describe(seconds="計測する秒数", mode="sampling: 低負荷（本番向け） / cprofile: 詳細だが計測中は遅くなる")
+    @app_commands.choices(mode=[app_commands.Choice(name=mode, value=mode) for mode in profiler.MODES])
+    @app_commands.checks.has_permissions(administrator=True)
+    async def profile(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 1, profiler.MAX_PROFILE_SECONDS] = 10, mode: str = "sampling"):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            result = await profiler.profile(seconds, mode)
+        except profiler.ProfilerBusyError as e:
+            return await interaction.followup.send(f"❌ {e}", ephemeral=True)
+        report = result.report if len(result.report) <= 1800 else result.report[:1800] + "\n…"
+        file = discord.File(fp=io.BytesIO(result.attachment), filename=result.filename)
+        await interaction.followup.send(f"✅ プロファイル結果（{result.mode} / {result.seconds:.0f}秒）\n```\n{report}\n```", file=file, ephemeral=True)
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(DebugCog(bot))
@@ -1,27 +1,49 @@
 import discord
-from discord import app_commands, ui, ButtonStyle, Embed, Color, Interaction, Member, ChannelType, PermissionOverwrite
+from discord import app_commands, ui, ButtonStyle, Embed, Color, Interaction, Member, ChannelType
 from discord.ext import commands
-from db_handler import db
-import config
+from db_handler import db, DatabaseUnavailableError
+import guilds
+import member_cache
+import shuffle_pool
+import team_solver
 import random
 import re
+import functools
 from datetime import datetime, timedelta
 
 # --- 定数とヘルパー関数 ---
 ROLES = ["gold", "mid", "exp", "jg", "roam"]
 ROLES_EMOJI = {"gold":"👑", "mid":"🔮", "exp":"⚔️", "jg":"🗡️", "roam":"🛡️"}
+TEAM_SIZE = len(ROLES)
+# 1回のチーム分けで作る試合数の上限（結果のEmbedのフィールド数と、プールのロール・VCの数を抑える）
+MAX_SHUFFLE_MATCHES = 10
+# チームの表示名とロールの色
+TEAM_STYLES = {"red": ("🔴 赤チーム", Color.red()), "blue": ("🔵 青チーム", Color.blue())}
+SUB_STYLE = ("🟡 控え", Color.gold())
 
-def get_user_profile(user_id: int) -> dict:
-    key = f"profile_{user_id}"
+def team_labels(matches: int) -> dict:
+    """
+    { チーム: 表示名 }。1試合目は "red" / "blue"、2試合目以降は "red2" / "blue2" ...
+    プールのロール・VCはチームごとに使い回すため、表示名は試合数によらずチームごとに同じにする（2試合目以降に番号を付ける）。
+    """
+    return {f"{color}{index + 1 if index else ''}": f"{label}{index + 1 if index else ''}" for index in range(matches) for color, (label, _) in TEAM_STYLES.items()}
+
+def get_user_profile(guild_id: int, user_id: int) -> dict:
+    key = guilds.key("profile", guild_id, user_id)
     data = db.get(key)
     return data if data else {"role_priority": []}
 
-def set_user_profile(user_id: int, profile_data: dict):
-    key = f"profile_{user_id}"
+def get_user_profiles(guild_id: int, user_ids) -> dict:
+    """複数ユーザーのプロフィールを1回のDBアクセスでまとめて取得する { user_id_str: profile }"""
+    found = db.get_many([guilds.key("profile", guild_id, uid) for uid in user_ids])
+    return {str(uid): found.get(guilds.key("profile", guild_id, uid)) or {"role_priority": []} for uid in user_ids}
+
+def set_user_profile(guild_id: int, user_id: int, profile_data: dict):
+    key = guilds.key("profile", guild_id, user_id)
     db.set(key, profile_data)
 
-def user_profile_not_set(user_id: int) -> bool:
-    return not get_user_profile(user_id).get("role_priority")
+def user_profile_not_set(guild_id: int, user_id: int) -> bool:
+    return not get_user_profile(guild_id, user_id).get("role_priority")
 
 def parse_time_range(time_str: str, default_start="20:00", default_end="24:00"):
     if not time_str: return (default_start, default_end)
@@ -34,13 +56,77 @@ def parse_time_range(time_str: str, default_start="20:00", default_end="24:00"):
     if m: return (f"{int(m.group(1)):02}:{m.group(2)}", default_end)
     return (default_start, default_end)
 
+# --- イベント募集の参加状況の表示 ---
+# Discord の制限: フィールドの値は1024文字、1つのEmbedのフィールドは25個、1メッセージのEmbedは10個・全Embedの文字数の合計は6000文字
+FIELD_VALUE_LIMIT = 1024
+EMBED_FIELD_LIMIT = 25
+MESSAGE_EMBED_LIMIT = 10
+MESSAGE_TEXT_LIMIT = 6000
+PARTICIPANT_STATUSES = {"参加": "✅", "一時的に参加": "🕒", "空いていれば参加": "❔"}
+# 参加者一覧（ボタンで表示する、ページ送りの一覧）の1ページの行数
+PARTICIPANT_PAGE_SIZE = 20
+
+@functools.lru_cache(maxsize=4096)
+def format_participant_line(user_id: str, roles: tuple, time: str) -> str:
+    """参加者1人分の行（同じ内容の行は作り直さない）"""
+    roles_str = f"({', '.join(roles)})" if roles else ""
+    time_str = f" [{time}]" if time else ""
+    return f"- <@{user_id}> {roles_str}{time_str}"
+
+def chunk_lines(lines: list[str], limit: int = FIELD_VALUE_LIMIT) -> list[str]:
+    """行を、改行を含めて limit 文字以内の塊にまとめる"""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        line = line[:limit]
+        if current and size + 1 + len(line) > limit:
+            chunks.append("\n".join(current)); current, size = [], 0
+        size += len(line) + (1 if current else 0)
+        current.append(line)
+    if current: chunks.append("\n".join(current))
+    return chunks
+
+def _embed_text_length(embed: Embed) -> int:
+    """フィールド以外の、文字数の制限に数えられる部分の文字数"""
+    return len(embed.title or "") + len(embed.description or "") + len(embed.footer.text or "") + len(embed.author.name or "")
+
+def build_event_embeds(base: Embed, header: str, sections: dict) -> tuple[list[Embed], bool]:
+    """
+    募集メッセージのEmbedを作る。sections は { 状態: [参加者の行] }。
+    全員分を、1024文字ごとのフィールド・25フィールドごとのEmbedに分けて載せる。
+    メッセージの制限に収まらない場合は、状態ごとに1フィールドに入る分だけ載せて残りを省略し、フッターで一覧のボタンを案内する。
+    (Embedの一覧, 省略したか) を返す。
+    """
+    fields, inline = [], all(len("\n".join(lines)) <= FIELD_VALUE_LIMIT for lines in sections.values())
+    for status, lines in sections.items():
+        emoji = PARTICIPANT_STATUSES[status]
+        for i, chunk in enumerate(chunk_lines(lines) or ["まだいません"]):
+            fields.append((f"{emoji} {status} ({len(lines)}人)" if i == 0 else f"{emoji} {status} (続き)", chunk))
+    fields.insert(0, (header, "\u200b"))
+    text_length = _embed_text_length(base) + sum(len(name) + len(value) for name, value in fields)
+    truncated = len(fields) > EMBED_FIELD_LIMIT * MESSAGE_EMBED_LIMIT or text_length > MESSAGE_TEXT_LIMIT
+    if truncated:
+        fields, inline = [(header, "\u200b")], True
+        for status, lines in sections.items():
+            chunk = chunk_lines(lines, FIELD_VALUE_LIMIT - 40)[0] if lines else "まだいません"
+            shown = chunk.count("\n") + 1 if lines else 0
+            if shown < len(lines): chunk += f"\n…ほか{len(lines) - shown}人"
+            fields.append((f"{PARTICIPANT_STATUSES[status]} {status} ({len(lines)}人)", chunk))
+    embeds = [base.copy()]
+    embeds[0].clear_fields()
+    # フッターは省略したときの案内にだけ使う（前回の案内を残さない）
+    embeds[0].remove_footer()
+    if truncated: embeds[0].set_footer(text="全員の一覧は「👥 参加者一覧」ボタンから確認できます。")
+    for i, (name, value) in enumerate(fields):
+        if i and i % EMBED_FIELD_LIMIT == 0: embeds.append(Embed(color=base.color))
+        embeds[-1].add_field(name=name, value=value, inline=inline and i > 0)
+    return embeds, truncated
+
 # --- UIクラス定義 ---
 
 class ProfileEditView(ui.View):
-    def __init__(self, target_user: Member):
+    def __init__(self, target_user: Member, profile: dict):
         super().__init__(timeout=300)
         self.target_user = target_user
-        profile = get_user_profile(target_user.id)
         self.priority_list: list[str] = profile.get("role_priority", [])
         for role in ROLES:
             button = ui.Button(label=role.upper(), custom_id=f"profile_role_{role}", style=ButtonStyle.secondary)
@@ -71,7 +157,7 @@ class ProfileEditView(ui.View):
             if len(self.priority_list) < len(ROLES): self.priority_list.append(role_name)
         await self.update_message(interaction)
     async def confirm_button_callback(self, interaction: Interaction):
-        set_user_profile(self.target_user.id, {"role_priority": self.priority_list, "name": self.target_user.display_name})
+        await db.run(set_user_profile, self.target_user.guild.id, self.target_user.id, {"role_priority": self.priority_list, "name": self.target_user.display_name})
         formatted_list = "\n".join(f"{i+1}. `{role.upper()}`" for i, role in enumerate(self.priority_list))
         embed = Embed(title="✅ プロフィール更新完了", description=f"以下の希望順位でロールを登録しました。\n\n{formatted_list}", color=Color.green())
         for item in self.children: item.disabled = True
@@ -84,14 +170,14 @@ class ProfileEditView(ui.View):
 
 class ProfileSetForUserModal(ui.Modal, title="代理プロフィール設定"):
     roles_input = ui.TextInput(label="希望ロールを上から順番に改行で区切って入力", style=discord.TextStyle.paragraph, placeholder="例:\nmid\njg\ngold...", required=True)
-    def __init__(self, target_user: Member):
-        super().__init__(); self.target_user = target_user; profile = get_user_profile(self.target_user.id)
+    def __init__(self, target_user: Member, profile: dict):
+        super().__init__(); self.target_user = target_user
         self.roles_input.default = "\n".join(profile.get("role_priority", []))
     async def on_submit(self, interaction: Interaction):
         raw_input = self.roles_input.value.strip().lower()
         priority_list = [role.strip() for role in raw_input.split('\n') if role.strip() in ROLES]
         if not priority_list: return await interaction.response.send_message("❌ 有効なロール名が入力されませんでした。", ephemeral=True)
-        set_user_profile(self.target_user.id, {"role_priority": priority_list, "name": self.target_user.display_name})
+        await db.run(set_user_profile, self.target_user.guild.id, self.target_user.id, {"role_priority": priority_list, "name": self.target_user.display_name})
         formatted_list = "\n".join(f"{i+1}. `{role.upper()}`" for i, role in enumerate(priority_list))
         embed = Embed(title=f"✅ {self.target_user.display_name}さんのプロフィールを更新", description=f"以下の希望順位でロールを登録しました。\n\n{formatted_list}", color=Color.green())
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -104,45 +190,59 @@ class EventView(ui.View):
         self.temp_attend_button.custom_id = f"event_temp_attend_{self.event_id}"
         self.if_free_button.custom_id = f"event_if_free_{self.event_id}"
         self.leave_button.custom_id = f"event_leave_{self.event_id}"
+        self.list_button.custom_id = f"event_list_{self.event_id}"
+        # 状態ごとの、前回表示した参加者の行 { 状態: (参加者の内容, [行]) }。変わっていない状態は並べ直さない
+        self.sections = {}
+    def render_sections(self, participants: dict) -> dict:
+        """状態ごとの参加者の行（参加表明の早い順）を返す"""
+        grouped = {status: [] for status in PARTICIPANT_STATUSES}
+        for user_id, p_data in participants.items():
+            if p_data.get("status") in grouped: grouped[p_data["status"]].append((user_id, p_data))
+        sections = {}
+        for status, entries in grouped.items():
+            signature = tuple((user_id, p_data.get("timestamp", ""), tuple(p_data.get("roles") or ()), p_data.get("time", "")) for user_id, p_data in entries)
+            cached = self.sections.get(status)
+            if cached is None or cached[0] != signature:
+                entries.sort(key=lambda item: item[1].get("timestamp", ""))
+                lines = [format_participant_line(user_id, tuple(p_data.get("roles") or ()), p_data.get("time", "") if status == "一時的に参加" else "") for user_id, p_data in entries]
+                cached = self.sections[status] = (signature, lines)
+            sections[status] = cached[1]
+        return sections
     async def update_embed(self, interaction: Interaction):
-        events = db.get("active_events", {})
+        events = await db.run(db.get, guilds.key("active_events", interaction.guild_id), {})
         event_data = events.get(self.event_id)
         if not event_data or not interaction.message: return
-        participants = event_data.get("participants", {})
+        sections = self.render_sections(event_data.get("participants", {}))
         limit = event_data.get("limit")
-        participant_count = len([p for p in participants.values() if p.get("status") in ["参加", "一時的に参加", "空いていれば参加"]])
+        participant_count = sum(len(lines) for lines in sections.values())
         limit_str = f"/{limit}人" if limit else ""
-        embed = interaction.message.embeds[0]; embed.clear_fields()
-        embed.add_field(name=f"現在の参加状況 ({participant_count}{limit_str})", value="\u200b", inline=False)
-        statuses = {"参加": "✅", "一時的に参加": "🕒", "空いていれば参加": "❔"}
-        for status, emoji in statuses.items():
-            member_list = []
-            sorted_participants = sorted([item for item in participants.items() if item[1].get("status") == status], key=lambda item: item[1].get("timestamp", ""))
-            for user_id, p_data in sorted_participants:
-                roles_str = f"({', '.join(p_data.get('roles', []))})" if p_data.get('roles') else ""
-                time_str = f" [{p_data.get('time')}]" if status == "一時的に参加" and p_data.get('time') else ""
-                member_list.append(f"- <@{user_id}> {roles_str}{time_str}")
-            embed.add_field(name=f"{emoji} {status} ({len(member_list)}人)", value="\n".join(member_list) if member_list else "まだいません", inline=True)
-        await interaction.message.edit(embed=embed)
+        header = f"現在の参加状況 ({participant_count}{limit_str})"
+        embeds, _ = build_event_embeds(interaction.message.embeds[0], header, sections)
+        # 以前に作成した募集メッセージにも一覧のボタンが表示されるよう、ボタンも一緒に送る
+        await interaction.message.edit(embeds=embeds, view=self)
     async def update_participant_data(self, interaction: Interaction, status: str, roles=None, time=None) -> bool:
-        events = db.get("active_events", {})
-        if self.event_id not in events:
+        user_id_str = str(interaction.user.id)
+        if status != "辞退" and not roles: roles = (await db.run(get_user_profile, interaction.guild_id, interaction.user.id)).get("role_priority", [])
+        entry = {"name": interaction.user.display_name, "roles": roles, "status": status, "timestamp": datetime.now().isoformat(), "time": time if status == "一時的に参加" else ""}
+        exists = False
+        def apply(events):
+            # 同時に押された場合は最新の値で再実行されるため、ここでは値の書き換えだけを行う
+            nonlocal exists
+            exists = self.event_id in events
+            if not exists: return
+            participants = events[self.event_id]["participants"]
+            if status == "辞退": participants.pop(user_id_str, None)
+            else: participants[user_id_str] = entry
+        await db.run(db.update, guilds.key("active_events", interaction.guild_id), apply, {})
+        if not exists:
             msg = "このイベントは既に存在しません。";
             if not interaction.response.is_done(): await interaction.response.send_message(msg, ephemeral=True)
             else: await interaction.followup.send(msg, ephemeral=True)
             return False
-        participants = events[self.event_id]["participants"]
-        user_id_str = str(interaction.user.id)
-        if status == "辞退":
-            if user_id_str in participants: del participants[user_id_str]
-        else:
-            if not roles: roles = get_user_profile(interaction.user.id).get("role_priority", [])
-            participants[user_id_str] = {"name": interaction.user.display_name, "roles": roles, "status": status, "timestamp": datetime.now().isoformat(), "time": time if status == "一時的に参加" else ""}
-        db.set("active_events", events)
         await self.update_embed(interaction)
         return True
     async def _check_profile_and_rsvp(self, interaction: Interaction, status: str):
-        if user_profile_not_set(interaction.user.id): return await interaction.response.send_message("❌ まず `/profile set` で希望ロールを登録してください！", ephemeral=True)
+        if await db.run(user_profile_not_set, interaction.guild_id, interaction.user.id): return await interaction.response.send_message("❌ まず `/profile set` で希望ロールを登録してください！", ephemeral=True)
         await interaction.response.defer()
         success = await self.update_participant_data(interaction, status)
         if success: await interaction.followup.send(f"「{status}」で受け付けました。", ephemeral=True)
@@ -150,8 +250,9 @@ class EventView(ui.View):
     async def attend_button(self, i: Interaction, b: ui.Button): await self._check_profile_and_rsvp(i, "参加")
     @ui.button(label="🕒 一時参加", style=ButtonStyle.primary)
     async def temp_attend_button(self, i: Interaction, b: ui.Button):
-        if user_profile_not_set(i.user.id): return await i.response.send_message("❌ まず `/profile set`で希望ロールを登録してください！", ephemeral=True)
-        await i.response.send_modal(TempAttendModal(self, i.user))
+        role_priority = (await db.run(get_user_profile, i.guild_id, i.user.id)).get("role_priority", [])
+        if not role_priority: return await i.response.send_message("❌ まず `/profile set`で希望ロールを登録してください！", ephemeral=True)
+        await i.response.send_modal(TempAttendModal(self, role_priority))
     @ui.button(label="❔ 空いていれば参加", style=ButtonStyle.primary)
     async def if_free_button(self, i: Interaction, b: ui.Button): await self._check_profile_and_rsvp(i, "空いていれば参加")
     @ui.button(label="❌ 辞退", style=ButtonStyle.red, row=1)
@@ -159,16 +260,48 @@ class EventView(ui.View):
         await i.response.defer()
         success = await self.update_participant_data(i, "辞退")
         if success: await i.followup.send("参加を辞退しました。", ephemeral=True)
+    @ui.button(label="👥 参加者一覧", style=ButtonStyle.secondary, row=1)
+    async def list_button(self, i: Interaction, b: ui.Button):
+        event_data = (await db.run(db.get, guilds.key("active_events", i.guild_id), {})).get(self.event_id)
+        if not event_data: return await i.response.send_message("このイベントは既に存在しません。", ephemeral=True)
+        sections = self.render_sections(event_data.get("participants", {}))
+        lines = [line for status, status_lines in sections.items() for line in [f"**{PARTICIPANT_STATUSES[status]} {status} ({len(status_lines)}人)**"] + (status_lines or ["まだいません"])]
+        view = ParticipantListView(event_data.get("summary", ""), lines)
+        await i.response.send_message(embed=view.page_embed(), view=view, ephemeral=True)
+
+class ParticipantListView(ui.View):
+    """参加者の一覧を、PARTICIPANT_PAGE_SIZE 行ずつページ送りで表示する（本人にだけ表示）"""
+    def __init__(self, summary: str, lines: list[str]):
+        super().__init__(timeout=300)
+        self.summary = summary
+        self.pages = [lines[i:i + PARTICIPANT_PAGE_SIZE] for i in range(0, len(lines), PARTICIPANT_PAGE_SIZE)] or [[]]
+        self.page = 0
+        self._update_buttons()
+    def page_embed(self) -> Embed:
+        embed = Embed(title=f"👥 {self.summary} の参加者", description="\n".join(self.pages[self.page])[:4096], color=Color.blue())
+        embed.set_footer(text=f"{self.page + 1} / {len(self.pages)} ページ")
+        return embed
+    def _update_buttons(self):
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= len(self.pages) - 1
+    async def _show(self, interaction: Interaction, page: int):
+        self.page = page
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.page_embed(), view=self)
+    @ui.button(label="◀ 前へ", style=ButtonStyle.secondary)
+    async def prev_button(self, i: Interaction, b: ui.Button): await self._show(i, self.page - 1)
+    @ui.button(label="次へ ▶", style=ButtonStyle.secondary)
+    async def next_button(self, i: Interaction, b: ui.Button): await self._show(i, self.page + 1)
 
 class TempAttendModal(ui.Modal, title="一時的に参加"):
     roles_input = ui.TextInput(label="希望ロール (任意, 改行区切り)", style=discord.TextStyle.paragraph, placeholder="gold\nmid", required=False)
     time_input = ui.TextInput(label="参加可能な時間帯 (必須)", placeholder="例: 21:30~22:30", required=True)
-    def __init__(self, view: EventView, user: Member):
-        super().__init__(); self.view = view; self.roles_input.default = "\n".join(get_user_profile(user.id).get("role_priority", []))
+    def __init__(self, view: EventView, role_priority: list):
+        super().__init__(); self.view = view; self.roles_input.default = "\n".join(role_priority)
     async def on_submit(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True)
         roles = [r.strip().lower() for r in self.roles_input.value.split('\n') if r.strip().lower() in ROLES]
-        if not roles: roles = get_user_profile(interaction.user.id).get("role_priority", [])
+        if not roles: roles = (await db.run(get_user_profile, interaction.guild_id, interaction.user.id)).get("role_priority", [])
         success = await self.view.update_participant_data(interaction, "一時的に参加", roles=roles, time=self.time_input.value)
         if success: await interaction.followup.send("「一時的に参加」で受け付けました。", ephemeral=True)
 
@@ -189,10 +322,7 @@ class EventCreateModal(ui.Modal, title="イベント作成"):
             msg = await interaction.channel.send(embed=embed)
             event_id = str(msg.id)
             await msg.edit(view=EventView(event_id=event_id))
-            events_db_key = "active_events"
-            events = db.get(events_db_key, {})
-            events[event_id] = event_data
-            db.set(events_db_key, events)
+            await db.run(db.update, guilds.key("active_events", interaction.guild_id), lambda events: {**events, event_id: event_data}, {})
             await interaction.followup.send("✅ イベント募集を開始しました。", ephemeral=True)
         except Exception as e: await interaction.followup.send(f"❌ イベント作成中にエラーが発生しました: {e}", ephemeral=True)
 
@@ -203,7 +333,7 @@ class ShuffleResultView(ui.View):
     @ui.button(label="🟡 控えで参加する", style=ButtonStyle.primary, custom_id="shuffle_join_sub")
     async def join_sub_button(self, interaction: Interaction, button: ui.Button):
         await interaction.response.defer(ephemeral=True)
-        completed_shuffles = db.get("completed_shuffles", {})
+        completed_shuffles = await db.run(db.get, guilds.key("completed_shuffles", interaction.guild_id), {})
         completed_data = completed_shuffles.get(self.shuffle_id)
         if not completed_data: return
         user_id_str = str(interaction.user.id)
@@ -214,8 +344,10 @@ class ShuffleResultView(ui.View):
         if sub_role and isinstance(interaction.user, Member):
             try:
                 await interaction.user.add_roles(sub_role, reason="控え参加")
-                completed_shuffles[self.shuffle_id].setdefault("teams", {}).setdefault("subs", {})[user_id_str] = {"name": interaction.user.display_name}
-                db.set("completed_shuffles", completed_shuffles)
+                def apply(shuffles):
+                    if self.shuffle_id in shuffles:
+                        shuffles[self.shuffle_id].setdefault("teams", {}).setdefault("subs", {})[user_id_str] = {"name": interaction.user.display_name}
+                await db.run(db.update, guilds.key("completed_shuffles", interaction.guild_id), apply, {})
                 await interaction.followup.send("控えメンバーとして参加し、ロールを付与しました。", ephemeral=True)
             except discord.Forbidden: await interaction.followup.send("❌ ロール付与の権限がありません。", ephemeral=True)
         else: await interaction.followup.send("控えロールが見つからないか、エラーが発生しました。", ephemeral=True)
@@ -232,7 +364,7 @@ class FillRoleView(ui.View):
     def __init__(self, assignment_id: str, original_interaction: Interaction):
         super().__init__(timeout=300)
         self.assignment_id = assignment_id; self.original_interaction = original_interaction; self.selected_slot = None
-        assignments = db.get("active_assignments", {}); assignment_data = assignments.get(self.assignment_id)
+        assignments = db.get(guilds.key("active_assignments", original_interaction.guild_id), {}); assignment_data = assignments.get(self.assignment_id)
         options = []
         if assignment_data:
             for role, data in assignment_data["shifts"].items():
@@ -251,12 +383,19 @@ class FillRoleView(ui.View):
     async def confirm(self, interaction: Interaction, button: ui.Button):
         if not self.selected_slot: return await interaction.response.send_message("先にドロップダウンから担当したい枠を選択してください。", ephemeral=True)
         await interaction.response.defer()
-        assignments = db.get("active_assignments", {}); assignment_data = assignments.get(self.assignment_id)
-        if not assignment_data: return await interaction.followup.send("❌ この割り当ては既に存在しません。", ephemeral=True)
         role_to_fill = self.selected_slot
-        if assignment_data["shifts"][role_to_fill] is not None: return await interaction.followup.send("❌ そのロールは既に埋まっています。", ephemeral=True)
-        assignment_data["shifts"][role_to_fill] = {"name": interaction.user.display_name, "status": "後から参加"}
-        db.set("active_assignments", assignments)
+        # 同じ枠を複数人が同時に確定した場合も、先に書き込めた1人だけが埋められる
+        outcome, assignment_data = None, None
+        def apply(assignments):
+            nonlocal outcome, assignment_data
+            assignment_data = assignments.get(self.assignment_id)
+            if not assignment_data: outcome = "missing"; return
+            if assignment_data["shifts"][role_to_fill] is not None: outcome = "filled"; return
+            assignment_data["shifts"][role_to_fill] = {"name": interaction.user.display_name, "status": "後から参加"}
+            outcome = "ok"
+        await db.run(db.update, guilds.key("active_assignments", interaction.guild_id), apply, {})
+        if outcome == "missing": return await interaction.followup.send("❌ この割り当ては既に存在しません。", ephemeral=True)
+        if outcome == "filled": return await interaction.followup.send("❌ そのロールは既に埋まっています。", ephemeral=True)
         try:
             original_message = await self.original_interaction.channel.fetch_message(assignment_data["message_id"])
             cog = self.original_interaction.client.get_cog("EventsCog")
@@ -271,7 +410,7 @@ class EventsCog(commands.Cog):
     """イベント・プロフィール・チーム分け関連の機能"""
     help_category = "イベント"
     help_description = "イベント募集、プロフィール設定、チーム分けなどを行います。"
-    command_helps = { "profile set": "自分の希望ロール（役割）の優先順位を設定します。", "profile set_for_user": "【管理者用】他のメンバーの希望ロール順を代理で登録・更新します。", "event create": "参加者を募集するためのイベントパネルを作成します。", "event assign": "募集を締め切り、チーム分けはせずに役割分担を発表します。", "event shuffle": "募集を締め切り、5v5のチーム分けを自動で実行します。", "event cleanup": "チーム分けで作成された一時的なロールとVCを全て削除します。", "event priority_pick": "役割・チーム分けの際に、特定のメンバーを優先します。" }
+    command_helps = { "profile set": "自分の希望ロール（役割）の優先順位を設定します。", "profile set_for_user": "【管理者用】他のメンバーの希望ロール順を代理で登録・更新します。", "event create": "参加者を募集するためのイベントパネルを作成します。", "event assign": "募集を締め切り、チーム分けはせずに役割分担を発表します。", "event shuffle": "募集を締め切り、参加人数に応じて1つ以上の5v5のチーム分けを自動で実行します。", "event cleanup": "チーム分けで使ったロールとVCを返却します（付与を外して次のチーム分けで使い回します）。purge を指定すると、使っていないロールとVCを削除します。", "event priority_pick": "役割・チーム分けの際に、特定のメンバーを優先します。" }
 
     def __init__(self, bot: commands.Bot): self.bot = bot
     async def cog_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
@@ -285,8 +424,8 @@ class EventsCog(commands.Cog):
     @profile.command(name="set", description="自分の希望ロール順を、ボタン操作で登録・更新します。")
     async def profile_set(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True)
-        view = ProfileEditView(target_user=interaction.user)
-        profile = get_user_profile(interaction.user.id)
+        profile = await db.run(get_user_profile, interaction.guild_id, interaction.user.id)
+        view = ProfileEditView(target_user=interaction.user, profile=profile)
         current_priority = profile.get("role_priority", [])
         formatted_list = "\n".join(f"{i+1}. `{role.upper()}`" for i, role in enumerate(current_priority))
         if not formatted_list: formatted_list = "`（上のボタンを押して希望順位を追加してください）`"
@@ -297,7 +436,8 @@ class EventsCog(commands.Cog):
     @app_commands.describe(member="プロフィールを設定するメンバー")
     @app_commands.checks.has_permissions(administrator=True)
     async def profile_set_for_user(self, interaction: Interaction, member: Member):
-        await interaction.response.send_modal(ProfileSetForUserModal(target_user=member))
+        profile = await db.run(get_user_profile, interaction.guild_id, member.id)
+        await interaction.response.send_modal(ProfileSetForUserModal(target_user=member, profile=profile))
 
     @event.command(name="create", description="参加者を募集するためのイベントパネルを作成します。")
     @app_commands.checks.has_permissions(manage_events=True)
@@ -305,23 +445,36 @@ class EventsCog(commands.Cog):
         await interaction.response.send_modal(EventCreateModal())
 
     def _get_active_event(self, interaction: Interaction):
-        active_events = db.get("active_events", {})
+        active_events = db.get(guilds.key("active_events", interaction.guild_id), {})
         channel_events = {sid: sdata for sid, sdata in active_events.items() if sdata.get("channel_id") == interaction.channel_id}
         if not channel_events: return None, None, None
         event_id = max(channel_events.keys(), key=int)
         return event_id, active_events, channel_events[event_id]
 
+    async def _close_event(self, guild_id: int, event_id: str):
+        """募集中のイベントを一覧から外す（他のイベントへの同時の書き込みは残す）"""
+        await db.run(db.update, guilds.key("active_events", guild_id), lambda events: {sid: sdata for sid, sdata in events.items() if sid != event_id}, {})
+
     def _solve_assignment(self, participants: dict, priority_picks: dict) -> dict:
+        """
+        役割分担 { ロール: ユーザーID または None } と、その評価（埋まった枠の数・希望順位の合計）。
+        埋まる枠が最も多く、その中で希望ロール順の順位の合計が最も小さく、同点なら参加表明の早い人を選ぶ
+        """
+        sorted_participants = sorted(participants.items(), key=lambda item: item[1]['timestamp'])
+        return team_solver.solve_roles({user_id: data.get("roles", []) for user_id, data in sorted_participants}, ROLES, priority_picks)
+
+    def _solve_assignment_greedy(self, participants: dict, priority_picks: dict) -> dict:
+        """以前の割り当て方（参加表明の早い順に、空いている希望ロールに入れる）{ ロール: ユーザーID または None }。/event assign で結果を比べるために使う"""
         sorted_participants = sorted(participants.items(), key=lambda item: item[1]['timestamp'])
         assigned_users, assignments = set(), {role: None for role in ROLES}
         for role, user_id_str in priority_picks.items():
             if role in ROLES and user_id_str in participants and user_id_str not in assigned_users:
-                assignments[role] = participants[user_id_str]; assigned_users.add(user_id_str)
+                assignments[role] = user_id_str; assigned_users.add(user_id_str)
         for user_id, data in sorted_participants:
             if user_id in assigned_users: continue
             for role in data.get("roles", []):
                 if role in ROLES and assignments[role] is None:
-                    assignments[role] = data; assigned_users.add(user_id); break
+                    assignments[role] = user_id; assigned_users.add(user_id); break
         return assignments
 
     def format_assignment_embed(self, assignment_data: dict, event_summary: str) -> Embed:
@@ -337,119 +490,134 @@ class EventsCog(commands.Cog):
     @app_commands.checks.has_permissions(manage_events=True)
     async def event_assign(self, interaction: Interaction):
         await interaction.response.defer()
-        event_id, active_events, event_data = self._get_active_event(interaction)
+        event_id, active_events, event_data = await db.run(self._get_active_event, interaction)
         if not event_id: return await interaction.followup.send("このチャンネルに募集中のイベントはありません。", ephemeral=True)
         participants = {uid: pdata for uid, pdata in event_data.get("participants", {}).items() if pdata.get("status") in ["参加", "一時的に参加", "空いていれば参加"]}
         priority_picks = event_data.get("priority_picks", {})
-        assignments = self._solve_assignment(participants, priority_picks)
+        optimal = self._solve_assignment(participants, priority_picks)
+        assignments = {role: participants[user_id] if user_id else None for role, user_id in optimal["assignments"].items()}
+        # 以前の先着順の割り当てと比べた結果を、実行した人に報告する
+        greedy = team_solver.evaluate_roles(self._solve_assignment_greedy(participants, priority_picks), {user_id: data.get("roles", []) for user_id, data in participants.items()})
         embed = self.format_assignment_embed(assignments, event_data['summary'])
         msg = await interaction.channel.send(embed=embed, view=AssignmentResultView(assignment_id=event_id))
-        assignments_db_key = "active_assignments"; active_assignments = db.get(assignments_db_key, {})
-        active_assignments[event_id] = {"shifts": assignments, "message_id": msg.id, "summary": event_data['summary']}
-        db.set(assignments_db_key, active_assignments)
-        await interaction.followup.send("✅ 役割分担を発表しました。", ephemeral=True)
+        assignment_entry = {"shifts": assignments, "message_id": msg.id, "summary": event_data['summary']}
+        await db.run(db.update, guilds.key("active_assignments", interaction.guild_id), lambda active: {**active, event_id: assignment_entry}, {})
+        await interaction.followup.send(f"✅ 役割分担を発表しました。\n埋まった枠: {optimal['filled']}/{len(ROLES)}（先着順の場合: {greedy['filled']}/{len(ROLES)}）\n希望順位の合計: {optimal['cost']}（先着順の場合: {greedy['cost']}、第1希望 = 0）", ephemeral=True)
         try:
             original_msg = await interaction.channel.fetch_message(int(event_id))
             await original_msg.edit(content=f"~~**【{event_data.get('summary')}】は締め切られました**~~", embed=None, view=None)
         except: pass
-        del active_events[event_id]; db.set("active_events", active_events)
-
-    def _solve_strict_5v5(self, players: dict, priority_picks: dict) -> dict | None:
-        player_ids = list(players.keys())
-        if len(player_ids) < 10: return None
-        for _ in range(100):
-            assignments, available_roles, available_players = {}, set(ROLES), set(player_ids)
-            for role, user_id in priority_picks.items():
-                if role in available_roles and user_id in available_players:
-                    assignments[("red", role)] = user_id; available_roles.remove(role); available_players.remove(user_id)
-            shuffled_players = list(available_players); random.shuffle(shuffled_players)
-            slots_to_fill = [(team, role) for team in ["red", "blue"] for role in ROLES if (team, role) not in assignments]
-            def solve(p_pool, s_pool):
-                if not s_pool: return True
-                team, role = s_pool[0]
-                candidates = [pid for pid in p_pool if role in get_user_profile(int(pid)).get("role_priority",[])]
-                random.shuffle(candidates)
-                for candidate in candidates:
-                    assignments[(team, role)] = candidate
-                    if solve([p for p in p_pool if p != candidate], s_pool[1:]): return True
-                    del assignments[(team, role)]
-                return False
-            if solve(shuffled_players, slots_to_fill):
-                team_red = {r: p for t, r in assignments if t == "red" for p in [assignments[(t,r)]]}
-                team_blue = {r: p for t, r in assignments if t == "blue" for p in [assignments[(t,r)]]}
-                final_players_in_teams = set(team_red.values()) | set(team_blue.values())
-                subs = {pid: players[pid] for pid in player_ids if pid not in final_players_in_teams}
-                return {"teams": {"red": team_red, "blue": team_blue}, "subs": subs}
-        return None
-
-    @event.command(name="shuffle", description="募集を締め切り、5v5のチーム分けを実行します。")
+        await self._close_event(interaction.guild_id, event_id)
+
+    def _solve_matches(self, guild_id: int, players: dict, priority_picks: dict) -> dict | None:
+        """参加者をできるだけ多くの5v5に分ける。チームに入れなかった人は控え"""
+        if len(players) < TEAM_SIZE * 2: return None
+        profiles = get_user_profiles(guild_id, players.keys())
+        result = team_solver.solve_matches({pid: profiles[pid].get("role_priority", []) for pid in players}, ROLES, priority_picks, max_matches=MAX_SHUFFLE_MATCHES)
+        if not result: return None
+        # 試合ごとのチームを { "red": ..., "blue": ..., "red2": ..., "blue2": ... } にまとめる（1試合目は以前と同じキー）
+        teams = {f"{color}{index + 1 if index else ''}": team for index, match in enumerate(result["matches"]) for color, team in match.items()}
+        return {"teams": teams, "matches": len(result["matches"]), "subs": {pid: players[pid] for pid in result["subs"]}}
+
+    async def _provision_matches(self, guild: discord.Guild, category: discord.CategoryChannel, event_id: str, matches: int) -> tuple[dict, dict]:
+        """
+        試合ごとのチームのロールとVC、控えのロールをプールから借り（足りない分だけ作成し）、({チーム: Role, "sub": Role}, {チーム: VC}) を返す。
+        /event cleanup で event_id の分を返却する。
+        """
+        labels = {**team_labels(matches), shuffle_pool.SUB_TEAM: SUB_STYLE[0]}
+        colors = {team: TEAM_STYLES[team.rstrip("0123456789")][1] for team in team_labels(matches)}
+        colors[shuffle_pool.SUB_TEAM] = SUB_STYLE[1]
+        return await shuffle_pool.lease(guild, category, event_id, labels, colors, suffix=event_id[-4:])
+
+    @event.command(name="shuffle", description="募集を締め切り、参加人数に応じて1つ以上の5v5のチーム分けを実行します。")
     @app_commands.checks.has_permissions(manage_events=True)
     async def event_shuffle(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True)
-        event_id, active_events, event_data = self._get_active_event(interaction)
+        event_id, active_events, event_data = await db.run(self._get_active_event, interaction)
         if not event_id: return await interaction.followup.send("このチャンネルに募集中のイベントはありません。", ephemeral=True)
         participants = {uid: pdata for uid, pdata in event_data.get("participants", {}).items() if pdata.get("status") == "参加"}
-        if len(participants) < 10: return await interaction.followup.send(f"❌ 参加者が10人に満たないため、5v5チーム分けを中止しました。(現在{len(participants)}人)", ephemeral=True)
+        if len(participants) < TEAM_SIZE * 2: return await interaction.followup.send(f"❌ 参加者が10人に満たないため、5v5チーム分けを中止しました。(現在{len(participants)}人)", ephemeral=True)
         priority_picks = event_data.get("priority_picks", {})
-        result = self._solve_strict_5v5(participants, priority_picks)
+        result = await db.run(self._solve_matches, interaction.guild_id, participants, priority_picks)
         if not result: return await interaction.followup.send("❌ 参加者のロールの組み合わせでは、バランスの取れた5v5チームを作成できませんでした。", ephemeral=True)
         guild = interaction.guild
-        category = guild.get_channel(config.SHUFFLE_VC_CATEGORY_ID)
+        category = guild.get_channel(guilds.setting(guild.id, "shuffle_vc_category_id"))
         if not category or not isinstance(category, discord.CategoryChannel): return await interaction.followup.send("VC作成先のカテゴリが見つかりません。", ephemeral=True)
         try:
-            role_red = await guild.create_role(name=f"🔴 赤チーム({event_id[-4:]})", color=Color.red(), reason="チーム分け")
-            role_blue = await guild.create_role(name=f"🔵 青チーム({event_id[-4:]})", color=Color.blue(), reason="チーム分け")
-            role_sub = await guild.create_role(name=f"🟡 控え({event_id[-4:]})", color=Color.gold(), reason="チーム分け")
-            overwrites = {"red": {guild.default_role: PermissionOverwrite(connect=False), role_red: PermissionOverwrite(connect=True)}, "blue": {guild.default_role: PermissionOverwrite(connect=False), role_blue: PermissionOverwrite(connect=True)}}
-            vc_red, vc_blue = await category.create_voice_channel(name="🔴 赤チーム VC", overwrites=overwrites["red"]), await category.create_voice_channel(name="🔵 青チーム VC", overwrites=overwrites["blue"])
+            created_roles, created_vcs = await self._provision_matches(guild, category, event_id, result["matches"])
         except discord.Forbidden: return await interaction.followup.send("❌ ロールまたはVCの作成権限がありません。", ephemeral=True)
         async def assign_roles(team_data, role):
             for pid in team_data.values():
-                try: await guild.get_member(int(pid)).add_roles(role)
+                try: await (await member_cache.get_member(guild, pid)).add_roles(role)
                 except: print(f"Failed to assign role to {pid}")
-        await assign_roles(result["teams"]["red"], role_red); await assign_roles(result["teams"]["blue"], role_blue)
+        for team, team_data in result["teams"].items(): await assign_roles(team_data, created_roles[team])
         for pid in result["subs"].keys():
-            try: await guild.get_member(int(pid)).add_roles(role_sub)
+            try: await (await member_cache.get_member(guild, pid)).add_roles(created_roles["sub"])
             except: pass
         result_embed = Embed(title=f"【{event_data['summary']}】チーム分け結果発表！", color=Color.green())
         def format_team(team_data): return "\n".join([f"- {ROLES_EMOJI.get(role, '❔')} **{role.upper()}**: <@{pid}>" for role, pid in team_data.items()]) or "N/A"
-        result_embed.add_field(name="🔴 赤チーム", value=format_team(result["teams"]["red"]), inline=True)
-        result_embed.add_field(name="🔵 青チーム", value=format_team(result["teams"]["blue"]), inline=True)
-        result_embed.add_field(name="控えメンバー", value="\n".join([f"- <@{pid}>" for pid in result["subs"].keys()]) if result["subs"] else "なし", inline=False)
-        result_embed.add_field(name="専用VC", value=f"- 赤チーム: {vc_red.mention}\n- 青チーム: {vc_blue.mention}", inline=False)
+        labels = team_labels(result["matches"])
+        for team, team_data in result["teams"].items():
+            result_embed.add_field(name=labels[team], value=format_team(team_data), inline=True)
+        result_embed.add_field(name="控えメンバー", value="\n".join([f"- <@{pid}>" for pid in result["subs"].keys()])[:FIELD_VALUE_LIMIT] if result["subs"] else "なし", inline=False)
+        result_embed.add_field(name="専用VC", value="\n".join(f"- {labels[team]}: {vc.mention}" for team, vc in created_vcs.items()), inline=False)
         result_msg = await interaction.channel.send(embed=result_embed)
-        completed_shuffles = db.get("completed_shuffles", {}); completed_shuffle_id = str(result_msg.id)
-        completed_shuffles[completed_shuffle_id] = {"teams": result, "created_roles": {"red": role_red.id, "blue": role_blue.id, "sub": role_sub.id}, "created_vcs": {"red": vc_red.id, "blue": vc_blue.id}}
-        db.set("completed_shuffles", completed_shuffles)
+        completed_shuffle_id = str(result_msg.id)
+        shuffle_entry = {"teams": result, "pool_lease": event_id, "created_roles": {name: role.id for name, role in created_roles.items()}, "created_vcs": {name: vc.id for name, vc in created_vcs.items()}}
+        await db.run(db.update, guilds.key("completed_shuffles", interaction.guild_id), lambda shuffles: {**shuffles, completed_shuffle_id: shuffle_entry}, {})
         await result_msg.edit(view=ShuffleResultView(shuffle_id=completed_shuffle_id))
         try:
             original_msg = await interaction.channel.fetch_message(int(event_id))
             await original_msg.edit(content=f"~~**【{event_data.get('summary')}】は締め切られました**~~", embed=None, view=None)
         except: pass
-        del active_events[event_id]; db.set("active_events", active_events)
-        await interaction.followup.send("✅ チーム分けが完了しました！", ephemeral=True)
+        await self._close_event(interaction.guild_id, event_id)
+        await interaction.followup.send(f"✅ チーム分けが完了しました！（{result['matches']}試合）", ephemeral=True)
 
-    @event.command(name="cleanup", description="Botが作成した一時的なVCとロールを全て削除します。")
+    @event.command(name="cleanup", description="チーム分けのロールとVCを返却します（purge で使っていない分を削除）。")
     @app_commands.checks.has_permissions(manage_guild=True)
-    async def event_cleanup(self, interaction: Interaction):
+    @app_commands.describe(purge="使っていないプールのロールとVCも削除する")
+    async def event_cleanup(self, interaction: Interaction, purge: bool = False):
         await interaction.response.defer(ephemeral=True)
-        completed_shuffles = db.get("completed_shuffles", {})
-        if not completed_shuffles: return await interaction.followup.send("クリーンアップ対象はありません。", ephemeral=True)
-        deleted_roles, deleted_vcs, errors = 0, 0, 0
-        for shuffle_id in list(completed_shuffles.keys()):
-            s_data = completed_shuffles.pop(shuffle_id)
+        completed_shuffles = await db.run(db.get, guilds.key("completed_shuffles", interaction.guild_id), {})
+        if not completed_shuffles and not purge: return await interaction.followup.send("クリーンアップ対象はありません。", ephemeral=True)
+        released, deleted_roles, deleted_vcs, errors = 0, 0, 0, 0
+        # 返却・削除を最後まで終えたチーム分けだけを記録から外す（失敗したものは次回のクリーンアップでやり直す）
+        cleaned = set()
+        for shuffle_id, s_data in completed_shuffles.items():
+            # プールから借りたロール・VCは削除せずに返却する（次のチーム分けで使い回す）
+            if s_data.get("pool_lease"):
+                try:
+                    # ロールを付与したメンバー（チームの全員と控え）だけからロールを外す（全メンバーを調べない）
+                    teams = s_data.get("teams", {})
+                    member_ids = [pid for team_data in teams.get("teams", {}).values() for pid in team_data.values()] + list(teams.get("subs", {}))
+                    released += await shuffle_pool.release(interaction.guild, s_data["pool_lease"], member_ids)
+                    cleaned.add(shuffle_id)
+                except Exception as e: errors += 1; print(f"ERROR: チーム分けのプールの返却に失敗しました: {e}")
+                continue
+            # プール導入前のチーム分けは、以前どおり削除する
+            failed = False
             for role_id in s_data.get("created_roles", {}).values():
                 try:
                     role = interaction.guild.get_role(role_id)
                     if role: await role.delete(reason="シャッフルクリーンアップ"); deleted_roles += 1
-                except: errors += 1
+                except: errors += 1; failed = True
             for vc_id in s_data.get("created_vcs", {}).values():
                 try:
                     vc = interaction.guild.get_channel(vc_id)
                     if vc: await vc.delete(reason="シャッフルクリーンアップ"); deleted_vcs += 1
-                except: errors += 1
-        db.set("completed_shuffles", completed_shuffles)
-        await interaction.followup.send(f"✅ クリーンアップ完了\n- 削除したロール: {deleted_roles}個\n- 削除したVC: {deleted_vcs}個", ephemeral=True)
+                except: errors += 1; failed = True
+            if not failed: cleaned.add(shuffle_id)
+        # 片付けている間に追加されたチーム分けは残す
+        if cleaned:
+            await db.run(db.update, guilds.key("completed_shuffles", interaction.guild_id), lambda shuffles: {sid: sdata for sid, sdata in shuffles.items() if sid not in cleaned}, {})
+        if purge:
+            try:
+                purged_roles, purged_vcs = await shuffle_pool.purge(interaction.guild)
+                deleted_roles += purged_roles; deleted_vcs += purged_vcs
+            except Exception as e: errors += 1; print(f"ERROR: チーム分けのプールの削除に失敗しました: {e}")
+        lines = [f"- 返却したロール・VC: {released}組", f"- 削除したロール: {deleted_roles}個", f"- 削除したVC: {deleted_vcs}個"]
+        if errors: lines.append(f"- 失敗: {errors}件（次回のクリーンアップで再試行します）")
+        await interaction.followup.send("✅ クリーンアップ完了\n" + "\n".join(lines), ephemeral=True)
 
     @event.command(name="priority_pick", description="このイベントで特定のロールを優先的に担当する人を指定します。")
     @app_commands.checks.has_permissions(manage_events=True)
@@ -457,21 +625,29 @@ class EventsCog(commands.Cog):
     @app_commands.choices(role=[app_commands.Choice(name=r.upper(), value=r) for r in ROLES])
     async def event_priority_pick(self, interaction: Interaction, role: str, user: Member):
         await interaction.response.defer(ephemeral=True)
-        event_id, active_events, event_data = self._get_active_event(interaction)
+        event_id, active_events, event_data = await db.run(self._get_active_event, interaction)
         if not event_id: return await interaction.followup.send("このチャンネルに募集中のイベントはありません。", ephemeral=True)
-        event_data.setdefault("priority_picks", {})[role] = str(user.id)
-        db.set("active_events", active_events)
+        def apply(events):
+            if event_id in events: events[event_id].setdefault("priority_picks", {})[role] = str(user.id)
+        await db.run(db.update, guilds.key("active_events", interaction.guild_id), apply, {})
         await interaction.followup.send(f"✅ {user.mention}さんを **{role.upper()}** の優先プレイヤーに設定しました。", ephemeral=True)
 
 # --- セットアップ関数 ---
 async def setup(bot: commands.Bot):
     await bot.add_cog(EventsCog(bot))
-    active_events = db.get("active_events", {})
-    if isinstance(active_events, dict):
-        for event_id in active_events.keys(): bot.add_view(EventView(event_id=event_id))
-    completed_shuffles = db.get("completed_shuffles", {})
-    if isinstance(completed_shuffles, dict):
-        for shuffle_id in completed_shuffles.keys(): bot.add_view(ShuffleResultView(shuffle_id=shuffle_id))
-    active_assignments = db.get("active_assignments", {})
-    if isinstance(active_assignments, dict):
-        for assign_id in active_assignments.keys(): bot.add_view(AssignmentResultView(assignment_id=assign_id))
\ No newline at end of file
+    # 永続Viewの復元に必要なデータは全ギルド分をまとめて読み、その間は他のCogの読み込みを進める
+    try:
+        stored = await db.run(_load_persistent_view_ids)
+    except DatabaseUnavailableError as e:
+        # Cog自体は読み込み、以前のパネルのボタンは次回の起動時に復元する
+        return print(f"⚠️ 永続Viewの復元に失敗しました: {e}")
+    for event_id in stored["active_events"]: bot.add_view(EventView(event_id=event_id))
+    for shuffle_id in stored["completed_shuffles"]: bot.add_view(ShuffleResultView(shuffle_id=shuffle_id))
+    for assign_id in stored["active_assignments"]: bot.add_view(AssignmentResultView(assignment_id=assign_id))
+
+def _load_persistent_view_ids() -> dict:
+    """全ギルドの募集中イベント・チーム分け・役割分担のIDを { 名前: [ID, ...] } で返す"""
+    stored = {}
+    for name in ("active_events", "completed_shuffles", "active_assignments"):
+        stored[name] = [item_id for _, items in db.scan(f"{name}_") if isinstance(items, dict) for item_id in items]
+    return stored
@@ -2,13 +2,28 @@ import discord
 from discord import app_commands, Embed
 from discord.ext import commands
 
+# オートコンプリートで返せる候補の上限（Discordの制限）
+MAX_CHOICES = 25
+
 class HelpCog(commands.Cog):
     """
     ボットのヘルプコマンドを管理する機能。
     他のCogに特定の変数を定義することで、動的にヘルプを生成する。
+    ヘルプの内容（Embed）とオートコンプリートの候補は、Cogの読み込み・取り外しのたびに作り直して保持する。
     """
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # { カテゴリ名: {"description": 説明, "cogs": [Cog], "command_count": コマンド数, "embed": Embed} }
+        self.categories = {}
+        self.overview_embed = None
+        # オートコンプリートの索引 { 入力（小文字）: [Choice] }。カテゴリ名の部分文字列ごとに、名前順の候補を持つ
+        self.autocomplete_index = {}
+        self.rebuild_index()
+
+    @commands.Cog.listener()
+    async def on_cogs_changed(self):
+        """Cog（拡張機能）の読み込み・取り外しのたびに main.py から呼ばれる（このCogより後に読み込まれたCogもここで反映する）"""
+        self.rebuild_index()
 
     def get_all_categories(self) -> dict:
         """ボットにロードされている全てのCogからカテゴリ情報を取得・整理する"""
@@ -24,54 +39,43 @@ class HelpCog(commands.Cog):
                 categories[cat]["cogs"].append(cog)
         return categories
 
-    async def help_category_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-        """ヘルプカテゴリのオートコンプリート候補を生成する"""
+    def rebuild_index(self):
+        """カテゴリごとのコマンド数・Embedと、オートコンプリートの索引を作り直す"""
         categories = self.get_all_categories()
-        choices = [
-            app_commands.Choice(name=f"【{cat}】", value=cat)
-            for cat in sorted(list(categories.keys()))
-            if current.lower() in cat.lower()
-        ]
-        return choices[:25]
+        for cat, data in categories.items():
+            data["command_count"] = sum(len(cog.get_app_commands()) for cog in data["cogs"])
+            data["embed"] = self._build_category_embed(cat, data)
+        self.categories = categories
+        self.overview_embed = self._build_overview_embed(categories)
 
-    @app_commands.command(name="help", description="ボットのコマンドヘルプを表示します。")
-    @app_commands.describe(category="詳細を見たいカテゴリを選択してください。")
-    @app_commands.autocomplete(category=help_category_autocomplete)
-    async def help(self, interaction: discord.Interaction, category: str = None):
-        """
-        カテゴリ指定なし: カテゴリ一覧を表示
-        カテゴリ指定あり: カテゴリ内のコマンド一覧を表示
-        """
-        all_categories = self.get_all_categories()
-
-        # カテゴリが指定されていない場合、一覧を表示
-        if not category:
-            embed = Embed(
-                title="📜 コマンドヘルプ",
-                description="見たいカテゴリを引数で選択（入力時に候補が出ます）してください。",
-                color=discord.Color.blurple()
-            )
-            if not all_categories:
-                embed.add_field(name="コマンドなし", value="現在表示できるコマンドはありません。")
-            else:
-                for cat, data in sorted(all_categories.items()):
-                    command_count = 0
-                    for cog in data["cogs"]:
-                        command_count += len(cog.get_app_commands())
-
-                    embed.add_field(
-                        name=f"【{cat}】 ({command_count} コマンド)",
-                        value=data["description"],
-                        inline=False
-                    )
-            await interaction.response.send_message(embed=embed, ephemeral=True)
-            return
+        index = {}
+        for cat in sorted(categories):
+            choice = app_commands.Choice(name=f"【{cat}】", value=cat)
+            lowered = cat.lower()
+            substrings = {lowered[start:end] for start in range(len(lowered)) for end in range(start + 1, len(lowered) + 1)}
+            for substring in substrings | {""}:
+                choices = index.setdefault(substring, [])
+                if len(choices) < MAX_CHOICES: choices.append(choice)
+        self.autocomplete_index = index
 
-        # カテゴリが指定されている場合
-        if category not in all_categories:
-            return await interaction.response.send_message(f"❌ カテゴリ「{category}」は見つかりませんでした。", ephemeral=True)
+    def _build_overview_embed(self, categories: dict) -> Embed:
+        embed = Embed(
+            title="📜 コマンドヘルプ",
+            description="見たいカテゴリを引数で選択（入力時に候補が出ます）してください。",
+            color=discord.Color.blurple()
+        )
+        if not categories:
+            embed.add_field(name="コマンドなし", value="現在表示できるコマンドはありません。")
+        else:
+            for cat, data in sorted(categories.items()):
+                embed.add_field(
+                    name=f"【{cat}】 ({data['command_count']} コマンド)",
+                    value=data["description"],
+                    inline=False
+                )
+        return embed
 
-        data = all_categories[category]
+    def _build_category_embed(self, category: str, data: dict) -> Embed:
         embed = Embed(
             title=f"【{category}】のコマンド一覧",
             description=data["description"],
@@ -91,8 +95,28 @@ class HelpCog(commands.Cog):
                 elif isinstance(cmd, app_commands.Command):
                     desc = command_helps.get(cmd.name, cmd.description or "説明がありません。")
                     embed.add_field(name=f"`/{cmd.name}`", value=desc, inline=False)
+        return embed
 
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+    async def help_category_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        """ヘルプカテゴリのオートコンプリート候補を返す（入力をキーに索引を引くだけ）"""
+        return self.autocomplete_index.get(current.lower(), [])
+
+    @app_commands.command(name="help", description="ボットのコマンドヘルプを表示します。")
+    @app_commands.describe(category="詳細を見たいカテゴリを選択してください。")
+    @app_commands.autocomplete(category=help_category_autocomplete)
+    async def help(self, interaction: discord.Interaction, category: str = None):
+        """
+        カテゴリ指定なし: カテゴリ一覧を表示
+        カテゴリ指定あり: カテゴリ内のコマンド一覧を表示
+        """
+        # カテゴリが指定されていない場合、一覧を表示
+        if not category:
+            return await interaction.response.send_message(embed=self.overview_embed, ephemeral=True)
+
+        # カテゴリが指定されている場合
+        if category not in self.categories:
+            return await interaction.response.send_message(f"❌ カテゴリ「{category}」は見つかりませんでした。", ephemeral=True)
+        await interaction.response.send_message(embed=self.categories[category]["embed"], ephemeral=True)
 
 async def setup(bot: commands.Bot):
-    await bot.add_cog(HelpCog(bot))
\ No newline at end of file
+    await bot.add_cog(HelpCog(bot))
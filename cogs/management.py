@@ -1,8 +1,10 @@
 import discord
 from discord import app_commands, ui, ButtonStyle, ChannelType, Embed, Color, Interaction, Member
 from discord.ext import commands, tasks
-from db_handler import db
-import config
+from db_handler import db, DatabaseUnavailableError
+import metrics
+import guilds
+import member_cache
 from datetime import datetime, timezone, timedelta
 import asyncio
 
@@ -32,7 +34,7 @@ class ClanJoinView(discord.ui.View):
     async def join_clan_button(self, interaction: Interaction, button: ui.Button):
         await interaction.response.defer(ephemeral=True)
         member = interaction.user
-        role = interaction.guild.get_role(config.CLAN_MEMBER_ROLE_ID)
+        role = guilds.role(interaction.guild, "clan_member_role_id")
         if not role:
             return await interaction.followup.send("⚠ 「クランメンバー」ロールが見つかりません。", ephemeral=True)
 
@@ -69,19 +71,25 @@ class ManagementCog(commands.Cog):
     def cog_unload(self):
         self.trial_reminder_task.cancel()
 
-    def get_guild_data(self, guild_id: int) -> dict:
-        """このCogで使うギルドごとのデータを取得・初期化する"""
-        key = f"management_{guild_id}"
+    @staticmethod
+    def _fill_defaults(guild_data: dict) -> dict:
         defaults = {"results": {}, "templates": {"合格": [], "不合格": []}, "selected_templates": {"合格": 0, "不合格": 0}, "is_lazy_join_enabled": True}
-        guild_data = db.get(key, {})
         for k, v in defaults.items():
             guild_data.setdefault(k, v)
         return guild_data
 
-    def save_guild_data(self, guild_id: int, data: dict):
-        """このCogで使うギルドごとのデータを保存する"""
-        key = f"management_{guild_id}"
-        db.set(key, data)
+    def get_guild_data(self, guild_id: int) -> dict:
+        """このCogで使うギルドごとのデータを取得・初期化する"""
+        return self._fill_defaults(db.get(f"management_{guild_id}", {}))
+
+    async def update_guild_data(self, guild_id: int, mutator) -> dict:
+        """
+        ギルドごとのデータを mutator で書き換えて保存し、保存後のデータを返す。
+        他の管理者の操作と同時に実行された場合は、最新のデータで mutator をやり直す（どちらの変更も失われない）。
+        """
+        def apply(guild_data):
+            mutator(self._fill_defaults(guild_data))
+        return await db.run(db.update, f"management_{guild_id}", apply, {})
 
     @commands.Cog.listener()
     async def on_interaction(self, interaction: discord.Interaction):
@@ -101,12 +109,12 @@ class ManagementCog(commands.Cog):
     async def handle_trial_join(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True, thinking=True)
         member = interaction.user
-        trial_role = interaction.guild.get_role(config.TRIAL_ROLE_ID)
-        trial_key = f"trial_{member.id}"
+        trial_role = guilds.role(interaction.guild, "trial_role_id")
+        trial_key = guilds.key("trial", interaction.guild_id, member.id)
 
         # ★★★ 修正点1: チェックを最初に行う ★★★
         # DBに記録があるか、または既にロールを持っているかを確認
-        if db.get(trial_key) is not None or (trial_role and trial_role in member.roles):
+        if (await db.run(db.get, trial_key)) is not None or (trial_role and trial_role in member.roles):
             return await interaction.followup.send("あなたは既に体験フローに参加中です。", ephemeral=True)
 
         # --- ここから先は、新規参加者として処理 ---
@@ -114,16 +122,16 @@ class ManagementCog(commands.Cog):
         # ★★★ 修正点2: エラーハンドリングを強化 ★★★
         try:
             # ロール付与処理
-            non_trial_role = interaction.guild.get_role(config.NON_TRIAL_ROLE_ID)
+            non_trial_role = guilds.role(interaction.guild, "non_trial_role_id")
             if not trial_role:
-                return await interaction.followup.send("⚠ `TRIAL_ROLE_ID`が正しく設定されていません。", ephemeral=True)
+                return await interaction.followup.send("⚠ 体験メンバーのロールが正しく設定されていません。`/config role` で `trial_role_id` を設定してください。", ephemeral=True)
 
             await member.add_roles(trial_role, reason="体験加入")
             if non_trial_role and non_trial_role in member.roles:
                 await member.remove_roles(non_trial_role, reason="体験加入への切り替え")
 
             # DB記録処理
-            db.set(trial_key, {
+            await db.run(db.set, trial_key, {
                 "name": member.display_name,
                 "join_timestamp": datetime.now(timezone.utc).isoformat(),
                 "notified_day_1": False,
@@ -152,9 +160,9 @@ class ManagementCog(commands.Cog):
         """「助っ人として参加」ボタンの処理"""
         await interaction.response.defer(ephemeral=True, thinking=True)
         member = interaction.user
-        helper_role = interaction.guild.get_role(config.NON_TRIAL_ROLE_ID)
-        trial_role = interaction.guild.get_role(config.TRIAL_ROLE_ID)
-        if not helper_role: return await interaction.followup.send("⚠ `NON_TRIAL_ROLE_ID`が正しく設定されていません。", ephemeral=True)
+        helper_role = guilds.role(interaction.guild, "non_trial_role_id")
+        trial_role = guilds.role(interaction.guild, "trial_role_id")
+        if not helper_role: return await interaction.followup.send("⚠ 助っ人のロールが正しく設定されていません。`/config role` で `non_trial_role_id` を設定してください。", ephemeral=True)
 
         try:
             await member.add_roles(helper_role)
@@ -165,10 +173,10 @@ class ManagementCog(commands.Cog):
 
     async def create_evaluation_thread(self, member: discord.Member, guild: discord.Guild):
         """裏側で評価用スレッドを作成する"""
-        eval_channel = guild.get_channel(config.EVALUATION_CHANNEL_ID)
+        eval_channel = guilds.channel(guild, "evaluation_channel_id")
         if not isinstance(eval_channel, discord.TextChannel): return
 
-        staff_role = guild.get_role(config.STAFF_ROLE_ID)
+        staff_role = guilds.role(guild, "staff_role_id")
         try:
             thread = await eval_channel.create_thread(name=f"【体験】{member.display_name}さんの選考", type=ChannelType.private_thread)
             await thread.send(content=f"{staff_role.mention if staff_role else ''} {member.display_name}さんの体験加入が開始されました。", view=EvaluationDecisionView())
@@ -181,25 +189,25 @@ class ManagementCog(commands.Cog):
         if not isinstance(interaction.channel, discord.Thread): return
 
         member_name = interaction.channel.name.replace("【体験】", "").replace("さんの選考", "")
-        member = discord.utils.get(interaction.guild.members, display_name=member_name)
+        member = await member_cache.find_by_display_name(interaction.guild, member_name)
         if not member: return await interaction.followup.send(f"対象ユーザー「{member_name}」が見つかりません。", ephemeral=True)
 
         result_map = {"persistent_trial_pass": "合格", "persistent_trial_fail": "不合格"}
         result = result_map.get(interaction.data["custom_id"])
         if not result: return await interaction.followup.send("この選考を「保留」としてマークしました。", ephemeral=True)
 
-        trial_role = interaction.guild.get_role(config.TRIAL_ROLE_ID)
-        full_role = interaction.guild.get_role(config.CLAN_MEMBER_ROLE_ID)
-        post_trial_role = config.POST_TRIAL_ROLE_ID and interaction.guild.get_role(config.POST_TRIAL_ROLE_ID)
+        trial_role = guilds.role(interaction.guild, "trial_role_id")
+        full_role = guilds.role(interaction.guild, "clan_member_role_id")
+        post_trial_role = guilds.role(interaction.guild, "post_trial_role_id")
 
-        db.delete(f"trial_{member.id}")
+        await db.run(db.delete, guilds.key("trial", interaction.guild_id, member.id))
 
         try:
             if trial_role and trial_role in member.roles: await member.remove_roles(trial_role)
 
             if result == "合格":
                 if full_role: await member.add_roles(full_role)
-                result_channel = interaction.guild.get_channel(config.RESULT_CHANNEL_ID)
+                result_channel = guilds.channel(interaction.guild, "result_channel_id")
                 if isinstance(result_channel, discord.TextChannel):
                     res_thread = await result_channel.create_thread(name=f"🎉{member.display_name}さん、ようこそ！")
                     await res_thread.send(f"{member.mention} さん、体験お疲れ様でした！\n\n**【選考結果：合格】**\n\n本日より、正式にクランメンバーとなりました！", view=ClanJoinView())
@@ -232,20 +240,18 @@ class ManagementCog(commands.Cog):
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.choices(result=[app_commands.Choice(name="合格", value="合格"), app_commands.Choice(name="不合格", value="不合格")])
     async def result_add(self, interaction: Interaction, user: Member, result: str):
-        guild_data = self.get_guild_data(interaction.guild_id)
-        guild_data["results"][str(user.id)] = result
-        self.save_guild_data(interaction.guild_id, guild_data)
+        await self.update_guild_data(interaction.guild_id, lambda guild_data: guild_data["results"].update({str(user.id): result}))
         await interaction.response.send_message(f"✅ {user.display_name}さんの結果を「{result}」に設定しました。", ephemeral=True)
 
     @result_group.command(name="list", description="現在の選考結果を一覧表示します。")
     @app_commands.checks.has_permissions(administrator=True)
     async def result_list(self, interaction: Interaction):
-        guild_data = self.get_guild_data(interaction.guild_id)
+        guild_data = await db.run(self.get_guild_data, interaction.guild_id)
         results = guild_data["results"]
         if not results: return await interaction.response.send_message("📭 現在登録されている結果はありません。", ephemeral=True)
         message = "🗂 **登録済みの選考結果一覧**\n"
         for user_id, result in results.items():
-            member = interaction.guild.get_member(int(user_id))
+            member = await member_cache.get_member(interaction.guild, user_id)
             display_name = member.display_name if member else f"ID: {user_id}"
             message += f"- {display_name}：**{result}**\n"
         await interaction.response.send_message(content=message, ephemeral=True)
@@ -254,16 +260,16 @@ class ManagementCog(commands.Cog):
     @app_commands.checks.has_permissions(administrator=True)
     async def result_send(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True, thinking=True)
-        guild_data = self.get_guild_data(interaction.guild_id)
+        guild_data = await db.run(self.get_guild_data, interaction.guild_id)
         results = guild_data["results"]
         if not results: return await interaction.followup.send("📭 送信する結果が登録されていません。", ephemeral=True)
 
-        channel = interaction.guild.get_channel(config.RESULT_CHANNEL_ID)
+        channel = guilds.channel(interaction.guild, "result_channel_id")
         if not isinstance(channel, discord.TextChannel): return await interaction.followup.send("⚠ 結果発表用チャンネルが見つかりません。")
 
         success, fail = 0, 0
         for user_id, result in list(results.items()):
-            member = interaction.guild.get_member(int(user_id))
+            member = await member_cache.get_member(interaction.guild, user_id)
             if not member:
                 fail += 1; continue
             try:
@@ -282,23 +288,24 @@ class ManagementCog(commands.Cog):
                 fail += 1
 
         await interaction.followup.send(f"✅ 全ての選考結果の送信処理が完了しました。\n成功: {success}件, 失敗: {fail}件")
-        guild_data["results"].clear()
-        self.save_guild_data(interaction.guild_id, guild_data)
+        # 送信中に登録・変更された結果は次回の送信用に残す
+        def clear_sent(latest):
+            for user_id, result in results.items():
+                if latest["results"].get(user_id) == result: del latest["results"][user_id]
+        await self.update_guild_data(interaction.guild_id, clear_sent)
 
     @template_group.command(name="add", description="通知用のメッセージテンプレートを追加します。")
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.choices(result_type=[app_commands.Choice(name="合格", value="合格"), app_commands.Choice(name="不合格", value="不合格")])
     async def template_add(self, interaction: Interaction, result_type: str, message: str):
-        guild_data = self.get_guild_data(interaction.guild_id)
-        guild_data["templates"][result_type].append(message)
-        self.save_guild_data(interaction.guild_id, guild_data)
+        guild_data = await self.update_guild_data(interaction.guild_id, lambda guild_data: guild_data["templates"][result_type].append(message))
         index = len(guild_data['templates'][result_type]) - 1
         await interaction.response.send_message(f"✅ テンプレートを【{result_type}】に追加しました。(番号: {index})", ephemeral=True)
 
     @template_group.command(name="list", description="登録されているメッセージテンプレートを一覧表示します。")
     @app_commands.checks.has_permissions(administrator=True)
     async def template_list(self, interaction: Interaction):
-        guild_data = self.get_guild_data(interaction.guild_id)
+        guild_data = await db.run(self.get_guild_data, interaction.guild_id)
         embed = Embed(title="登録済みテンプレート一覧", color=Color.green())
         for result_type, template_list in guild_data["templates"].items():
             value = "\n".join(f"`{i}`: {template}" for i, template in enumerate(template_list)) if template_list else "登録されていません。"
@@ -309,31 +316,37 @@ class ManagementCog(commands.Cog):
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.choices(result_type=[app_commands.Choice(name="合格", value="合格"), app_commands.Choice(name="不合格", value="不合格")])
     async def template_set(self, interaction: Interaction, result_type: str, index: int):
-        guild_data = self.get_guild_data(interaction.guild_id)
-        if not (0 <= index < len(guild_data["templates"][result_type])):
+        found = False
+        def select(guild_data):
+            nonlocal found
+            found = 0 <= index < len(guild_data["templates"][result_type])
+            if found: guild_data["selected_templates"][result_type] = index
+        await self.update_guild_data(interaction.guild_id, select)
+        if not found:
             return await interaction.response.send_message("❌ 指定されたテンプレートが見つかりません。", ephemeral=True)
-        guild_data["selected_templates"][result_type] = index
-        self.save_guild_data(interaction.guild_id, guild_data)
         await interaction.response.send_message(f"✅ {result_type}のテンプレートを [{index}] に設定しました。", ephemeral=True)
 
     @template_group.command(name="delete", description="指定した番号のメッセージテンプレートを削除します。")
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.choices(result_type=[app_commands.Choice(name="合格", value="合格"), app_commands.Choice(name="不合格", value="不合格")])
     async def template_delete(self, interaction: Interaction, result_type: str, index: int):
-        guild_data = self.get_guild_data(interaction.guild_id)
-        templates = guild_data["templates"][result_type]
-        if not (0 <= index < len(templates)):
+        found = False
+        def remove(guild_data):
+            nonlocal found
+            templates = guild_data["templates"][result_type]
+            found = 0 <= index < len(templates)
+            if found: templates.pop(index)
+        await self.update_guild_data(interaction.guild_id, remove)
+        if not found:
             return await interaction.response.send_message(f"❌ 番号 `{index}` のテンプレートは見つかりません。", ephemeral=True)
-        templates.pop(index)
-        self.save_guild_data(interaction.guild_id, guild_data)
         await interaction.response.send_message(f"✅ 【{result_type}】 のテンプレート `{index}` を削除しました。", ephemeral=True)
 
     @lazy_group.command(name="join", description="lazy lifeロールを自分に付与します")
     async def lazy_join(self, interaction: Interaction):
-        guild_data = self.get_guild_data(interaction.guild_id)
+        guild_data = await db.run(self.get_guild_data, interaction.guild_id)
         if not guild_data.get("is_lazy_join_enabled", True):
             return await interaction.response.send_message("❌ このコマンドは現在、管理者によって無効化されています。", ephemeral=True)
-        role = interaction.guild.get_role(config.LAZY_LIFE_ROLE_ID)
+        role = guilds.role(interaction.guild, "lazy_life_role_id")
         if not role: return await interaction.response.send_message("❌ 'lazy life' ロールが見つかりません。", ephemeral=True)
         if role in interaction.user.roles: return await interaction.response.send_message("あなたはすでに 'lazy life' ロールを持っています。", ephemeral=True)
         try:
@@ -345,32 +358,45 @@ class ManagementCog(commands.Cog):
     @lazy_group.command(name="toggle", description="（管理者用）lazy joinコマンドの有効/無効を切り替えます")
     @app_commands.checks.has_permissions(administrator=True)
     async def lazy_toggle(self, interaction: Interaction, enabled: bool):
-        guild_data = self.get_guild_data(interaction.guild_id)
-        guild_data["is_lazy_join_enabled"] = enabled
-        self.save_guild_data(interaction.guild_id, guild_data)
+        await self.update_guild_data(interaction.guild_id, lambda guild_data: guild_data.update(is_lazy_join_enabled=enabled))
         status = "有効" if enabled else "無効"
         await interaction.response.send_message(f"✅ `/lazy join` コマンドを **{status}** に設定しました。", ephemeral=True)
 
     @tasks.loop(hours=12.0)
+    @metrics.timed_task("trial_reminder_task")
     async def trial_reminder_task(self):
         await self.bot.wait_until_ready()
+        # このプロセスが受け持つギルドごとに、そのギルドの体験メンバーだけを確認する
+        for guild in self.bot.guilds:
+            report_channel = guilds.channel(guild, "report_channel_id")
+            if not report_channel: continue
+            # 体験メンバーの一覧を読めなかったギルドは、次回（12時間後）に確認する
+            try: await self._remind_trials(guild, report_channel)
+            except DatabaseUnavailableError as e: print(f"ERROR: {guild.name}: 体験メンバーの確認に失敗しました: {e}")
+
+    async def _remind_trials(self, guild: discord.Guild, report_channel):
         now = datetime.now(timezone.utc)
-        all_data = db.all()
-        guild = self.bot.get_guild(config.GUILD_ID)
-        if not guild or not config.REPORT_CHANNEL_ID: return
-        report_channel = guild.get_channel(config.REPORT_CHANNEL_ID)
-        if not report_channel: return
-        for key, data in all_data.items():
-            if key.startswith("trial_") and isinstance(data, dict):
-                join_dt = datetime.fromisoformat(data.get("join_timestamp", now.isoformat()))
-                days_passed = (now - join_dt).days
-                member_id = int(key.split('_')[1])
-                if days_passed >= 1 and not data.get("notified_day_1"):
-                    await report_channel.send(f"【🔔 体験1日経過】<@{member_id}> さんが参加してから1日が経過しました。")
-                    data["notified_day_1"] = True; db.set(key, data)
-                if days_passed >= 3 and not data.get("notified_day_3"):
-                    await report_channel.send(f"【📝 体験3日経過】<@{member_id}> さんが参加してから3日が経過しました。")
-                    data["notified_day_3"] = True; db.set(key, data)
+        # 送信を待つ間にカーソルを開いたままにしない（イベントループも止めない）よう、先に体験メンバーの一覧を読み切る
+        trials = await db.run(lambda: list(db.scan(guilds.key("trial", guild.id, ""))))
+        # 通知済みフラグの更新は最後にまとめて書き込む（途中で送信に失敗しても、送信済みの分は記録する）
+        notified = {}
+        try:
+            for key, data in trials:
+                if isinstance(data, dict):
+                    join_dt = datetime.fromisoformat(data.get("join_timestamp", now.isoformat()))
+                    days_passed = (now - join_dt).days
+                    member_id = int(key.rsplit('_', 1)[1])
+                    if days_passed >= 1 and not data.get("notified_day_1"):
+                        await report_channel.send(f"【🔔 体験1日経過】<@{member_id}> さんが参加してから1日が経過しました。")
+                        notified.setdefault(key, {})["notified_day_1"] = True
+                    if days_passed >= 3 and not data.get("notified_day_3"):
+                        await report_channel.send(f"【📝 体験3日経過】<@{member_id}> さんが参加してから3日が経過しました。")
+                        notified.setdefault(key, {})["notified_day_3"] = True
+        finally:
+            # 通知済みフラグだけを1回のバルク書き込みで反映する。送信を待っている間に体験メンバーの記録が
+            # 削除・変更されている場合があるため、記録全体は書き戻さず、削除済みのキーは作り直さない（patch）
+            if notified:
+                await db.run(db.bulk_write, [("patch", key, flags) for key, flags in notified.items()])
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(ManagementCog(bot))
\ No newline at end of file
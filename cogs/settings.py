@@ -0,0 +1,72 @@
+import discord
+from discord import app_commands, Embed, Color, Interaction
+from discord.ext import commands
+import guilds
+
+def _setting_choices(kind: str) -> list[app_commands.Choice[str]]:
+    return [app_commands.Choice(name=f"{name}（{description}）", value=name) for name, (_, setting_kind, description) in guilds.SETTINGS.items() if setting_kind == kind]
+
+class SettingsCog(commands.Cog):
+    """サーバーごとのチャンネル・ロールの設定を管理する機能"""
+    help_category = "サーバー設定"
+    help_description = "このサーバーでボットが使うチャンネルやロールを設定します。"
+    command_helps = {
+        "config show": "（管理者用）現在の設定を一覧表示します。",
+        "config channel": "（管理者用）ボットが使うチャンネルを設定します。",
+        "config role": "（管理者用）ボットが使うロールを設定します。",
+        "config category": "（管理者用）チーム分けのVCを作成するカテゴリを設定します。",
+        "config reset": "（管理者用）設定を消して、未設定（または環境変数の値）に戻します。",
+    }
+    config_group = app_commands.Group(name="config", description="【管理者用】このサーバーのチャンネル・ロールの設定", guild_only=True, default_permissions=discord.Permissions(administrator=True))
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @config_group.command(name="show", description="（管理者用）現在の設定を一覧表示します。")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def show(self, interaction: Interaction):
+        embed = Embed(title="⚙️ サーバー設定", color=Color.blurple())
+        lines = []
+        for name, (value, from_env) in guilds.settings(interaction.guild_id).items():
+            kind, description = guilds.SETTINGS[name][1], guilds.SETTINGS[name][2]
+            if value is None: shown = "未設定"
+            elif kind == "role": shown = f"<@&{value}>"
+            else: shown = f"<#{value}>"
+            lines.append(f"`{name}` {description}: {shown}{'（環境変数）' if from_env else ''}")
+        embed.description = "\n".join(lines)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    async def _save(self, interaction: Interaction, name: str, value: int | None, shown: str):
+        await guilds.set_setting(interaction.guild_id, name, value)
+        await interaction.response.send_message(f"✅ `{name}` を {shown} に設定しました。", ephemeral=True)
+
+    @config_group.command(name="channel", description="（管理者用）ボットが使うチャンネルを設定します。")
+    @app_commands.describe(setting="設定する項目", channel="使うチャンネル")
+    @app_commands.choices(setting=_setting_choices("channel"))
+    @app_commands.checks.has_permissions(administrator=True)
+    async def channel(self, interaction: Interaction, setting: str, channel: discord.TextChannel):
+        await self._save(interaction, setting, channel.id, channel.mention)
+
+    @config_group.command(name="role", description="（管理者用）ボットが使うロールを設定します。")
+    @app_commands.describe(setting="設定する項目", role="使うロール")
+    @app_commands.choices(setting=_setting_choices("role"))
+    @app_commands.checks.has_permissions(administrator=True)
+    async def role(self, interaction: Interaction, setting: str, role: discord.Role):
+        await self._save(interaction, setting, role.id, role.mention)
+
+    @config_group.command(name="category", description="（管理者用）チーム分けのVCを作成するカテゴリを設定します。")
+    @app_commands.describe(category="VCを作成するカテゴリ")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def category(self, interaction: Interaction, category: discord.CategoryChannel):
+        await self._save(interaction, "shuffle_vc_category_id", category.id, category.mention)
+
+    @config_group.command(name="reset", description="（管理者用）設定を消して、未設定（または環境変数の値）に戻します。")
+    @app_commands.describe(setting="元に戻す項目")
+    @app_commands.choices(setting=[app_commands.Choice(name=name, value=name) for name in guilds.SETTINGS])
+    @app_commands.checks.has_permissions(administrator=True)
+    async def reset(self, interaction: Interaction, setting: str):
+        await guilds.set_setting(interaction.guild_id, setting, None)
+        await interaction.response.send_message(f"✅ `{setting}` の設定を消しました。", ephemeral=True)
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(SettingsCog(bot))
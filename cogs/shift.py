@@ -1,18 +1,15 @@
 import discord
 from discord import app_commands, ui, ButtonStyle, Embed, Color, Interaction, Member, Role, TextChannel, ChannelType
 from discord.ext import commands
-from db_handler import db
-import config
+from db_handler import db, DatabaseUnavailableError
+import guilds
+import member_cache
+from message_router import router, MessageContext
 import re
 from datetime import datetime, timedelta
 from io import BytesIO
 
-try:
-    import openpyxl
-    from openpyxl.styles import Font, Alignment, PatternFill
-    from openpyxl.utils import get_column_letter
-except ImportError:
-    openpyxl = None
+# openpyxl は読み込みが重いため、起動時には読み込まず Excel 出力のコマンド内で import する
 
 # --- 定数 ---
 REPROCESS_EMOJI = '🔄'
@@ -128,6 +125,32 @@ class ShiftCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # 予定調整スレッドの索引 { スレッドID: 本人のユーザーID（文字列） }
+        # メッセージごとにDBを読まずに、予定調整スレッドへの本人の書き込みかを判定する
+        self.schedule_threads = {}
+        router.subscribe("shift", self.handle_schedule_message, threads_only=True, accepts=self.is_schedule_thread)
+
+    async def cog_load(self):
+        try:
+            self.schedule_threads = await db.run(self._load_schedule_threads)
+        except DatabaseUnavailableError as e:
+            # 新しく作るスレッドは索引に追加されるが、既存のスレッドへの書き込みは次回の起動まで処理されない
+            print(f"⚠️ 予定調整スレッドの一覧を読み込めませんでした: {e}")
+
+    def cog_unload(self):
+        router.unsubscribe("shift")
+
+    def _load_schedule_threads(self) -> dict:
+        threads = {}
+        for _, schedules in db.scan("shift_schedules_"):
+            if not isinstance(schedules, dict): continue
+            for user_id_str, entry in schedules.items():
+                if entry.get("thread_id"): threads[int(entry["thread_id"])] = user_id_str
+        return threads
+
+    def is_schedule_thread(self, context: MessageContext) -> bool:
+        """予定調整スレッドへの、本人の書き込みか"""
+        return self.schedule_threads.get(context.channel_id) == str(context.user_id)
 
     async def cog_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
         print(f"Cog 'ShiftCog' でエラー: {error}")
@@ -137,12 +160,7 @@ class ShiftCog(commands.Cog):
 
     async def _process_schedule_message(self, message: discord.Message):
         if message.author.bot or not isinstance(message.channel, discord.Thread): return
-        schedules = db.get("shift_schedules", {})
-        thread_id_str, user_id_str = str(message.channel.id), None
-        for uid, udata in schedules.items():
-            if udata.get("thread_id") == thread_id_str:
-                user_id_str = uid
-                break
+        user_id_str = self.schedule_threads.get(message.channel.id)
         if not user_id_str or user_id_str != str(message.author.id): return
         parsed_list = parse_schedule_message(message.content)
         if parsed_list is None:
@@ -151,16 +169,22 @@ class ShiftCog(commands.Cog):
             try: await message.reply(error_message, delete_after=15)
             except discord.Forbidden: pass
             return
-        for parsed in parsed_list:
-            day_key = f"day_{parsed['day']}"
-            schedules[user_id_str].setdefault("schedule", {})[day_key] = f"{parsed['time']} ({parsed['status']})"
-        db.set("shift_schedules", schedules)
+        await self._save_parsed_schedule(message.guild.id, user_id_str, parsed_list)
         try: await message.add_reaction("✅")
         except discord.Forbidden: print(f"ERROR: リアクション付与権限がありません in {message.channel.name}")
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        await self._process_schedule_message(message)
+    async def _save_parsed_schedule(self, guild_id: int, user_id_str: str, parsed_list: list):
+        """解析した予定を保存する。他のメンバーの同時の書き込みと競合しても、最新のデータに反映し直す"""
+        def apply(schedules):
+            if user_id_str not in schedules: return
+            for parsed in parsed_list:
+                day_key = f"day_{parsed['day']}"
+                schedules[user_id_str].setdefault("schedule", {})[day_key] = f"{parsed['time']} ({parsed['status']})"
+        await db.run(db.update, guilds.key("shift_schedules", guild_id), apply, {})
+
+    async def handle_schedule_message(self, context: MessageContext):
+        """スレッド内の書き込みを監視し、予定を自動で記録する"""
+        await self._process_schedule_message(context.message)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
@@ -176,22 +200,21 @@ class ShiftCog(commands.Cog):
     shift = app_commands.Group(name="shift", description="週間活動予定（シフト）の管理", guild_only=True)
 
     # ★★★★★ ここが修正箇所 ★★★★★
-    async def _create_schedule_thread(self, channel: TextChannel, member: Member):
-        schedules = db.get("shift_schedules", {})
+    async def _create_schedule_thread(self, channel: TextChannel, member: Member, schedules: dict, created: dict):
+        """スレッドを作成して created に記録する。DBへの保存は呼び出し側でまとめて行う"""
         user_id_str = str(member.id)
         if user_id_str in schedules and schedules[user_id_str].get("thread_id"):
             return None, "既にスレッドが存在します"
         try:
             thread = await channel.create_thread(name=f"週間予定 - {member.display_name}", type=ChannelType.private_thread)
             await thread.add_user(member)
-            schedules.setdefault(user_id_str, {})["thread_id"] = str(thread.id)
-            schedules[user_id_str]["name"] = member.display_name
-            db.set("shift_schedules", schedules)
+            created[user_id_str] = {"thread_id": str(thread.id), "name": member.display_name}
 
             # スタッフロールを取得してメンションを作成
             staff_mention = ""
-            if config.STAFF_ROLE_ID:
-                staff_role = channel.guild.get_role(config.STAFF_ROLE_ID)
+            staff_role_id = guilds.setting(channel.guild.id, "staff_role_id")
+            if staff_role_id:
+                staff_role = channel.guild.get_role(staff_role_id)
                 if staff_role:
                     staff_mention = f"{staff_role.mention} "
 
@@ -228,21 +251,33 @@ class ShiftCog(commands.Cog):
     async def create(self, interaction: Interaction, member: Member = None, role: Role = None):
         if not member and not role: return await interaction.response.send_message("メンバーまたはロールのいずれか一方を指定してください。", ephemeral=True)
         await interaction.response.defer(ephemeral=True)
-        targets = list(dict.fromkeys(([member] if member else []) + (role.members if role else [])))
+        targets = list(dict.fromkeys(([member] if member else []) + (await member_cache.role_members(interaction.guild, role) if role else [])))
         success_count, fail_count, skip_count, error_messages = 0, 0, 0, []
-        for m in targets:
-            if m.bot: continue
-            thread, error = await self._create_schedule_thread(interaction.channel, m)
-            if thread: success_count += 1
-            elif "既に" in (error or ""): skip_count += 1
-            else: fail_count += 1; error_messages.append(error) if error not in error_messages else None
+        # 対象者全員分の作成結果を、最後に1回の読み込み・書き込みで保存する
+        schedules, created = await db.run(db.get, guilds.key("shift_schedules", interaction.guild_id), {}), {}
+        try:
+            for m in targets:
+                if m.bot: continue
+                thread, error = await self._create_schedule_thread(interaction.channel, m, schedules, created)
+                if thread: success_count += 1
+                elif "既に" in (error or ""): skip_count += 1
+                else: fail_count += 1; error_messages.append(error) if error not in error_messages else None
+        finally:
+            if created:
+                # スレッド作成中に書き込まれた予定を消さないよう、最新のデータに追記する
+                def merge(latest):
+                    for user_id_str, entry in created.items():
+                        latest.setdefault(user_id_str, {}).update(entry)
+                await db.run(db.update, guilds.key("shift_schedules", interaction.guild_id), merge, {})
+                for user_id_str, entry in created.items(): self.schedule_threads[int(entry["thread_id"])] = user_id_str
         await interaction.followup.send(f"スレッド作成完了。\n✅ 成功: {success_count}件\n⏩ スキップ: {skip_count}件\n❌ 失敗: {fail_count}件\n{', '.join(error_messages)}", ephemeral=True)
 
     @shift.command(name="create_all", description="クランメンバー全員の予定調整スレッドを一斉に作成します。")
     @app_commands.checks.has_permissions(manage_threads=True)
     async def create_all(self, interaction: Interaction):
-        if not config.CLAN_MEMBER_ROLE_ID: return await interaction.response.send_message("`CLAN_MEMBER_ROLE_ID`が設定されていません。", ephemeral=True)
-        clan_member_role = interaction.guild.get_role(config.CLAN_MEMBER_ROLE_ID)
+        clan_member_role_id = guilds.setting(interaction.guild_id, "clan_member_role_id")
+        if not clan_member_role_id: return await interaction.response.send_message("クランメンバーのロールが設定されていません。`/config role` で `clan_member_role_id` を設定してください。", ephemeral=True)
+        clan_member_role = interaction.guild.get_role(clan_member_role_id)
         if not clan_member_role: return await interaction.response.send_message("クランメンバーロールが見つかりません。", ephemeral=True)
         await self.create.callback(self, interaction, member=None, role=clan_member_role)
 
@@ -250,7 +285,7 @@ class ShiftCog(commands.Cog):
     @app_commands.checks.has_permissions(manage_threads=True)
     async def export(self, interaction: Interaction):
         await interaction.response.defer()
-        schedules = db.get("shift_schedules", {})
+        schedules = await db.run(db.get, guilds.key("shift_schedules", interaction.guild_id), {})
         if not schedules: return await interaction.followup.send("スケジュールデータがありません。")
         days = ["月", "火", "水", "木", "金", "土", "日"]
         max_name_len = get_max_name_length(schedules)
@@ -277,7 +312,7 @@ class ShiftCog(commands.Cog):
     async def export_excel(self, interaction: Interaction):
         # (このコマンドの中身は変更なし)
         await interaction.response.defer(ephemeral=True)
-        schedules = db.get("shift_schedules", {})
+        schedules = await db.run(db.get, guilds.key("shift_schedules", interaction.guild_id), {})
         if not schedules: return await interaction.followup.send("スケジュールデータがありません。", ephemeral=True)
         try:
             import openpyxl
@@ -319,7 +354,7 @@ class ShiftCog(commands.Cog):
     async def cleanup(self, interaction: Interaction):
         # (このコマンドの中身は変更なし)
         await interaction.response.defer(ephemeral=True)
-        schedules = db.get("shift_schedules", {})
+        schedules = await db.run(db.get, guilds.key("shift_schedules", interaction.guild_id), {})
         if not schedules: return await interaction.followup.send("クリーンアップ対象のスレッドはありません。", ephemeral=True)
         archived_count, failed_count = 0, 0
         for user_id in list(schedules.keys()):
@@ -328,8 +363,11 @@ class ShiftCog(commands.Cog):
                 try:
                     thread = await self.bot.fetch_channel(int(thread_id)); await thread.edit(archived=True, locked=True); archived_count += 1
                 except (discord.NotFound, discord.Forbidden): failed_count += 1
-            del schedules[user_id]
-        db.set("shift_schedules", schedules)
+        # アーカイブ中に作成されたスレッドの情報は残す
+        archived = {user_id: entry.get("thread_id") for user_id, entry in schedules.items()}
+        await db.run(db.update, guilds.key("shift_schedules", interaction.guild_id), lambda latest: {uid: entry for uid, entry in latest.items() if archived.get(uid, object()) != entry.get("thread_id")}, {})
+        for thread_id in archived.values():
+            if thread_id: self.schedule_threads.pop(int(thread_id), None)
         await interaction.followup.send(f"クリーンアップ完了。\n✅ アーカイブ成功: {archived_count}件\n❌ 失敗: {failed_count}件", ephemeral=True)
 
 # cogs/shift.py の ShiftCog クラス内に追記
@@ -350,7 +388,7 @@ class ShiftCog(commands.Cog):
         await interaction.response.defer(ephemeral=True, thinking=True)
 
 
-        schedules = db.get("shift_schedules", {})
+        schedules = await db.run(db.get, guilds.key("shift_schedules", interaction.guild_id), {})
         if not schedules:
             return await interaction.followup.send("スケジュールデータがありません。", ephemeral=True)
 
@@ -434,44 +472,6 @@ class ShiftCog(commands.Cog):
             import traceback
             traceback.print_exc()
             await interaction.followup.send(f"❌ Excelファイルの作成中にエラーが発生しました: {e}", ephemeral=True)
-            
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        """スレッド内の書き込みを監視し、予定を自動で記録する"""
-        if message.author.bot or not isinstance(message.channel, discord.Thread): return
-
-        schedules = db.get("shift_schedules", {})
-        thread_id_str = str(message.channel.id)
-        user_id_str = next((uid for uid, udata in schedules.items() if udata.get("thread_id") == thread_id_str), None)
-        
-        if not user_id_str or user_id_str != str(message.author.id): return
-
-        # ★★★ ここからデバッグログ付き ★★★
-        print(f"\n\n--- on_message TRIGGERED by {message.author.display_name} ---")
-        
-        parsed_list = parse_schedule_message(message.content)
-        
-        if parsed_list is None:
-            print(" -> 解析結果がNoneのため、エラーメッセージを返信します。")
-            error_message = (f"{message.author.mention} 書き方が違うようです！\n"
-                             "基本の形: `曜日 時間 状態` で入力してくださいね。")
-            try: await message.reply(error_message, delete_after=20)
-            except: pass
-            return
-
-        print(f" -> DB更新対象: {len(parsed_list)}件")
-        for parsed in parsed_list:
-            day_key = f"day_{parsed['day']}"
-            schedules[user_id_str].setdefault("schedule", {})[day_key] = f"{parsed['time']} ({parsed['status']})"
-        
-        db.set("shift_schedules", schedules)
-        print(" -> DB更新完了。")
-        try:
-            await message.add_reaction("✅")
-            print(" -> リアクション付与完了。")
-        except discord.Forbidden:
-            print(f"ERROR: リアクション付与の権限がありません in {message.channel.name}")
-        print("--- on_message FINISHED ---")
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(ShiftCog(bot))
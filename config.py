@@ -32,12 +32,56 @@ def get_env_var(name: str, required: bool = True, cast_to=str, default=None) ->
     except (ValueError, TypeError):
         raise ConfigError(f"環境変数 '{name}' の値 '{value}' を {cast_to.__name__} に正しく変換できません。")
 
+def int_list(value: str) -> list[int]:
+    """"0,1,2" のようなカンマ区切りの文字列を整数のリストに変換する"""
+    return [int(item) for item in value.split(",") if item.strip()]
+
 # --- Bot設定 ---
 BOT_TOKEN = get_env_var("BOT_TOKEN")
-GUILD_ID = get_env_var("GUILD_ID", cast_to=int)
-MONGO_URI = get_env_var("MONGO_URI", required=not IS_REPLIT) # Replit以外で必須
+# 以前から使っているギルドのID（任意）。このギルドでは、/config で設定していない項目に下の環境変数の値を使う
+# また、ギルドで分けていなかった以前のデータは、起動時にこのギルドのデータとして移行する
+GUILD_ID = get_env_var("GUILD_ID", required=False, cast_to=int)
+
+# --- メンバーキャッシュ設定 ---
+# full: 起動時に全メンバーを取得してキャッシュする（小さいサーバー向け。従来どおり）
+# tracked: 起動時には取得せず、追跡対象（クラン・体験・スタッフのロール、最近の活動、体験中・シフト登録済み）のメンバーだけを後からキャッシュする
+# lazy: 起動時には取得せず、全メンバーの一覧が必要になったギルドだけを初めて必要になったときに取得する
+MEMBER_CACHE_POLICY = get_env_var("MEMBER_CACHE_POLICY", required=False, default="full").lower()
+if MEMBER_CACHE_POLICY not in ("full", "tracked", "lazy"):
+    raise ConfigError(f"MEMBER_CACHE_POLICY の値 '{MEMBER_CACHE_POLICY}' は不正です。full / tracked / lazy のいずれかを指定してください。")
+# キャッシュにないメンバーをAPIで取得した結果を保持する件数と秒数
+MEMBER_LRU_SIZE = get_env_var("MEMBER_LRU_SIZE", required=False, cast_to=int, default=1000)
+MEMBER_LRU_TTL_SECONDS = get_env_var("MEMBER_LRU_TTL_SECONDS", required=False, cast_to=int, default=300)
+# tracked: ロールを持つメンバーを調べるための全メンバー取得を、ギルドごとに何秒に1回までにするか（結果はIDだけを保持し、
+# 再接続・/shift create などはこの間、前回の結果とキャッシュ済みのメンバーを使う）
+MEMBER_ROLE_SCAN_INTERVAL_SECONDS = get_env_var("MEMBER_ROLE_SCAN_INTERVAL_SECONDS", required=False, cast_to=int, default=21600)
+
+# --- シャーディング設定 ---
+# 通常は未設定でよい（1プロセス・シャードなし）。複数プロセスで動かす場合は launcher.py が設定する
+# 全体のシャード数。設定すると AutoShardedBot として起動する
+SHARD_COUNT = get_env_var("SHARD_COUNT", required=False, cast_to=int)
+# このプロセスが担当するシャード番号（例: "0,1"）。未設定の場合は全シャードを担当する
+SHARD_IDS = get_env_var("SHARD_IDS", required=False, cast_to=int_list)
+# このプロセスのクラスター番号と、クラスター（プロセス）の総数。全体で1回だけ行う処理はクラスター0が担当する
+CLUSTER_ID = get_env_var("CLUSTER_ID", required=False, cast_to=int, default=0)
+CLUSTER_COUNT = get_env_var("CLUSTER_COUNT", required=False, cast_to=int, default=1)
+if SHARD_IDS and not SHARD_COUNT:
+    raise ConfigError("SHARD_IDS を指定する場合は SHARD_COUNT も指定してください。")
+if SHARD_COUNT and SHARD_IDS and any(not 0 <= shard_id < SHARD_COUNT for shard_id in SHARD_IDS):
+    raise ConfigError(f"SHARD_IDS {SHARD_IDS} に、SHARD_COUNT ({SHARD_COUNT}) の範囲外の番号があります。")
 
-# --- チャンネルID ---
+# --- データベース設定 ---
+# "mongo" / "replit" / "sqlite"。未指定の場合、Replit上ではreplit、それ以外ではmongoを使う
+DB_BACKEND = get_env_var("DB_BACKEND", required=False, default="replit" if IS_REPLIT else "mongo").lower()
+if DB_BACKEND not in ("mongo", "replit", "sqlite"):
+    raise ConfigError(f"DB_BACKEND の値 '{DB_BACKEND}' は不正です。mongo / replit / sqlite のいずれかを指定してください。")
+MONGO_URI = get_env_var("MONGO_URI", required=DB_BACKEND == "mongo") # MongoDBを使う場合のみ必須
+MONGO_MAX_POOL_SIZE = get_env_var("MONGO_MAX_POOL_SIZE", required=False, cast_to=int, default=20)
+# 接続・サーバー選択のタイムアウト（ミリ秒）。ドライバーのデフォルト（30秒）では障害時にボット全体が止まるため短くする
+MONGO_TIMEOUT_MS = get_env_var("MONGO_TIMEOUT_MS", required=False, cast_to=int, default=3000)
+SQLITE_PATH = get_env_var("SQLITE_PATH", required=False, default="clanbot.sqlite3")
+
+# --- チャンネルID（GUILD_ID のギルドで、/config の設定がない場合に使う） ---
 ROLE_SELECT_CHANNEL_ID = get_env_var("ROLE_SELECT_CHANNEL_ID", required=False, cast_to=int)
 RESULT_CHANNEL_ID = get_env_var("RESULT_CHANNEL_ID", required=False, cast_to=int)
 MAIN_CHANNEL_ID = get_env_var("MAIN_CHANNEL_ID", required=False, cast_to=int)
@@ -55,3 +99,13 @@ POST_TRIAL_ROLE_ID = get_env_var("POST_TRIAL_ROLE_ID", required=False, cast_to=i
 
 # --- VCカテゴリID ---
 SHUFFLE_VC_CATEGORY_ID = get_env_var("SHUFFLE_VC_CATEGORY_ID", required=False, cast_to=int)
+
+# --- 監視設定 ---
+# イベントループがこの時間（ミリ秒）以上止まったら、止めている処理のスタックを記録する
+LOOP_STALL_THRESHOLD_MS = get_env_var("LOOP_STALL_THRESHOLD_MS", required=False, cast_to=int, default=500)
+# 同じ場所での停止のログを出す最小間隔（秒）
+LOOP_STALL_LOG_INTERVAL = get_env_var("LOOP_STALL_LOG_INTERVAL", required=False, cast_to=int, default=60)
+# Webサーバーの /debug/profile に必要なトークン（Authorization: Bearer <トークン>）。未設定の場合は無効
+DEBUG_TOKEN = get_env_var("DEBUG_TOKEN", required=False)
+# 1 にすると、コマンドツリーに変更がなくても起動時に必ずスラッシュコマンドを同期する
+FORCE_COMMAND_SYNC = get_env_var("FORCE_COMMAND_SYNC", required=False, cast_to=int, default=0)
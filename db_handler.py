@@ -1,72 +1,963 @@
 import os
-import pymongo
+import re
+import copy
+import json
+import time
+import bisect
+import random
+import asyncio
+import sqlite3
+import inspect
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import config
+import metrics
 
-# Replitで実行中かどうかを判定
-IS_REPLIT = 'REPL_ID' in os.environ
+try:
+    import pymongo
+    # 接続できないことを表すエラー（障害とみなし、書き込みを保留して再送する）。それ以外のエラーは、再送しても同じように失敗する
+    _MONGO_OUTAGE_ERRORS = (pymongo.errors.AutoReconnect, pymongo.errors.ServerSelectionTimeoutError, pymongo.errors.NetworkTimeout)
+except ImportError:
+    pymongo = None
+
+# 「値が存在しない」ことを表す目印（None を保存した場合と区別する）
+_MISSING = object()
+# update() で競合した場合に再試行する最大回数
+CAS_MAX_RETRIES = 20
+
+class DatabaseUnavailableError(Exception):
+    """DBに接続できず、update() の結果や scan() の全件を確定できない場合に送出する"""
+
+class UpdateConflictError(Exception):
+    """update() が再試行の上限まで競合し続けた場合に送出する"""
+
+# /metrics に操作回数・所要時間を記録する公開メソッド
+_INSTRUMENTED_METHODS = ("get", "set", "delete", "all", "prefix", "get_many", "scan", "bulk_write", "set_many", "delete_many", "increment_many", "update", "ranked", "count_ranked", "rank_of")
+# メソッドの中で別のメソッドを呼んだ場合（set → bulk_write など）に、外側の1回だけを記録するための呼び出しの深さ
+_instrument_depth = threading.local()
+
+def _metric_prefix(args: tuple) -> str:
+    """
+    メトリクスのラベルに使うキーのプレフィックス。ギルドIDやユーザーIDの数字を全て N に置き換え、種類ごとに集計する
+    （activity_123_456 → activity_N_N、activity_123_ → activity_N_）。ギルドが増えてもラベルの種類は増えない。
+    複数キーの操作は最初のキーで代表する。
+    """
+    if not args: return ""
+    target = args[0]
+    if isinstance(target, dict): target = next(iter(target), "")
+    elif isinstance(target, (list, tuple)):
+        target = target[0] if target else ""
+        if isinstance(target, tuple): target = target[1]  # bulk_write の操作
+    elif not isinstance(target, (str, int)): return "*"
+    return re.sub(r"\d+", "N", str(target))[:40]
+
+def _instrument(name: str, method):
+    """DB操作の回数と所要時間を metrics に記録するラッパー"""
+    def record(args, started, status):
+        prefix = _metric_prefix(args)
+        metrics.DB_OPERATIONS.inc(operation=name, prefix=prefix, status=status)
+        metrics.DB_LATENCY.observe(time.perf_counter() - started, operation=name, prefix=prefix)
+
+    if inspect.isgeneratorfunction(method):
+        # scan はジェネレーターのため、最後まで読み終えるまでの時間を記録する
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            depth = getattr(_instrument_depth, "value", 0)
+            if depth: yield from method(self, *args, **kwargs); return
+            started, status = time.perf_counter(), "ok"
+            _instrument_depth.value = 1
+            try:
+                # 利用側が途中で止めた場合も、ここで深さを戻してから抜ける
+                for item in method(self, *args, **kwargs):
+                    _instrument_depth.value = 0
+                    yield item
+                    _instrument_depth.value = 1
+            except Exception:
+                status = "error"; raise
+            finally:
+                _instrument_depth.value = 0
+                record(args, started, status)
+        generator_wrapper._instrumented = True
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(_instrument_depth, "value", 0)
+        if depth: return method(self, *args, **kwargs)
+        started, status = time.perf_counter(), "ok"
+        _instrument_depth.value = 1
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            status = "error"; raise
+        finally:
+            _instrument_depth.value = 0
+            record(args, started, status)
+    wrapper._instrumented = True
+    return wrapper
 
 class DatabaseHandler:
+    # run() で同期APIを実行するスレッドプール。None の場合は asyncio のデフォルトを使う
+    executor = None
+
+    def __init_subclass__(cls, **kwargs):
+        # バックエンドごとに、公開メソッドを計測用のラッパーで包む
+        super().__init_subclass__(**kwargs)
+        for name in _INSTRUMENTED_METHODS:
+            method = getattr(cls, name, None)
+            if method is not None and not getattr(method, "_instrumented", False):
+                setattr(cls, name, _instrument(name, method))
+
+    async def run(self, method, *args, **kwargs):
+        """同期APIをスレッドで実行し、イベントループをブロックせずに結果を待つ（例: await db.run(db.get_many, keys)）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    def health(self) -> dict:
+        """DBの状態。state が "closed" 以外の場合は障害中（/health や /ping で表示する）"""
+        return {"backend": config.DB_BACKEND, "state": "closed"}
+
+    @property
+    def is_available(self) -> bool:
+        return self.health().get("state") != "open"
+
+    def update(self, key, mutator, default=None):
+        """
+        key の値を mutator で書き換えて保存し、保存した値を返す（バージョン番号による楽観的排他制御）。
+        mutator は現在の値のコピー（存在しない場合は default のコピー）を受け取り、その場で書き換えるか新しい値を返す。
+        他の書き込みと競合した場合は最新の値を読み直して mutator をやり直すため、mutator の中で通信などの副作用を起こさないこと。
+        mutator が例外を送出した場合や、値が変わらなかった場合は何も保存しない（例外はそのまま送出する）。
+        スレッドから呼ぶ前提（await db.run(db.update, key, mutator, default)）。
+        """
+        key = str(key)
+        for attempt in range(CAS_MAX_RETRIES):
+            current, version = self._read_versioned(key)
+            value = copy.deepcopy(default) if current is _MISSING else current
+            before = copy.deepcopy(value)
+            result = mutator(value)
+            if result is not None: value = result
+            # 何も変わらなかった場合は書き込まない
+            if value == before or self._write_if_version(key, value, version):
+                return value
+            # 同じタイミングで再試行し続けないよう、少しずらして読み直す
+            time.sleep(random.uniform(0, 0.002 * (attempt + 1)))
+        raise UpdateConflictError(f"{key} の更新が競合し続けたため中断しました。")
+
+    # update() 用: (値 or _MISSING, バージョン番号) を返す。キーが存在しない場合のバージョンは None でもよい
+    def _read_versioned(self, key: str) -> tuple: raise NotImplementedError
+    # update() 用: バージョンが version のままなら value を書き込んで True を返す。version=None は「キーが存在しない場合のみ作成」
+    def _write_if_version(self, key: str, value, version) -> bool: raise NotImplementedError
+
     def get(self, key, default=None): raise NotImplementedError
     def set(self, key, value): raise NotImplementedError
     def delete(self, key): raise NotImplementedError
     def all(self): raise NotImplementedError
-    def prefix(self, p_str: str = ""): raise NotImplementedError
+    # p_str で始まるキーの一覧を返す。include_data=True なら {key: data} を返す（projection は scan と同じ）
+    def prefix(self, p_str: str = "", include_data: bool = False, projection: list | None = None): raise NotImplementedError
+    # 複数キーをまとめて取得する。存在しないキーは結果に含まれない
+    def get_many(self, keys) -> dict: raise NotImplementedError
+    # 複数の書き込みを1回で送る。operations は以下のタプルのリスト:
+    #   ("set", key, value) / ("delete", key) / ("update", key, increments, sets) / ("patch", key, sets)
+    # update の increments / sets は data 内のドット区切りパスで指定する（例: {"vc_seconds.total": 60}）
+    # patch は既に存在するキーの sets のパスだけを上書きする（キーがなければ何もしない。update と違って作成しない）
+    def bulk_write(self, operations: list): raise NotImplementedError
+
+    # p_str で始まるキーを (key, data) で順に返すジェネレーター。全件をメモリに載せずに走査できる
+    # projection: None なら data 全体、フィールドのリストならその項目だけ、空リストならキーのみ（data は {}）
+    # 全件を返せない場合（障害中・途中で失敗）は DatabaseUnavailableError を送出する
+    def scan(self, p_str: str = "", projection: list | None = None, batch_size: int = 100): raise NotImplementedError
+
+    def set_many(self, mapping: dict):
+        self.bulk_write([("set", key, value) for key, value in mapping.items()])
+
+    def delete_many(self, keys):
+        self.bulk_write([("delete", key) for key in keys])
+
+    # increments: { key: {"vc_seconds.total": 60, ...} } / sets: { key: {"name": "..."} }
+    def increment_many(self, increments: dict, sets: dict | None = None):
+        sets = sets or {}
+        self.bulk_write([("update", key, increments.get(key, {}), sets.get(key, {})) for key in set(increments) | set(sets)])
+    # ランキング用: p_str で始まるキーを field の値の降順（同じ値はキー順）で並べ、offset から limit 件を (key, data) で返す
+    # 計算量はバックエンドによる。Replit DB はメモリ上の順序統計インデックスで O(log n)。
+    # SQLite はギルドごとに分かれたインデックス、MongoDB は (field, _id) の複合インデックスだけで処理し、本体は返す limit 件しか読まないが、
+    # B-tree には順位を数える仕組みがないため、offset・順位・件数の分だけインデックスのエントリをたどる（それらに比例する）
+    def ranked(self, p_str: str, field: str, offset: int = 0, limit: int = 10) -> list: raise NotImplementedError
+    # field の値が0より大きいキーの数
+    def count_ranked(self, p_str: str, field: str) -> int: raise NotImplementedError
+    # key の順位と値を (rank, score) で返す。値が0以下なら None
+    def rank_of(self, p_str: str, field: str, key) -> tuple | None: raise NotImplementedError
+
+def _project(data, projection: list | None):
+    """data から projection で指定したフィールドだけを取り出す"""
+    if projection is None or not isinstance(data, dict): return data
+    result = {}
+    for path in projection:
+        value = _get_path(data, path, default=None)
+        if value is not None:
+            _apply_increment(result, {}, {path: value})
+    return result
+
+def _get_path(data, path: str, default=0):
+    """ドット区切りのパスで辞書の値を取得する"""
+    for part in path.split("."):
+        if not isinstance(data, dict): return default
+        data = data.get(part)
+    return default if data is None else data
+
+def _apply_increment(data: dict, increments: dict, sets: dict | None = None) -> dict:
+    """ドット区切りのパスに従って、辞書内の数値を加算・値を上書きする"""
+    for path, amount in increments.items():
+        *parents, leaf = path.split(".")
+        node = data
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = node.get(leaf, 0) + amount
+    for path, value in (sets or {}).items():
+        *parents, leaf = path.split(".")
+        node = data
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = value
+    return data
+
+class _RankIndex:
+    """値の降順に並んだキーの一覧を保持し、ページ取得と順位検索を O(log n) で行う順序統計インデックス"""
+    def __init__(self, field: str):
+        self.field = field
+        self.scores = {}  # { key: score }
+        self.order = []   # [(-score, key)] の昇順 = score の降順
+
+    def update(self, key: str, data):
+        self.remove(key)
+        score = _get_path(data, self.field)
+        if isinstance(score, (int, float)) and score > 0:
+            self.scores[key] = score
+            bisect.insort(self.order, (-score, key))
+
+    def remove(self, key: str):
+        score = self.scores.pop(key, None)
+        if score is not None:
+            index = bisect.bisect_left(self.order, (-score, key))
+            del self.order[index]
+
+    def page(self, offset: int, limit: int) -> list:
+        return [key for _, key in self.order[offset:offset + limit]]
+
+    def rank(self, key: str) -> tuple | None:
+        score = self.scores.get(key)
+        if score is None: return None
+        # 自分より値が大きいキーの数 + 1 が順位（同点は同順位）
+        return bisect.bisect_left(self.order, (-score, "")) + 1, score
+
+def _prefix_bounds(p_str: str) -> tuple:
+    """
+    プレフィックス検索を範囲検索に変換する（p_str <= key < p_str の最後の文字を1つ進めた文字列）。
+    文字列の比較はコードポイント順（= UTF-8のバイト順）を前提とする。上限がない場合は None を返す。
+    """
+    p_str = str(p_str)
+    upper = p_str
+    while upper and ord(upper[-1]) == 0x10FFFF:
+        upper = upper[:-1]
+    if not upper: return p_str, None
+    next_code = ord(upper[-1]) + 1
+    if 0xD800 <= next_code <= 0xDFFF: next_code = 0xE000  # サロゲート領域は文字列として保存できないため飛ばす
+    return p_str, upper[:-1] + chr(next_code)
+
+def _prefix_filter(p_str: str) -> dict:
+    """
+    MongoDB用のプレフィックス検索条件。正規表現を使わないため、入力中の記号がパターンとして解釈されず、
+    _id の主キーインデックスをそのまま使える。
+    """
+    lower, upper = _prefix_bounds(p_str)
+    if not lower: return {}
+    if upper is None: return {"_id": {"$gte": lower}}
+    return {"_id": {"$gte": lower, "$lt": upper}}
 
 # --- Replit DB用の処理 ---
-if IS_REPLIT:
-    print("INFO: Replit環境を検出。Replit DBを使用します。")
-    from replit import db as replit_db
-    class ReplitDBHandler(DatabaseHandler):
-        def get(self, key, default=None): return replit_db.get(str(key), default)
-        def set(self, key, value): replit_db[str(key)] = value
-        def delete(self, key):
-            key_str = str(key)
-            if key_str in replit_db: del replit_db[key_str]; return True
-            return False
-        def all(self): return {key: replit_db[key] for key in replit_db.keys()}
-        def prefix(self, p_str: str = ""): return tuple(key for key in replit_db.keys() if key.startswith(p_str))
-    db = ReplitDBHandler()
+# Replit DBへの同時リクエスト数の上限
+REPLIT_FETCH_CONCURRENCY = 8
+class ReplitDBHandler(DatabaseHandler):
+    """
+    Replit DBはキーごとのHTTPリクエストになるため、以下の工夫で通信回数を抑える。
+    - 読み書きした値をローカルのミラーに保持し、2回目以降の読み込みは通信しない（書き込むのはこのプロセスだけのため一貫性が保たれる）
+    - プレフィックス検索はサーバー側で行い、ミラーにない値だけを並列に取得する
+    - 複数キーの書き込みは set_bulk の1リクエストにまとめる
+    """
+    def __init__(self):
+        from replit import db as replit_db
+        self._replit = replit_db
+        # ランキング用のインデックス { (p_str, field): _RankIndex }。初回の問い合わせ時に作成し、書き込みに合わせて更新する
+        self._rank_indexes = {}
+        # ローカルミラー { key: value or _MISSING }
+        self._mirror = {}
+        self._executor = ThreadPoolExecutor(max_workers=REPLIT_FETCH_CONCURRENCY, thread_name_prefix="replit-db")
+        # run() でスレッドから呼ばれてもランキング用インデックスが壊れないようにするロック
+        self._index_lock = threading.RLock()
+        # Replit DBには条件付き書き込みがないため、キーごとのバージョン番号をこのプロセス内で管理する
+        # （書き込むのはこのプロセスだけのため、ロックの中で比較すれば競合を検出できる）
+        self._versions = {}
+        self._write_lock = threading.RLock()
+
+    def _fetch(self, key: str):
+        """DBから値を取得する。get_raw を使い、変更のたびに書き込みが走る ObservedDict を避ける"""
+        try:
+            return json.loads(self._replit.get_raw(key))
+        except KeyError:
+            return _MISSING
+
+    def _load(self, keys) -> None:
+        """ミラーにないキーを、同時実行数を制限しながら並列に取得してミラーに入れる"""
+        unique = dict.fromkeys(keys)
+        missing = [key for key in unique if key not in self._mirror]
+        metrics.cache_result("replit_mirror", True, len(unique) - len(missing))
+        metrics.cache_result("replit_mirror", False, len(missing))
+        if len(missing) == 1:
+            self._mirror[missing[0]] = self._fetch(missing[0])
+        elif missing:
+            for key, value in zip(missing, self._executor.map(self._fetch, missing)):
+                self._mirror[key] = value
+
+    def _read(self, key: str, default=None):
+        value = self._mirror.get(key, _MISSING)
+        # 呼び出し側が書き換えてもミラーが変わらないよう、コピーを返す
+        return default if value is _MISSING else copy.deepcopy(value)
+
+    def get(self, key, default=None):
+        key_str = str(key)
+        self._load([key_str])
+        return self._read(key_str, default)
+    def set(self, key, value):
+        self.set_many({key: value})
+    def delete(self, key):
+        key_str = str(key)
+        self._load([key_str])
+        with self._write_lock:
+            if self._mirror.get(key_str, _MISSING) is _MISSING: return False
+            try: del self._replit[key_str]
+            except KeyError: pass
+            self._mirror[key_str] = _MISSING
+            self._versions[key_str] = self._versions.get(key_str, 0) + 1
+        self._update_rank_indexes(key_str, None)
+        return True
+    def all(self): return dict(self.scan(""))
+    def prefix(self, p_str: str = "", include_data: bool = False, projection: list | None = None):
+        if include_data: return dict(self.scan(p_str, projection))
+        return self._replit.prefix(p_str)
+    def get_many(self, keys) -> dict:
+        key_strs = [str(key) for key in keys]
+        self._load(key_strs)
+        return {key: self._read(key) for key in key_strs if self._mirror.get(key, _MISSING) is not _MISSING}
+    def scan(self, p_str: str = "", projection: list | None = None, batch_size: int = 100):
+        # キー一覧はサーバー側で絞り込み、値は batch_size 件ずつ並列に取得する
+        keys = self.prefix(p_str)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            if projection == []:
+                for key in batch: yield key, {}
+                continue
+            self._load(batch)
+            for key in batch:
+                value = self._read(key)
+                if value is not None: yield key, _project(value, projection)
+    def set_many(self, mapping: dict):
+        values = {str(key): value for key, value in mapping.items()}
+        if not values: return
+        with self._write_lock:
+            self._replit.set_bulk(values)
+            for key, value in values.items():
+                self._mirror[key] = copy.deepcopy(value)
+                self._versions[key] = self._versions.get(key, 0) + 1
+        for key, value in values.items():
+            self._update_rank_indexes(key, value)
+    def _read_versioned(self, key: str) -> tuple:
+        self._load([key])
+        with self._write_lock:
+            value = self._mirror.get(key, _MISSING)
+            return (value if value is _MISSING else copy.deepcopy(value)), self._versions.get(key, 0)
+    def _write_if_version(self, key: str, value, version) -> bool:
+        with self._write_lock:
+            if self._versions.get(key, 0) != version: return False
+            self.set_many({key: value})
+            return True
+    def bulk_write(self, operations: list):
+        # 操作を順にローカルで適用し、最終的な値だけを set_bulk の1リクエストで書き込む
+        to_set, to_delete = {}, []
+        self._load([str(op[1]) for op in operations if op[0] in ("update", "patch")])
+        for op, key, *args in operations:
+            key = str(key)
+            if op == "set":
+                to_set[key] = args[0]
+                if key in to_delete: to_delete.remove(key)
+            elif op == "delete":
+                to_set.pop(key, None); to_delete.append(key)
+            elif op == "update":
+                data = to_set[key] if key in to_set else (None if key in to_delete else self._read(key))
+                to_set[key] = _apply_increment(data or {}, args[0], args[1])
+                if key in to_delete: to_delete.remove(key)
+            elif op == "patch":
+                data = to_set[key] if key in to_set else (None if key in to_delete else self._read(key))
+                if isinstance(data, dict): to_set[key] = _apply_increment(data, {}, args[0])
+        for key in to_delete: self.delete(key)
+        self.set_many(to_set)
+
+    def _update_rank_indexes(self, key: str, value):
+        with self._index_lock:
+            for (p_str, _), index in self._rank_indexes.items():
+                if key.startswith(p_str):
+                    if value is None: index.remove(key)
+                    else: index.update(key, value)
+
+    def _get_rank_index(self, p_str: str, field: str) -> _RankIndex:
+        with self._index_lock:
+            if (p_str, field) not in self._rank_indexes:
+                index = _RankIndex(field)
+                for key, data in self.scan(p_str, projection=[field]):
+                    index.update(key, data)
+                self._rank_indexes[(p_str, field)] = index
+            return self._rank_indexes[(p_str, field)]
+
+    def ranked(self, p_str: str, field: str, offset: int = 0, limit: int = 10) -> list:
+        with self._index_lock:
+            keys = self._get_rank_index(p_str, field).page(offset, limit)
+        return [(key, self.get(key)) for key in keys]
+
+    def count_ranked(self, p_str: str, field: str) -> int:
+        with self._index_lock:
+            return len(self._get_rank_index(p_str, field).order)
+
+    def rank_of(self, p_str: str, field: str, key) -> tuple | None:
+        with self._index_lock:
+            return self._get_rank_index(p_str, field).rank(str(key))
 
 # --- MongoDB用の処理 ---
-else:
-    print("INFO: Replit以外の環境を検出。MongoDBを使用します。")
-    class MongoDBHandler(DatabaseHandler):
-        def __init__(self):
+# 連続でこの回数失敗したら、しばらくDBへのアクセスを止める（サーキットブレーカー）
+MONGO_FAILURE_THRESHOLD = 3
+# アクセスを止めてから、接続を再試行するまでの秒数
+MONGO_RETRY_AFTER_SECONDS = 30
+# 障害中に保留しておく書き込みの最大数（超えた分は古いものから捨てる）
+MONGO_WRITE_QUEUE_LIMIT = 10000
+
+class _CircuitBreaker:
+    """
+    DBの障害時に、毎回タイムアウトまで待たずにすぐ失敗させるための仕組み。
+    closed（通常）→ 連続失敗で open（アクセスしない）→ 一定時間後に half_open（1回だけ試す）→ 成功で closed / 失敗で open
+    """
+    def __init__(self, failure_threshold: int, retry_after: float):
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.retry_after:
+                self.state = "half_open"
+                return True
+            return self.state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print("✅ MongoDBへの接続が回復しました。")
+            self.state, self.failures = "closed", 0
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"⚠ MongoDBへのアクセスを一時停止します（{self.retry_after}秒後に再試行）: {self.last_error}")
+                self.state, self.opened_at = "open", time.monotonic()
+
+class MongoDBHandler(DatabaseHandler):
+    """
+    接続プールとタイムアウトを明示したMongoDBクライアント。
+    障害中は読み込みをすぐに失敗させ（デフォルト値を返す）、書き込みは保留して回復後に順番どおり再送する。
+    """
+    def __init__(self):
+        self.client = None
+        self.collection = None
+        # インデックスを作成済みのランキング用フィールド
+        self._indexed_fields = set()
+        self.breaker = _CircuitBreaker(MONGO_FAILURE_THRESHOLD, MONGO_RETRY_AFTER_SECONDS)
+        # 障害中に保留した書き込み（bulk_write の操作）
+        self._pending_writes = deque()
+        self._write_lock = threading.RLock()
+        self._connect()
+
+    def _connect(self) -> bool:
+        try:
+            if pymongo is None: raise ImportError("pymongo がインストールされていません。")
+            client = pymongo.MongoClient(
+                config.MONGO_URI,
+                maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+                serverSelectionTimeoutMS=config.MONGO_TIMEOUT_MS,
+                connectTimeoutMS=config.MONGO_TIMEOUT_MS,
+                socketTimeoutMS=config.MONGO_TIMEOUT_MS * 2,
+                retryWrites=True,
+                retryReads=True,
+            )
             try:
-                self.client = pymongo.MongoClient(config.MONGO_URI)
-                self.client.admin.command('ping')
-                self.db = self.client.get_database("ClanBotDB")
-                self.collection = self.db.get_collection("data")
-                print("✅ MongoDBに正常に接続しました。")
-            except Exception as e:
-                print(f"❌ MongoDBへの接続に失敗しました: {e}"); self.client = None
-        
-        # ★★★★★ ここから修正 ★★★★★
-        def get(self, key, default=None):
-            if not self.client: return default
-            document = self.collection.find_one({"_id": str(key)})
-            if document:
-                # 'data'キーが存在しない場合も、default値を返すように修正
-                return document.get("data", default)
+                client.admin.command('ping')
+            except Exception:
+                # 再試行のたびに作るクライアントの監視スレッドと接続プールが、障害中に溜まらないようにする
+                client.close()
+                raise
+            self.client = client
+            self.db = self.client.get_database("ClanBotDB")
+            self.collection = self.db.get_collection("data")
+            self.breaker.record_success()
+            print("✅ MongoDBに正常に接続しました。")
+            return True
+        except Exception as e:
+            print(f"❌ MongoDBへの接続に失敗しました: {e}")
+            self.breaker.record_failure(e)
+            return False
+
+    def _available(self) -> bool:
+        """DBにアクセスしてよいかを判定し、未接続なら再接続を試みる"""
+        if not self.breaker.allow(): return False
+        if self.client is None: return self._connect()
+        return True
+
+    def _read(self, func, default):
+        """読み込みを実行する。障害中や失敗時は default を返す"""
+        if not self._available(): return default
+        # 保留中の書き込みを先に反映し、自分の書き込みを読めるようにする（送れなければ古い値を返さず default）
+        if self._pending_writes and not self._replay_pending(): return default
+        try:
+            result = func()
+        except pymongo.errors.PyMongoError as e:
+            self.breaker.record_failure(e)
             return default
+        self.breaker.record_success()
+        return result
+
+    def _write(self, operations: list) -> bool:
+        """書き込みを実行する。障害中は保留し、既に保留がある場合は順序を守るため後ろに並べる"""
+        with self._write_lock:
+            self._pending_writes.extend(operations)
+            while len(self._pending_writes) > MONGO_WRITE_QUEUE_LIMIT:
+                self._pending_writes.popleft()
+                print("⚠ 保留中の書き込みが上限を超えたため、古いものを破棄しました。")
+            if not self._available(): return False
+            return self._replay_pending()
+
+    def _replay_pending(self) -> bool:
+        """
+        保留中の書き込みを順番どおりに送る。接続できない場合は保留したままにして False を返す。
+        一部だけ反映された場合は反映された分を保留から外し（$inc を二重に加算しないように）、
+        データの問題などで失敗した操作は、再送しても失敗し続けて後ろの書き込みを止めるため、記録して破棄する。
+        """
+        with self._write_lock:
+            while self._pending_writes:
+                operations = list(self._pending_writes)
+                try:
+                    self._send_bulk(operations)
+                except _MONGO_OUTAGE_ERRORS as e:
+                    self.breaker.record_failure(e)
+                    return False
+                except pymongo.errors.BulkWriteError as e:
+                    # ordered=True では、失敗した操作より前だけが反映され、後ろは送られていない
+                    write_errors = e.details.get("writeErrors") or []
+                    if not write_errors:
+                        # 書き込み自体は全て反映された（writeConcern を満たせなかっただけ）
+                        print(f"⚠ MongoDBへの書き込みの確認に失敗しました: {e.details.get('writeConcernErrors')}")
+                        self._discard_pending(len(operations))
+                        continue
+                    failed = e.operation_index
+                    self._discard_pending(failed)
+                    print(f"❌ MongoDBへの書き込みに失敗したため破棄しました（{operations[failed][0]} {operations[failed][1]}）: {write_errors[0].get('errmsg')}")
+                    self._discard_pending(1)
+                    continue
+                except Exception as e:
+                    # 送る前に分かるエラー（ドキュメントが大きすぎるなど）。どの操作が原因かを1件ずつ送って調べる
+                    if not self._send_one_by_one(e): return False
+                    continue
+                self._discard_pending(len(operations))
+            self.breaker.record_success()
+            return True
+
+    def _discard_pending(self, count: int):
+        for _ in range(count): self._pending_writes.popleft()
+
+    def _send_one_by_one(self, error: Exception) -> bool:
+        """保留中の書き込みを1件ずつ送り、失敗するものは破棄する。接続できなくなった場合は False"""
+        while self._pending_writes:
+            operation = self._pending_writes[0]
+            try:
+                self._send_bulk([operation])
+            except _MONGO_OUTAGE_ERRORS as e:
+                self.breaker.record_failure(e)
+                return False
+            except Exception as e:
+                print(f"❌ MongoDBへの書き込みに失敗したため破棄しました（{operation[0]} {operation[1]}）: {type(e).__name__}: {e}")
+            self._pending_writes.popleft()
+        return True
+
+    def health(self) -> dict:
+        return {
+            "backend": "mongo",
+            "state": self.breaker.state,
+            "connected": self.client is not None,
+            "queued_writes": len(self._pending_writes),
+            "consecutive_failures": self.breaker.failures,
+            "last_error": self.breaker.last_error,
+        }
+
+    def _read_versioned(self, key: str) -> tuple:
+        # 保留中の書き込みを先に反映しないと、古い値を元に更新してしまう
+        if not self._available() or not self._replay_pending():
+            raise DatabaseUnavailableError("MongoDBに接続できないため、更新できません。")
+        try:
+            document = self.collection.find_one({"_id": key})
+        except pymongo.errors.PyMongoError as e:
+            self.breaker.record_failure(e)
+            raise DatabaseUnavailableError(str(e)) from e
+        if document is None: return _MISSING, None
+        # version がないドキュメントは、この仕組みを入れる前に作られたもの（0 として扱う）
+        return document.get("data"), document.get("version", 0)
+
+    def _write_if_version(self, key: str, value, version) -> bool:
+        try:
+            if version is None:
+                try:
+                    self.collection.insert_one({"_id": key, "data": value, "version": 1})
+                except pymongo.errors.DuplicateKeyError:
+                    return False
+                return True
+            condition = {"_id": key, "version": version} if version else {"_id": key, "version": {"$exists": False}}
+            result = self.collection.update_one(condition, {"$set": {"data": value}, "$inc": {"version": 1}})
+        except pymongo.errors.PyMongoError as e:
+            self.breaker.record_failure(e)
+            raise DatabaseUnavailableError(str(e)) from e
+        return result.matched_count == 1
+
+    def get(self, key, default=None):
+        document = self._read(lambda: self.collection.find_one({"_id": str(key)}), None)
+        if document:
+            # 'data'キーが存在しない場合も、default値を返す
+            return document.get("data", default)
+        return default
+
+    def set(self, key, value):
+        self._write([("set", key, value)])
+
+    def delete(self, key):
+        if self._pending_writes or not self._available():
+            # 障害中は削除を保留する（削除できたかはまだ分からない）
+            self._write([("delete", key)]); return False
+        result = self._read(lambda: self.collection.delete_one({"_id": str(key)}), None)
+        if result is None:
+            self._write([("delete", key)]); return False
+        return result.deleted_count > 0
+
+    def all(self) -> dict:
+        return self._scan_dict("")
+
+    def _scan_dict(self, p_str: str, projection: list | None = None) -> dict:
+        # all() / prefix() は他の読み込みと同じく、障害中は空の結果を返す
+        try:
+            return dict(self.scan(p_str, projection))
+        except DatabaseUnavailableError:
+            return {}
+
+    def prefix(self, p_str: str = "", include_data: bool = False, projection: list | None = None):
+        """_id の範囲検索でプレフィックスに一致するキーを返す。include_data=True ならデータも同じクエリで取得する"""
+        if include_data: return self._scan_dict(p_str, projection)
+        return self._read(lambda: tuple(doc["_id"] for doc in self.collection.find(_prefix_filter(p_str), {"_id": 1})), tuple())
+
+    def get_many(self, keys) -> dict:
+        """$in を使い、複数キーを1回のクエリで取得する"""
+        ids = [str(key) for key in keys]
+        if not ids: return {}
+        return self._read(lambda: {doc["_id"]: doc.get("data") for doc in self.collection.find({"_id": {"$in": ids}}) if doc.get("data") is not None}, {})
+
+    def scan(self, p_str: str = "", projection: list | None = None, batch_size: int = 100):
+        """
+        カーソルから batch_size 件ずつ受け取りながら、1件ずつ返す。
+        障害中や走査の途中で失敗した場合は DatabaseUnavailableError を送出する（途中までの結果を全件とみなさないように）。
+        """
+        if not self._available(): raise DatabaseUnavailableError("MongoDBに接続できないため、走査できません。")
+        fields = {"_id": 1} if projection is not None else None
+        if projection:
+            fields.update({f"data.{path}": 1 for path in projection})
+        try:
+            for doc in self.collection.find(_prefix_filter(p_str), fields).batch_size(batch_size):
+                yield doc["_id"], doc.get("data", {})
+        except pymongo.errors.PyMongoError as e:
+            self.breaker.record_failure(e)
+            raise DatabaseUnavailableError(str(e)) from e
+        self.breaker.record_success()
+
+    def bulk_write(self, operations: list):
+        """set / delete / $inc・$set をまとめて1回の bulk_write で送る"""
+        if operations: self._write(list(operations))
+
+    def _send_bulk(self, operations: list):
+        """
+        operations を1回の bulk_write で送る。BulkWriteError には、失敗した操作の operations 内での位置を operation_index として付ける
+        （空の update は送らないため、リクエストの位置と operations の位置は一致しない）
+        """
+        requests, positions = [], []
+        for position, (op, key, *args) in enumerate(operations):
+            # どの書き込みでも version を進め、update() 中の他の書き込みを検出できるようにする
+            if op == "set":
+                request = pymongo.UpdateOne({"_id": str(key)}, {"$set": {"data": args[0]}, "$inc": {"version": 1}}, upsert=True)
+            elif op == "delete":
+                request = pymongo.DeleteOne({"_id": str(key)})
+            elif op == "update":
+                increments, sets = args
+                if not increments and not sets: continue
+                update = {"$inc": {"version": 1}}
+                update["$inc"].update({f"data.{path}": amount for path, amount in (increments or {}).items()})
+                if sets:
+                    update["$set"] = {f"data.{path}": value for path, value in sets.items()}
+                request = pymongo.UpdateOne({"_id": str(key)}, update, upsert=True)
+            elif op == "patch":
+                if not args[0]: continue
+                request = pymongo.UpdateOne({"_id": str(key)}, {"$set": {f"data.{path}": value for path, value in args[0].items()}, "$inc": {"version": 1}})
+            else:
+                continue
+            requests.append(request); positions.append(position)
+        if not requests: return
+        try:
+            self.collection.bulk_write(requests, ordered=True)
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get("writeErrors") or []
+            if write_errors: e.operation_index = positions[write_errors[0]["index"]]
+            raise
+
+    def _rank_index(self, field: str) -> str:
+        """
+        ランキング用の (data.field 降順, _id) の複合インデックスの名前。初回はインデックスを作成する。
+        _id を含めることで、プレフィックス（ギルド）の絞り込みをインデックスのキーだけで行い、対象外のドキュメントを読まない。
+        """
+        name = f"rank_{field}"
+        if field not in self._indexed_fields:
+            self.collection.create_index([(f"data.{field}", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)], name=name)
+            self._indexed_fields.add(field)
+        return name
+
+    def _ranked_filter(self, p_str: str, field: str, minimum=0) -> dict:
+        return {**_prefix_filter(p_str), f"data.{field}": {"$gt": minimum}}
+
+    def ranked(self, p_str: str, field: str, offset: int = 0, limit: int = 10) -> list:
+        """skip はインデックスのエントリをたどるだけで、ドキュメント本体は limit 件だけ読む（offset に比例する）"""
+        def query():
+            cursor = (self.collection.find(self._ranked_filter(p_str, field))
+                      .sort([(f"data.{field}", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)])
+                      .hint(self._rank_index(field)).skip(offset).limit(limit))
+            return [(doc["_id"], doc.get("data", {})) for doc in cursor]
+        return self._read(query, [])
+
+    def count_ranked(self, p_str: str, field: str) -> int:
+        """インデックスのエントリだけで数える（件数に比例する）"""
+        return self._read(lambda: self.collection.count_documents(self._ranked_filter(p_str, field), hint=self._rank_index(field)), 0)
+
+    def rank_of(self, p_str: str, field: str, key) -> tuple | None:
+        """自分より値が大きいエントリをインデックス上で数える（ドキュメントは読まないが、順位に比例する）"""
+        score = _get_path(self.get(key, {}), field)
+        if not isinstance(score, (int, float)) or score <= 0: return None
+        higher = self._read(lambda: self.collection.count_documents(self._ranked_filter(p_str, field, minimum=score), hint=self._rank_index(field)), None)
+        return None if higher is None else (higher + 1, score)
+
+# --- SQLite用の処理 ---
+# ランキング等で json_extract に渡すフィールド名として許可する形式
+_FIELD_PATTERN = re.compile(r"[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*")
+# ランキングのインデックスで、キーをギルドごとに分けるための式（末尾の数字 = ユーザーIDを除く）
+_KEY_PARTITION = "rtrim(key, '0123456789')"
+# 1回の IN (...) に渡すキーの最大数（SQLiteの変数上限より十分小さい値）
+SQLITE_IN_CHUNK = 500
+
+class SQLiteDBHandler(DatabaseHandler):
+    """
+    ローカルのSQLite（WALモード）にJSONで保存するバックエンド。単独のサーバーで動かす場合や、テスト・ベンチマーク用。
+    - キーは主キー（= プレフィックス検索用のインデックス）で、プレフィックス検索は範囲検索で行う
+    - 複数の書き込みは1トランザクションにまとめる
+    - run() は専用の1スレッドで実行されるため、イベントループをブロックしない（get / set などを直接呼ぶと、
+      ファイルの読み書きとロックの待ち時間の分だけループが止まる。コルーチンからは必ず await db.run(...) で呼ぶ）
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-db")
+        # インデックスを作成済みのランキング用フィールド
+        self._indexed_fields = set()
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+            # version 列がない古いファイルには列を追加する
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(kv)")]
+            if "version" not in columns:
+                self.conn.execute("ALTER TABLE kv ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        print(f"✅ SQLite ({path}) を使用します。")
+
+    def _prefix_where(self, p_str: str) -> tuple:
+        lower, upper = _prefix_bounds(p_str)
+        if upper is None: return "key >= ?", [lower]
+        return "key >= ? AND key < ?", [lower, upper]
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (str(key),)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        self.bulk_write([("set", key, value)])
+
+    def _read_versioned(self, key: str) -> tuple:
+        with self._lock:
+            row = self.conn.execute("SELECT value, version FROM kv WHERE key = ?", (key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (_MISSING, None)
+
+    def _write_if_version(self, key: str, value, version) -> bool:
+        # 同じファイルを別プロセスが更新していても、version の比較で競合を検出できる
+        value_json = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            if version is None:
+                cursor = self.conn.execute("INSERT INTO kv (key, value, version) VALUES (?, ?, 1) ON CONFLICT(key) DO NOTHING", (key, value_json))
+            else:
+                cursor = self.conn.execute("UPDATE kv SET value = ?, version = version + 1 WHERE key = ? AND version = ?", (value_json, key, version))
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self._lock:
+            return self.conn.execute("DELETE FROM kv WHERE key = ?", (str(key),)).rowcount > 0
+
+    def all(self) -> dict:
+        return dict(self.scan(""))
+
+    def prefix(self, p_str: str = "", include_data: bool = False, projection: list | None = None):
+        if include_data: return dict(self.scan(p_str, projection))
+        where, params = self._prefix_where(p_str)
+        with self._lock:
+            return tuple(row[0] for row in self.conn.execute(f"SELECT key FROM kv WHERE {where} ORDER BY key", params))
+
+    def get_many(self, keys) -> dict:
+        ids = [str(key) for key in keys]
+        result = {}
+        with self._lock:
+            for start in range(0, len(ids), SQLITE_IN_CHUNK):
+                chunk = ids[start:start + SQLITE_IN_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for key, value in self.conn.execute(f"SELECT key, value FROM kv WHERE key IN ({placeholders})", chunk):
+                    result[key] = json.loads(value)
+        return result
+
+    def scan(self, p_str: str = "", projection: list | None = None, batch_size: int = 100):
+        """キー順に batch_size 件ずつ読み込む。ロックは1バッチの読み込み中だけ保持する"""
+        where, params = self._prefix_where(p_str)
+        last_key = None
+        while True:
+            condition = where + (" AND key > ?" if last_key is not None else "")
+            args = params + ([last_key] if last_key is not None else []) + [batch_size]
+            with self._lock:
+                rows = self.conn.execute(f"SELECT key, value FROM kv WHERE {condition} ORDER BY key LIMIT ?", args).fetchall()
+            for key, value in rows:
+                yield key, ({} if projection == [] else _project(json.loads(value), projection))
+            if len(rows) < batch_size: return
+            last_key = rows[-1][0]
+
+    def bulk_write(self, operations: list):
+        """すべての操作を1つのトランザクションで適用する"""
+        if not operations: return
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for op, key, *args in operations:
+                    key = str(key)
+                    if op == "set":
+                        value = args[0]
+                    elif op == "delete":
+                        self.conn.execute("DELETE FROM kv WHERE key = ?", (key,)); continue
+                    elif op == "update":
+                        row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+                        value = _apply_increment(json.loads(row[0]) if row else {}, args[0], args[1])
+                    elif op == "patch":
+                        row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+                        current = json.loads(row[0]) if row else None
+                        if not isinstance(current, dict): continue
+                        value = _apply_increment(current, {}, args[0])
+                    else:
+                        continue
+                    self.conn.execute("INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value, version = kv.version + 1", (key, json.dumps(value, ensure_ascii=False)))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _field_expr(self, field: str) -> str:
+        """
+        ランキング用の式を返す。初回は (キーの末尾の数字を除いた部分, 式 降順, key) のインデックスを作成する。
+        activity_<guild_id>_<user_id> のキーは、末尾の数字を除くと activity_<guild_id>_ になり、ギルドごとに分かれた索引になる。
+        """
+        if not _FIELD_PATTERN.fullmatch(field):
+            raise ValueError(f"不正なフィールド名です: {field}")
+        expr = f"json_extract(value, '$.{field}')"
+        if field not in self._indexed_fields:
+            name = field.replace('.', '_')
+            with self._lock:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_rank_part_{name} ON kv ({_KEY_PARTITION}, {expr} DESC, key)")
+                # 以前の、式だけのインデックスはギルドの絞り込みに使えないため削除する
+                self.conn.execute(f"DROP INDEX IF EXISTS idx_rank_{name}")
+            self._indexed_fields.add(field)
+        return expr
+
+    def _ranked_where(self, p_str: str) -> tuple:
+        """
+        ランキング用の絞り込み。p_str が数字で終わらない場合（activity_<guild_id>_ など）は、
+        末尾が数字のキーだけを対象にしてインデックスのギルドの区切りで絞り込む。
+        その場合の計算量は O(log n + そのギルドの中でたどる件数)（offset・順位・件数に比例し、他のギルドの件数にはよらない）。
+        """
+        where, params = self._prefix_where(p_str)
+        if p_str and not p_str[-1].isdigit():
+            return f"{_KEY_PARTITION} = ? AND {where}", [p_str] + params
+        return where, params
+
+    def ranked(self, p_str: str, field: str, offset: int = 0, limit: int = 10) -> list:
+        expr = self._field_expr(field)
+        where, params = self._ranked_where(p_str)
+        with self._lock:
+            # OFFSET 分はインデックスだけをたどり、value は返す行だけ読む
+            rows = self.conn.execute(
+                f"SELECT kv.key, kv.value FROM (SELECT key FROM kv WHERE {where} AND {expr} > 0 ORDER BY {expr} DESC, key LIMIT ? OFFSET ?) AS page "
+                f"JOIN kv USING (key) ORDER BY {expr} DESC, kv.key",
+                params + [limit, offset]).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def count_ranked(self, p_str: str, field: str) -> int:
+        expr = self._field_expr(field)
+        where, params = self._ranked_where(p_str)
+        with self._lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM kv WHERE {where} AND {expr} > 0", params).fetchone()[0]
+
+    def rank_of(self, p_str: str, field: str, key) -> tuple | None:
+        expr = self._field_expr(field)
+        score = _get_path(self.get(key, {}), field)
+        if not isinstance(score, (int, float)) or score <= 0: return None
+        where, params = self._ranked_where(p_str)
+        with self._lock:
+            higher = self.conn.execute(f"SELECT COUNT(*) FROM kv WHERE {where} AND {expr} > ?", params + [score]).fetchone()[0]
+        return higher + 1, score
+
+def _create_handler() -> DatabaseHandler:
+    """config.DB_BACKEND に応じてデータベースのバックエンドを選ぶ"""
+    if config.DB_BACKEND == "replit":
+        print("INFO: Replit DBを使用します。")
+        return ReplitDBHandler()
+    if config.DB_BACKEND == "sqlite":
+        print("INFO: SQLiteを使用します。")
+        return SQLiteDBHandler(config.SQLITE_PATH)
+    print("INFO: MongoDBを使用します。")
+    return MongoDBHandler()
 
-        def set(self, key, value):
-            if not self.client: return
-            self.collection.update_one({"_id": str(key)}, {"$set": {"data": value}}, upsert=True)
-
-        def delete(self, key):
-            if not self.client: return False
-            result = self.collection.delete_one({"_id": str(key)})
-            return result.deleted_count > 0
-
-        def all(self) -> dict:
-            if not self.client: return {}
-             # 'data'キーが存在しないドキュメントも考慮
-            return {doc["_id"]: doc.get("data", {}) for doc in self.collection.find({})}
-
-        def prefix(self, p_str: str = "") -> tuple:
-            if not self.client: return tuple()
-            return tuple(doc["_id"] for doc in self.collection.find({"_id": {"$regex": f"^{p_str}"}}))
-        # ★★★★★ ここまで修正 ★★★★★
-            
-    db = MongoDBHandler()
+db = _create_handler()
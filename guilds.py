@@ -0,0 +1,116 @@
+"""
+ギルド（サーバー）ごとのデータの分け方と、ギルドごとの設定。
+
+1つのボットで複数のクランのサーバーを扱えるよう、データはギルドごとに別のキーに保存する。
+    active_events_<guild_id> / completed_shuffles_<guild_id> / active_assignments_<guild_id> / shift_schedules_<guild_id>
+    activity_<guild_id>_<user_id> / profile_<guild_id>_<user_id> / trial_<guild_id>_<user_id>
+    management_<guild_id> / guild_config_<guild_id>
+
+チャンネルやロールのIDは guild_config_<guild_id> に保存し、/config コマンドで設定する。
+設定がない項目は、以前からのギルド（config.GUILD_ID）に限り環境変数の値を使う。
+"""
+import config
+from db_handler import db
+
+# ギルドごとの設定項目 { 項目名: (環境変数名, 種類, 説明) }
+SETTINGS = {
+    "role_select_channel_id": ("ROLE_SELECT_CHANNEL_ID", "channel", "ロール選択パネルのチャンネル"),
+    "result_channel_id": ("RESULT_CHANNEL_ID", "channel", "合否結果の送信先チャンネル"),
+    "main_channel_id": ("MAIN_CHANNEL_ID", "channel", "メインチャンネル"),
+    "trial_channel_id": ("TRIAL_CHANNEL_ID", "channel", "体験加入のチャンネル"),
+    "evaluation_channel_id": ("EVALUATION_CHANNEL_ID", "channel", "体験者の評価用チャンネル"),
+    "report_channel_id": ("REPORT_CHANNEL_ID", "channel", "体験期間の通知先チャンネル"),
+    "lazy_life_role_id": ("LAZY_LIFE_ROLE_ID", "role", "lazy join で付与するロール"),
+    "clan_member_role_id": ("CLAN_MEMBER_ROLE_ID", "role", "クランメンバーのロール"),
+    "trial_role_id": ("TRIAL_ROLE_ID", "role", "体験メンバーのロール"),
+    "non_trial_role_id": ("NON_TRIAL_ROLE_ID", "role", "体験の対象外（お手伝い）のロール"),
+    "staff_role_id": ("STAFF_ROLE_ID", "role", "スタッフのロール"),
+    "post_trial_role_id": ("POST_TRIAL_ROLE_ID", "role", "合格後に付与するロール"),
+    "shuffle_vc_category_id": ("SHUFFLE_VC_CATEGORY_ID", "category", "チーム分けのVCを作成するカテゴリ"),
+}
+
+# 設定ドキュメントのキャッシュ { guild_id: {項目名: ID} }
+# ギルドのイベントは1つのプロセスにしか届かず、設定の変更もそのプロセスで行われるため、プロセス内のキャッシュで足りる
+_config_cache = {}
+
+def key(name: str, guild_id: int, user_id: int | str | None = None) -> str:
+    """ギルドごと（user_id を渡した場合はギルド内のユーザーごと）のDBキー"""
+    return f"{name}_{guild_id}" if user_id is None else f"{name}_{guild_id}_{user_id}"
+
+def _load_config(guild_id: int) -> dict:
+    guild_id = int(guild_id)
+    if guild_id not in _config_cache:
+        stored = db.get(key("guild_config", guild_id), {})
+        _config_cache[guild_id] = stored if isinstance(stored, dict) else {}
+    return _config_cache[guild_id]
+
+def setting(guild_id: int, name: str) -> int | None:
+    """ギルドの設定値（チャンネルやロールのID）。未設定なら None"""
+    value = _load_config(guild_id).get(name)
+    if value is None and config.GUILD_ID and int(guild_id) == config.GUILD_ID:
+        value = getattr(config, SETTINGS[name][0])
+    return value
+
+def role(guild, name: str):
+    """設定されたIDのロール。未設定か、ギルドに見つからない場合は None"""
+    role_id = setting(guild.id, name)
+    return guild.get_role(role_id) if role_id else None
+
+def channel(guild, name: str):
+    """設定されたIDのチャンネル（カテゴリを含む）。未設定か、ギルドに見つからない場合は None"""
+    channel_id = setting(guild.id, name)
+    return guild.get_channel(channel_id) if channel_id else None
+
+def settings(guild_id: int) -> dict:
+    """全項目の { 項目名: (値, 環境変数の値を使っているか) }"""
+    stored, result = _load_config(guild_id), {}
+    for name in SETTINGS:
+        value = setting(guild_id, name)
+        result[name] = (value, value is not None and stored.get(name) is None)
+    return result
+
+async def set_setting(guild_id: int, name: str, value: int | None):
+    """設定値を保存する。value が None なら設定を消す（環境変数の値に戻る）"""
+    if name not in SETTINGS: raise KeyError(name)
+    def apply(stored):
+        if value is None: stored.pop(name, None)
+        else: stored[name] = value
+    _config_cache[int(guild_id)] = await db.run(db.update, key("guild_config", guild_id), apply, {})
+
+# --- 以前の形式（ギルドで分けていないキー）からの移行 ---
+MIGRATION_TRACKER_KEY = "_internal_migrations"
+# ギルドごとに1つのキーにまとめていたデータ
+_LEGACY_GUILD_KEYS = ("active_events", "completed_shuffles", "active_assignments", "shift_schedules")
+# ユーザーごとのキー（<name>_<user_id>）
+_LEGACY_USER_PREFIXES = ("activity", "profile", "trial")
+
+def migrate_legacy_keys(guild_id: int, batch_size: int = 500) -> int:
+    """
+    ギルドで分けていなかった以前のキーを、guild_id のギルドのキーに移す（移したキーの数を返す）。
+    以前は1つのギルドだけを扱っていたため、全てのデータを config.GUILD_ID のものとみなす。完了したら記録し、2回目以降は何もしない。
+    """
+    tracker = db.get(MIGRATION_TRACKER_KEY, {})
+    if tracker.get("guild_partition"): return 0
+    moved, operations = 0, []
+    for name in _LEGACY_GUILD_KEYS:
+        value = db.get(name)
+        if value is None: continue
+        new_key = key(name, guild_id)
+        # 移行前に新しいキーへの書き込みがあった場合は、そちらを優先して足りない分だけ補う
+        current = db.get(new_key)
+        if isinstance(current, dict) and isinstance(value, dict): value = {**value, **current}
+        operations += [("set", new_key, value), ("delete", name)]; moved += 1
+    if operations: db.bulk_write(operations)
+    for name in _LEGACY_USER_PREFIXES:
+        # 以前のキーは <name>_<user_id>、新しいキーは <name>_<guild_id>_<user_id> で、区切りの数で見分ける
+        # 走査中にキーを書き換えないよう、先に対象のキーだけを集めてから batch_size 件ずつ移す
+        legacy = [old_key for old_key, _ in db.scan(f"{name}_", projection=[], batch_size=batch_size) if old_key[len(name) + 1:].isdigit()]
+        for i in range(0, len(legacy), batch_size):
+            values = db.get_many(legacy[i:i + batch_size])
+            operations = []
+            for old_key, value in values.items():
+                operations += [("set", key(name, guild_id, old_key[len(name) + 1:]), value), ("delete", old_key)]
+            db.bulk_write(operations); moved += len(values)
+    tracker["guild_partition"] = True
+    db.set(MIGRATION_TRACKER_KEY, tracker)
+    return moved
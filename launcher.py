@@ -0,0 +1,161 @@
+"""
+ボットを複数のプロセス（クラスター）に分けて起動し、監視するスーパーバイザー。
+
+    python launcher.py --shards 4 --clusters 2
+
+全シャードをクラスターごとに分け、各クラスターを main.py の別プロセスとして起動する。
+プロセスごとに SHARD_COUNT / SHARD_IDS / CLUSTER_ID / CLUSTER_COUNT と、Webサーバーのポート（PORT = 基準ポート + クラスター番号）を設定する。
+各プロセスの /health を定期的に確認し、終了したプロセスや、応答しない・ゲートウェイに接続できないプロセスを再起動する。
+
+クラスターをまたいで同じデータを読み書きするため、DBは複数プロセスから共有できるもの（mongo / ファイルの sqlite）を使うこと。
+"""
+import os
+import sys
+import signal
+import asyncio
+import argparse
+import aiohttp
+import config
+import sharding
+
+# Discord のログイン（IDENTIFY）はシャードごとに約5秒の間隔が必要なため、クラスターの起動をずらす
+IDENTIFY_INTERVAL_SECONDS = 5
+# 再起動を繰り返す場合の待ち時間の上限（秒）
+MAX_RESTART_BACKOFF_SECONDS = 300
+
+class Cluster:
+    def __init__(self, cluster_id: int, shard_ids: list[int], port: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.port = port
+        self.process = None
+        self.started_at = 0.0
+        self.failures = 0   # 連続したヘルスチェックの失敗回数
+        self.restarts = 0   # 連続した再起動の回数（正常に動き始めたら0に戻す）
+        self.restarting = None  # 再起動中のタスク
+
+    @property
+    def name(self) -> str:
+        return f"クラスター{self.cluster_id} (シャード {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+def _check_backend(cluster_count: int):
+    """複数プロセスで共有できないDBの設定で起動しない"""
+    if cluster_count <= 1: return
+    if config.DB_BACKEND == "replit":
+        # ReplitDBHandler はプロセス内に値を保持する（ミラー）ため、他のプロセスの書き込みが見えない
+        sys.exit("❌ DB_BACKEND=replit は複数プロセスでは使えません。mongo か sqlite を使ってください。")
+    if config.DB_BACKEND == "sqlite" and config.SQLITE_PATH == ":memory:":
+        sys.exit("❌ SQLITE_PATH=:memory: は複数プロセスで共有できません。ファイルのパスを指定してください。")
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        base_port = args.base_port or int(os.getenv("PORT", 8080))
+        self.clusters = [Cluster(cluster_id, shard_ids, base_port + cluster_id) for cluster_id, shard_ids in enumerate(sharding.split_shards(args.shards, args.clusters))]
+        self.stopping = False
+
+    async def start(self, cluster: Cluster):
+        env = dict(os.environ,
+                   SHARD_COUNT=str(self.args.shards),
+                   SHARD_IDS=",".join(map(str, cluster.shard_ids)),
+                   CLUSTER_ID=str(cluster.cluster_id),
+                   CLUSTER_COUNT=str(len(self.clusters)),
+                   PORT=str(cluster.port))
+        cluster.process = await asyncio.create_subprocess_exec(sys.executable, self.args.main, env=env)
+        cluster.started_at = asyncio.get_running_loop().time()
+        cluster.failures = 0
+        print(f"🚀 {cluster.name} を起動しました。(PID: {cluster.process.pid}, ポート: {cluster.port})")
+
+    async def stop(self, cluster: Cluster):
+        process = cluster.process
+        if process is None or process.returncode is not None: return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.args.stop_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {cluster.name} が終了しないため、強制終了します。")
+            process.kill()
+            await process.wait()
+
+    def schedule_restart(self, cluster: Cluster, reason: str):
+        # 再起動の待ち時間の間も、他のクラスターの監視は続ける
+        cluster.restarting = asyncio.create_task(self.restart(cluster, reason))
+
+    async def restart(self, cluster: Cluster, reason: str):
+        # すぐに落ち続ける場合に Discord へのログインを繰り返さないよう、待ち時間を倍々に延ばす
+        delay = min(MAX_RESTART_BACKOFF_SECONDS, IDENTIFY_INTERVAL_SECONDS * len(cluster.shard_ids) * 2 ** cluster.restarts)
+        cluster.restarts += 1
+        print(f"🔁 {cluster.name} を再起動します（{reason}）。{delay}秒後に起動します。")
+        await self.stop(cluster)
+        await asyncio.sleep(delay)
+        if not self.stopping: await self.start(cluster)
+        cluster.restarting = None
+
+    async def check(self, session: aiohttp.ClientSession, cluster: Cluster):
+        """1つのクラスターの状態を確認し、必要なら再起動する"""
+        if cluster.process.returncode is not None:
+            return self.schedule_restart(cluster, f"終了コード {cluster.process.returncode}")
+        uptime = asyncio.get_running_loop().time() - cluster.started_at
+        try:
+            async with session.get(f"http://127.0.0.1:{cluster.port}/health", timeout=aiohttp.ClientTimeout(total=self.args.health_timeout)) as response:
+                # DBの障害（503）ではプロセスを再起動しても直らないため、ゲートウェイへの接続だけを見る
+                status = await response.json()
+            healthy = status.get("bot", {}).get("ready", False) or uptime < self.args.startup_grace
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            # 起動直後はまだWebサーバーが立ち上がっていない
+            healthy = uptime < self.args.startup_grace
+        if healthy:
+            cluster.failures = 0
+            if uptime >= self.args.startup_grace: cluster.restarts = 0
+            return
+        cluster.failures += 1
+        print(f"⚠️ {cluster.name} のヘルスチェックに失敗しました。({cluster.failures}/{self.args.max_failures})")
+        if cluster.failures >= self.args.max_failures:
+            self.schedule_restart(cluster, "ヘルスチェックの失敗")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try: loop.add_signal_handler(sig, self.request_stop)
+            except NotImplementedError: pass
+        print(f"📦 {self.args.shards}シャードを{len(self.clusters)}プロセスで起動します。")
+        for i, cluster in enumerate(self.clusters):
+            if i: await asyncio.sleep(IDENTIFY_INTERVAL_SECONDS * len(self.clusters[i - 1].shard_ids))
+            if self.stopping: break
+            await self.start(cluster)
+        async with aiohttp.ClientSession() as session:
+            while not self.stopping:
+                await asyncio.sleep(self.args.health_interval)
+                if self.stopping: break
+                await asyncio.gather(*(self.check(session, cluster) for cluster in self.clusters if cluster.process is not None and cluster.restarting is None))
+        for cluster in self.clusters:
+            if cluster.restarting is not None: cluster.restarting.cancel()
+        await asyncio.gather(*(self.stop(cluster) for cluster in self.clusters))
+        print("🛑 全てのクラスターを停止しました。")
+
+    def request_stop(self):
+        if not self.stopping: print("🛑 停止しています...")
+        self.stopping = True
+
+def main():
+    parser = argparse.ArgumentParser(description="ボットを複数プロセスに分けて起動・監視する")
+    parser.add_argument("--shards", type=int, required=True, help="全体のシャード数")
+    parser.add_argument("--clusters", type=int, default=None, help="プロセス数（デフォルト: CPUコア数とシャード数の小さい方）")
+    parser.add_argument("--base-port", type=int, default=None, help="クラスター0のWebサーバーのポート（デフォルト: PORT または 8080）")
+    parser.add_argument("--main", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), help="起動するスクリプト")
+    parser.add_argument("--health-interval", type=float, default=15, help="ヘルスチェックの間隔（秒）")
+    parser.add_argument("--health-timeout", type=float, default=5, help="ヘルスチェックの応答の待ち時間（秒）")
+    parser.add_argument("--startup-grace", type=float, default=120, help="起動直後にヘルスチェックの失敗を無視する時間（秒）")
+    parser.add_argument("--max-failures", type=int, default=3, help="この回数続けてヘルスチェックに失敗したら再起動する")
+    parser.add_argument("--stop-timeout", type=float, default=15, help="停止を要求してから強制終了するまでの時間（秒）")
+    args = parser.parse_args()
+    args.clusters = args.clusters or min(os.cpu_count() or 1, args.shards)
+    try:
+        sharding.split_shards(args.shards, args.clusters)
+    except ValueError as e:
+        parser.error(str(e))
+    _check_backend(args.clusters)
+    asyncio.run(Supervisor(args).run())
+
+if __name__ == "__main__":
+    main()
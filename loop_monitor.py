@@ -0,0 +1,104 @@
+"""
+イベントループの停止（ブロッキング処理）を検出する監視機能。
+
+- ハートビート: ループ上のコルーチンが一定間隔で時刻を更新し、その遅れをループ遅延として metrics に記録する
+- ウォッチドッグ: 別スレッドがハートビートの更新を監視し、閾値を超えて止まっていたら、
+  その時点のループスレッドのスタックを取得して「どのCogのどの関数で止まっているか」を記録する
+
+通常時はハートビートとスレッドの短いスリープだけで動くため、本番環境で常時有効にしておける。
+スタックの取得は停止を検出したときだけ行い、ログは同じ場所ごとに一定間隔に1回だけ出す。
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+import config
+import metrics
+
+# ハートビートの間隔（秒）
+HEARTBEAT_INTERVAL_SECONDS = 0.1
+# 直近の停止として保持する件数
+RECENT_STALLS_SIZE = 20
+
+SLOW_CALLBACKS = metrics.Counter("clanbot_loop_stalls_total", "イベントループを閾値以上止めた処理の回数", ("location",))
+
+_PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+_IGNORED_FILES = {os.path.join(_PROJECT_ROOT, name) for name in ("loop_monitor.py", "main.py")}
+
+def find_culprit(stack: traceback.StackSummary) -> str:
+    """
+    スタックの中から、原因とみなすこのボット内のフレームを選ぶ。
+    cogs/ 内のフレームを優先し、なければボット内のいずれかのフレーム、それもなければ最も内側のフレームを返す。
+    """
+    own_frames = [f for f in stack if f.filename.startswith(_PROJECT_ROOT) and f.filename not in _IGNORED_FILES]
+    cog_frames = [f for f in own_frames if os.sep + "cogs" + os.sep in f.filename]
+    frame = (cog_frames or own_frames or list(stack) or [None])[-1]
+    if frame is None: return "unknown"
+    return f"{os.path.relpath(frame.filename, _PROJECT_ROOT) if frame.filename.startswith(_PROJECT_ROOT) else os.path.basename(frame.filename)}:{frame.name}"
+
+class LoopMonitor:
+    def __init__(self, threshold: float, log_interval: float, interval: float = HEARTBEAT_INTERVAL_SECONDS):
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.interval = interval
+        # 直近の停止 {"location", "blocked_seconds", "stack", "at"}（/debug などで参照する）
+        self.recent_stalls = deque(maxlen=RECENT_STALLS_SIZE)
+        self._last_beat = time.monotonic()
+        self._beat = 0
+        self._reported_beat = -1
+        self._last_logged = {}   # { location: 最後にログを出した時刻 }
+        self._suppressed = {}    # { location: ログを省略した回数 }
+        self._loop_thread_id = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """実行中のイベントループで監視を始める（setup_hook などから呼ぶ）"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        print(f"✅ イベントループの監視を開始しました（閾値: {self.threshold * 1000:.0f}ms）。")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task: self._task.cancel()
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            metrics.LOOP_LAG.observe(max(0.0, loop.time() - started - self.interval))
+            self._last_beat = time.monotonic()
+            self._beat += 1
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            blocked = time.monotonic() - self._last_beat
+            # 1回の停止につき、スタックを取得するのは最初に検出したときだけ
+            if blocked >= self.threshold and self._reported_beat != self._beat:
+                self._reported_beat = self._beat
+                self._capture(blocked)
+
+    def _capture(self, blocked: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None: return
+        stack = traceback.extract_stack(frame)
+        location = find_culprit(stack)
+        SLOW_CALLBACKS.inc(location=location)
+        self.recent_stalls.append({"location": location, "blocked_seconds": round(blocked, 3), "stack": "".join(stack.format()), "at": time.time()})
+
+        now = time.monotonic()
+        if now - self._last_logged.get(location, -self.log_interval) < self.log_interval:
+            self._suppressed[location] = self._suppressed.get(location, 0) + 1
+            return
+        self._last_logged[location] = now
+        suppressed = self._suppressed.pop(location, 0)
+        note = f"（前回のログ以降に同じ場所で {suppressed} 回）" if suppressed else ""
+        print(f"⚠ イベントループが {blocked * 1000:.0f}ms 以上止まっています: {location}{note}\n" + "".join(stack.format()[-8:]))
+
+monitor = LoopMonitor(config.LOOP_STALL_THRESHOLD_MS / 1000, config.LOOP_STALL_LOG_INTERVAL)
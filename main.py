@@ -1,43 +1,218 @@
+import time
+# 起動時間の計測の基準（import にかかる時間も含めるため、他のモジュールより先に記録する）
+PROCESS_STARTED = time.perf_counter()
 import os
+import json
+import hmac
 import asyncio
+import signal
+import hashlib
 import discord
+from discord import app_commands
 from discord.ext import commands
 import config
+import metrics
+import loop_monitor
+import profiler
+import sharding
+import guilds
+import member_cache
+from message_router import router
 from aiohttp import web
+from db_handler import db, DatabaseUnavailableError
 
-class MyBot(commands.Bot):
+class InstrumentedCommandTree(app_commands.CommandTree):
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        # 失敗したコマンドも所要時間を記録してから、通常のエラー処理に渡す
+        command = interaction.command.qualified_name if interaction.command else "unknown"
+        metrics.COMMAND_LATENCY.observe(_elapsed_since(interaction), command=command, status="error")
+        await super().on_error(interaction, error)
+
+def _elapsed_since(interaction: discord.Interaction) -> float:
+    """Discord上でインタラクションが作られてから現在までの秒数（ユーザーが体感する待ち時間）"""
+    return max(0.0, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+
+# SHARD_COUNT が設定されている場合は、このプロセスが担当するシャード（SHARD_IDS）だけに接続する
+_BotBase = commands.AutoShardedBot if config.SHARD_COUNT else commands.Bot
+
+class MyBot(_BotBase):
     def __init__(self):
         intents = discord.Intents.default()
         intents.members = True
         intents.message_content = True
-        super().__init__(command_prefix='!', intents=intents)
+        shard_options = {"shard_count": config.SHARD_COUNT, "shard_ids": config.SHARD_IDS} if config.SHARD_COUNT else {}
+        # コマンドは全ギルド共通（グローバル）に登録し、DMでは使えないようにする
+        super().__init__(command_prefix='!', intents=intents, tree_cls=InstrumentedCommandTree, allowed_contexts=app_commands.AppCommandContext(guild=True, dm_channel=False, private_channel=False), **shard_options, **member_cache.bot_options())
+        metrics.GATEWAY_LATENCY.set_function(lambda: self.latency)
+        metrics.CACHED_MEMBERS.set_function(lambda: sum(len(guild.members) for guild in self.guilds))
+        # 起動処理の各段階の所要時間（秒）と、Cogごとの読み込み時間
+        self.startup_phases = {"import": time.perf_counter() - PROCESS_STARTED}
+        self.cog_load_times = {}
+        self._phase_started = time.perf_counter()
+        self._startup_reported = False
+
+    def _end_phase(self, name: str):
+        now = time.perf_counter()
+        self.startup_phases[name] = now - self._phase_started
+        metrics.STARTUP_PHASE.set(self.startup_phases[name], phase=name)
+        self._phase_started = now
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        # リスナーごとの実行時間を記録する（どのCogが時間を使っているかを /metrics で見られるようにする）
+        started = time.perf_counter()
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            handler = getattr(coro, "__qualname__", event_name)
+            metrics.LISTENER_LATENCY.observe(time.perf_counter() - started, event=event_name, handler=handler)
+
+    async def on_message(self, message: discord.Message):
+        # Cogごとのリスナーではなく、ここで1回だけ受け取って各Cogのハンドラーに振り分ける
+        await router.dispatch(message)
+        await self.process_commands(message)
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        metrics.COMMAND_LATENCY.observe(_elapsed_since(interaction), command=command.qualified_name, status="ok")
 
     async def setup_hook(self):
+        # ここまでが Discord へのログイン（HTTP）の時間
+        self._end_phase("login")
+        # ループ遅延の計測と、ループを止めている処理の検出を始める
+        loop_monitor.monitor.start()
+        # ギルドで分けていなかった以前のデータを、Cogが読み込む前に GUILD_ID のギルドのキーへ移す
+        if sharding.is_primary() and config.GUILD_ID:
+            try:
+                moved = await db.run(guilds.migrate_legacy_keys, config.GUILD_ID)
+                if moved: print(f"🔀 以前のデータ {moved}件を、ギルド({config.GUILD_ID})のデータとして移行しました。")
+            except DatabaseUnavailableError as e:
+                # 完了を記録していないため、次回の起動時にやり直す
+                print(f"❌ 以前のデータの移行に失敗しました（次回の起動時に再試行します）: {e}")
         print("📦 Cogを読み込んでいます...")
-        for filename in os.listdir('./cogs'):
-            if filename.endswith('.py') and not filename.startswith('_'):
-                try:
-                    await self.load_extension(f'cogs.{filename[:-3]}')
-                    print(f'✅ Loaded: {filename}')
-                except Exception as e:
-                    print(f'❌ Failed to load {filename}: {type(e).__name__}: {e}')
+        names = sorted(filename[:-3] for filename in os.listdir('./cogs') if filename.endswith('.py') and not filename.startswith('_'))
+        # 各Cogは互いに依存しないため、並行して読み込む（setup 内のDB読み込みを待つ間に次のCogを読み込める）
+        await asyncio.gather(*(self._load_cog(name) for name in names))
+        self._end_phase("cogs")
+        # コマンドの登録はギルドごとではなくボット全体で1回でよいため、クラスター0だけが行う
+        if sharding.is_primary():
+            try:
+                await self._sync_commands()
+            except Exception as e:
+                print(f"❌ コマンド同期に失敗: {e}")
+        self._end_phase("command_sync")
+
+    async def add_cog(self, cog: commands.Cog, /, **kwargs):
+        await super().add_cog(cog, **kwargs)
+        # ヘルプの索引を作り直す（HelpCog.on_cogs_changed）
+        self.dispatch("cogs_changed")
+
+    async def remove_cog(self, name: str, /, **kwargs):
+        cog = await super().remove_cog(name, **kwargs)
+        if cog is not None: self.dispatch("cogs_changed")
+        return cog
+
+    async def _load_cog(self, name: str):
+        started = time.perf_counter()
         try:
-            guild = discord.Object(id=config.GUILD_ID)
-            self.tree.copy_global_to(guild=guild)
-            synced = await self.tree.sync(guild=guild)
-            print(f"📡 {len(synced)}個のコマンドをギルド({config.GUILD_ID})に同期しました。")
+            await self.load_extension(f'cogs.{name}')
+            self.cog_load_times[name] = time.perf_counter() - started
+            print(f'✅ Loaded: {name}.py ({self.cog_load_times[name] * 1000:.0f}ms)')
         except Exception as e:
-            print(f"❌ コマンド同期に失敗: {e}")
+            print(f'❌ Failed to load {name}.py: {type(e).__name__}: {e}')
+
+    async def _sync_commands(self):
+        """
+        コマンドツリーのハッシュが前回の同期時と同じなら、同期（Discord API の呼び出し）を省略する。
+        同期はレート制限が厳しく、起動のたびに行うと再起動が続いたときに待たされるため。
+        """
+        payload = sorted((command.to_dict(self.tree) for command in self.tree.get_commands()), key=lambda c: (c.get("type", 1), c["name"]))
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        hash_key = "_internal_command_tree_hash"
+        if not config.FORCE_COMMAND_SYNC and await db.run(db.get, hash_key) == digest:
+            print("📡 コマンドに変更がないため、同期を省略しました。")
+            return
+        synced = await self.tree.sync()
+        await db.run(db.set, hash_key, digest)
+        print(f"📡 {len(synced)}個のコマンドを全ギルド共通で同期しました。")
+        # 以前は GUILD_ID のギルド専用にコマンドを登録していたため、二重に表示されないよう一度だけ削除する
+        # （このツリーにはギルド専用のコマンドがないため、ギルドへの同期で登録済みのものが消える）
+        tracker = await db.run(db.get, guilds.MIGRATION_TRACKER_KEY, {})
+        if config.GUILD_ID and not tracker.get("guild_commands_cleared"):
+            await self.tree.sync(guild=discord.Object(id=config.GUILD_ID))
+            await db.run(db.update, guilds.MIGRATION_TRACKER_KEY, lambda stored: stored.update(guild_commands_cleared=True), {})
+            await db.run(db.delete, f"_internal_command_tree_hash_{config.GUILD_ID}")
+            print(f"📡 ギルド({config.GUILD_ID})専用に登録していたコマンドを削除しました。")
+
+    def _print_startup_report(self):
+        print("⏱️ 起動時間:")
+        for phase, seconds in self.startup_phases.items():
+            print(f"   {phase:<14}{seconds * 1000:8.0f}ms")
+        print(f"   {'total':<14}{sum(self.startup_phases.values()) * 1000:8.0f}ms")
+        slowest = sorted(self.cog_load_times.items(), key=lambda item: item[1], reverse=True)[:3]
+        if slowest: print("   遅いCog: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in slowest))
 
     async def on_ready(self):
         print("----------------------------------------")
         print(f"✅ {self.user} としてログインしました！")
         print(f"   (ID: {self.user.id})")
+        if config.SHARD_COUNT:
+            print(f"   クラスター {config.CLUSTER_ID}/{config.CLUSTER_COUNT} ・ シャード {sorted(self.shards)} / 全{self.shard_count}")
         print("----------------------------------------")
+        # on_ready は再接続のたびに呼ばれるため、起動時間の報告は最初の1回だけ
+        if not self._startup_reported:
+            self._startup_reported = True
+            self._end_phase("gateway_ready")
+            self._print_startup_report()
+
+    async def on_guild_available(self, guild: discord.Guild):
+        # tracked: 追跡対象のメンバーを後からキャッシュする（再接続でギルドが使えるようになるたびに呼ばれる）
+        if config.MEMBER_CACHE_POLICY == "tracked": asyncio.create_task(self._warm_members(guild))
+
+    async def on_guild_join(self, guild: discord.Guild):
+        if config.MEMBER_CACHE_POLICY == "tracked": asyncio.create_task(self._warm_members(guild))
+
+    async def _warm_members(self, guild: discord.Guild):
+        try:
+            await member_cache.warm(guild)
+        except Exception as e:
+            print(f"⚠️ {guild.name}: メンバーのキャッシュに失敗しました: {e}")
 
-async def start_web_server():
+async def health(request):
+    # DBが障害中（サーキットブレーカーが open）の場合は 503 を返す
+    status = db.health()
+    bot = request.app["bot"]
+    # launcher.py はこの情報で、プロセスがゲートウェイに接続できているかを確認する
+    status["bot"] = {"ready": bot.is_ready(), "cluster_id": config.CLUSTER_ID, "shard_ids": config.SHARD_IDS, "shard_count": config.SHARD_COUNT, "guilds": len(bot.guilds)}
+    return web.json_response(status, status=503 if status.get("state") == "open" else 200)
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def debug_profile(request):
+    """
+    /debug/profile?seconds=10&mode=sampling&output=report
+    output=raw で詳細（collapsed stack / pstats のテキスト）をそのまま返す
+    """
+    if not config.DEBUG_TOKEN: raise web.HTTPNotFound()
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token, config.DEBUG_TOKEN): raise web.HTTPUnauthorized()
+    try:
+        seconds = int(request.query.get("seconds", 10))
+        result = await profiler.profile(seconds, request.query.get("mode", "sampling"))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except profiler.ProfilerBusyError as e:
+        raise web.HTTPConflict(text=str(e))
+    if request.query.get("output") == "raw":
+        return web.Response(body=result.attachment, content_type="text/plain", charset="utf-8", headers={"Content-Disposition": f'attachment; filename="{result.filename}"'})
+    return web.Response(text=result.report, content_type="text/plain", charset="utf-8")
+
+async def start_web_server(bot: MyBot):
     app = web.Application()
+    app["bot"] = bot
     app.router.add_get('/', lambda r: web.Response(text="Bot is alive!"))
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/debug/profile', debug_profile)
     runner = web.AppRunner(app)
     await runner.setup()
     port = os.getenv("PORT", 8080)
@@ -48,10 +223,16 @@ async def start_web_server():
 
 async def main():
     bot = MyBot()
-    await asyncio.gather(
-        bot.start(config.BOT_TOKEN),
-        start_web_server()
-    )
+    # 停止時（ランチャーからの SIGTERM も含む）は bot.close() で Cog をアンロードし、未反映の活動記録などを書き込んでから終了する
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, lambda: asyncio.create_task(bot.close()))
+        except NotImplementedError: pass
+    web_server = asyncio.create_task(start_web_server(bot))
+    try:
+        await bot.start(config.BOT_TOKEN)
+    finally:
+        web_server.cancel()
 
 if __name__ == '__main__':
     if not os.path.exists('./cogs'):
@@ -0,0 +1,183 @@
+"""
+メンバーのキャッシュ方針（config.MEMBER_CACHE_POLICY）と、方針によらず使えるメンバーの取得処理。
+
+大きなサーバーで全メンバーをキャッシュすると、メモリと起動時間がメンバー総数に比例して増える。
+tracked / lazy では起動時の全メンバー取得（チャンク）を行わず、Cog は guild.get_member や role.members の代わりに
+ここの関数を使う（キャッシュにない場合は API から取得し、短時間 LRU に保持する）。
+"""
+import time
+import asyncio
+from collections import OrderedDict
+import discord
+import config
+import guilds
+import metrics
+from db_handler import db
+
+# query_members に一度に渡せるユーザーIDの上限
+QUERY_BATCH_SIZE = 100
+# 追跡対象とするロール（ギルド設定の項目名）
+TRACKED_ROLE_SETTINGS = ("clan_member_role_id", "trial_role_id", "staff_role_id")
+
+class _MemberLRU:
+    """fetch_member の結果を (guild_id, user_id) ごとに保持する。見つからなかった結果（None）も保持する"""
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key: tuple):
+        """(見つかったか, メンバー) を返す"""
+        entry = self._entries.get(key)
+        if entry is None: return False, None
+        expires_at, member = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, member
+
+    def put(self, key: tuple, member):
+        self._entries[key] = (time.monotonic() + self.ttl, member)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+_lru = _MemberLRU(config.MEMBER_LRU_SIZE, config.MEMBER_LRU_TTL_SECONDS)
+# 全メンバーを取得中・取得済みのギルド（lazy で同じギルドを同時に何度もチャンクしない）
+_chunking = {}
+# tracked: ロールごとのメンバーのID { guild_id: (調べた時刻, { role_id: {user_id} }) }。
+# 全メンバーの取得は config.MEMBER_ROLE_SCAN_INTERVAL_SECONDS に1回までにし、その結果をIDだけで保持する（Member はキャッシュしない）
+_role_snapshots = {}
+# tracked: 取得中のロールの一覧（同じギルドを同時に何度も取得しない）
+_snapshot_tasks = {}
+# tracked: キャッシュへの読み込み中のギルド（guild_available が続いても同時に1回だけ）
+_warming = set()
+
+def bot_options() -> dict:
+    """commands.Bot に渡す、キャッシュ方針に応じた引数"""
+    if config.MEMBER_CACHE_POLICY == "full":
+        return {"chunk_guilds_at_startup": True, "member_cache_flags": discord.MemberCacheFlags.all()}
+    # VC参加中のメンバーと、サーバーに新しく参加したメンバー（体験加入の対象）だけを自動でキャッシュする
+    return {"chunk_guilds_at_startup": False, "member_cache_flags": discord.MemberCacheFlags(voice=True, joined=True)}
+
+async def get_member(guild: discord.Guild, user_id: int) -> discord.Member | None:
+    """キャッシュ → LRU → API の順にメンバーを探す。サーバーにいない場合は None"""
+    user_id = int(user_id)
+    member = guild.get_member(user_id)
+    if member is not None: return member
+    found, member = _lru.get((guild.id, user_id))
+    metrics.cache_result("member", found)
+    if found: return member
+    try:
+        member = await guild.fetch_member(user_id)
+    except discord.NotFound:
+        member = None
+    except discord.HTTPException:
+        # 一時的な失敗は保持しない
+        return None
+    _lru.put((guild.id, user_id), member)
+    return member
+
+async def ensure_chunked(guild: discord.Guild):
+    """ギルドの全メンバーがキャッシュされていなければ、一度だけ取得してキャッシュする"""
+    if guild.chunked: return
+    task = _chunking.get(guild.id)
+    if task is None:
+        task = _chunking[guild.id] = asyncio.ensure_future(guild.chunk(cache=True))
+    try:
+        await task
+    except Exception:
+        _chunking.pop(guild.id, None)
+        raise
+
+async def all_members(guild: discord.Guild) -> list[discord.Member]:
+    """
+    ギルドの全メンバー。lazy では初回に全員を取得してキャッシュする。
+    tracked では全員を取得せず、キャッシュ済み（追跡対象）のメンバーだけを返す（全員が必要な機能は role_members などを使う）
+    """
+    if config.MEMBER_CACHE_POLICY == "lazy": await ensure_chunked(guild)
+    return guild.members
+
+async def _role_snapshot(guild: discord.Guild) -> dict:
+    """tracked: { role_id: {user_id} }。config.MEMBER_ROLE_SCAN_INTERVAL_SECONDS より古ければ全メンバーを取得し直す"""
+    scanned_at, snapshot = _role_snapshots.get(guild.id, (None, {}))
+    if scanned_at is not None and time.monotonic() - scanned_at < config.MEMBER_ROLE_SCAN_INTERVAL_SECONDS: return snapshot
+    task = _snapshot_tasks.get(guild.id)
+    if task is None:
+        task = _snapshot_tasks[guild.id] = asyncio.ensure_future(guild.chunk(cache=False))
+    try:
+        members = await task
+    finally:
+        _snapshot_tasks.pop(guild.id, None)
+    snapshot = {}
+    for member in members:
+        for role in member.roles:
+            if role.id != guild.id: snapshot.setdefault(role.id, set()).add(member.id)
+    _role_snapshots[guild.id] = (time.monotonic(), snapshot)
+    return snapshot
+
+async def _role_holder_ids(guild: discord.Guild, roles: list) -> set[int]:
+    """ロールを持つメンバーのID（前回取得したロールの一覧と、キャッシュ済みの role.members を合わせる）"""
+    snapshot = await _role_snapshot(guild)
+    return {user_id for role in roles for user_id in snapshot.get(role.id, ())} | {member.id for role in roles for member in role.members}
+
+async def fetch_members(guild: discord.Guild, user_ids) -> list[discord.Member]:
+    """user_ids のメンバー。キャッシュにない分は QUERY_BATCH_SIZE 人ずつまとめて取得する（キャッシュはしない）。サーバーにいない人は含めない"""
+    members, missing = [], []
+    for user_id in dict.fromkeys(int(user_id) for user_id in user_ids):
+        member = guild.get_member(user_id)
+        if member is not None: members.append(member)
+        else: missing.append(user_id)
+    for i in range(0, len(missing), QUERY_BATCH_SIZE):
+        members += await guild.query_members(user_ids=missing[i:i + QUERY_BATCH_SIZE], cache=False)
+    return members
+
+async def role_members(guild: discord.Guild, role: discord.Role) -> list[discord.Member]:
+    """role.members の代わり（キャッシュにないメンバーも含める）。tracked では、取得したメンバーのうち今もロールを持つ人だけを返す"""
+    if config.MEMBER_CACHE_POLICY == "full" or guild.chunked: return role.members
+    if config.MEMBER_CACHE_POLICY == "lazy":
+        await ensure_chunked(guild)
+        return role.members
+    return [member for member in await fetch_members(guild, await _role_holder_ids(guild, [role])) if role in member.roles]
+
+async def find_by_display_name(guild: discord.Guild, display_name: str) -> discord.Member | None:
+    """discord.utils.get(guild.members, display_name=...) の代わり"""
+    member = discord.utils.get(guild.members, display_name=display_name)
+    if member is not None or config.MEMBER_CACHE_POLICY == "full" or guild.chunked: return member
+    # ユーザー名・ニックネームの前方一致で検索し、表示名が一致するものを選ぶ
+    candidates = await guild.query_members(query=display_name, limit=100, cache=False)
+    return discord.utils.get(candidates, display_name=display_name)
+
+def _tracked_user_ids(guild_id: int) -> set[int]:
+    """DBから分かる追跡対象（体験中、シフト登録済み、今週活動した）のユーザーID"""
+    user_ids = set()
+    for key, _ in db.scan(guilds.key("trial", guild_id, ""), projection=[]):
+        user_id = key.rsplit("_", 1)[1]
+        if user_id.isdigit(): user_ids.add(int(user_id))
+    user_ids.update(int(user_id) for user_id in db.get(guilds.key("shift_schedules", guild_id), {}))
+    for key, data in db.scan(guilds.key("activity", guild_id, ""), projection=["message_count.weekly", "vc_seconds.weekly"]):
+        user_id = key.rsplit("_", 1)[1]
+        if user_id.isdigit() and (data.get("message_count", {}).get("weekly") or data.get("vc_seconds", {}).get("weekly")):
+            user_ids.add(int(user_id))
+    return user_ids
+
+async def warm(guild: discord.Guild):
+    """tracked: 追跡対象のメンバーだけをキャッシュに読み込む（起動後・再接続後にバックグラウンドで実行する）"""
+    if config.MEMBER_CACHE_POLICY != "tracked" or guild.chunked or guild.id in _warming: return
+    _warming.add(guild.id)
+    try:
+        started = time.perf_counter()
+        user_ids = await db.run(_tracked_user_ids, guild.id)
+        roles = [role for role in (guilds.role(guild, name) for name in TRACKED_ROLE_SETTINGS) if role]
+        if roles: user_ids.update(await _role_holder_ids(guild, roles))
+        # キャッシュ済みのメンバーは取得しない（再接続でキャッシュが残っていれば、ほとんど通信しない）
+        missing = [user_id for user_id in user_ids if guild.get_member(user_id) is None]
+        for i in range(0, len(missing), QUERY_BATCH_SIZE):
+            await guild.query_members(user_ids=missing[i:i + QUERY_BATCH_SIZE], cache=True)
+        print(f"👥 {guild.name}: 追跡対象のメンバー {len(user_ids)}人をキャッシュしました。（取得 {len(missing)}人、{time.perf_counter() - started:.1f}秒）")
+    finally:
+        _warming.discard(guild.id)
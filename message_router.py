@@ -0,0 +1,79 @@
+"""
+受信したメッセージ（on_message）を、各Cogのハンドラーに振り分ける。
+
+discord.py はリスナーごとに別のタスクとして on_message を呼ぶため、Cogごとにリスナーを持つと
+1件のメッセージでリスナーの数だけタスクが作られ、それぞれがボットの判定やDBの読み込みを行う。
+ボットの on_message から router.dispatch を1回だけ呼び、メッセージ1件につき1回だけ事前の判定を行ってから、
+条件に合うハンドラーだけを順に呼ぶ。ハンドラーには共通の MessageContext を渡す。
+
+    router.subscribe("activity", self.handle_message)
+    router.subscribe("shift", self.handle_schedule_message, threads_only=True, accepts=self.is_schedule_thread)
+
+ハンドラーごとの実行時間は metrics.MESSAGE_HANDLER_LATENCY に記録する。
+"""
+import time
+import traceback
+import discord
+import metrics
+
+class MessageContext:
+    """ハンドラーに渡す、メッセージ1件分の共通の情報"""
+    __slots__ = ("message", "guild_id", "channel_id", "user_id", "display_name", "is_thread")
+
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self.guild_id = message.guild.id
+        self.channel_id = message.channel.id
+        self.user_id = message.author.id
+        self.display_name = message.author.display_name
+        self.is_thread = isinstance(message.channel, discord.Thread)
+
+class _Subscription:
+    __slots__ = ("name", "handler", "threads_only", "accepts")
+
+    def __init__(self, name: str, handler, threads_only: bool, accepts):
+        self.name = name
+        self.handler = handler
+        self.threads_only = threads_only
+        self.accepts = accepts
+
+class MessageRouter:
+    def __init__(self):
+        # 登録順に呼ぶ { 名前: _Subscription }
+        self._subscriptions = {}
+
+    def subscribe(self, name: str, handler, *, threads_only: bool = False, accepts=None):
+        """
+        handler(context) を登録する。同じ名前で登録し直すと置き換える。
+        threads_only: スレッド内のメッセージだけを受け取る
+        accepts: context を受け取り、ハンドラーを呼ぶかを返す関数（DBを読まない、軽い判定にすること）
+        """
+        self._subscriptions[name] = _Subscription(name, handler, threads_only, accepts)
+
+    def unsubscribe(self, name: str):
+        self._subscriptions.pop(name, None)
+
+    async def dispatch(self, message: discord.Message):
+        # DMとボットのメッセージは、どのハンドラーも扱わない
+        if message.guild is None:
+            return metrics.MESSAGES_RECEIVED.inc(result="dm")
+        if message.author.bot:
+            return metrics.MESSAGES_RECEIVED.inc(result="bot")
+        metrics.MESSAGES_RECEIVED.inc(result="routed")
+        context = MessageContext(message)
+        # ハンドラーの中で登録・解除されても影響しないよう、先に一覧を固定する
+        for subscription in list(self._subscriptions.values()):
+            if subscription.threads_only and not context.is_thread: continue
+            if subscription.accepts is not None and not subscription.accepts(context): continue
+            started, status = time.perf_counter(), "ok"
+            try:
+                await subscription.handler(context)
+            except Exception as e:
+                # 1つのハンドラーの失敗で、他のハンドラーを止めない
+                status = "error"
+                print(f"ERROR: メッセージのハンドラー '{subscription.name}' でエラー: {e}")
+                traceback.print_exc()
+            finally:
+                metrics.MESSAGE_HANDLER_LATENCY.observe(time.perf_counter() - started, handler=subscription.name, status=status)
+
+router = MessageRouter()
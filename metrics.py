@@ -0,0 +1,170 @@
+"""
+ボットの内部状態を Prometheus のテキスト形式で公開するための、最小限のメトリクス集計。
+main.py の /metrics がこのモジュールの render() を返す。
+
+- Counter: 増えるだけの値（DB操作の回数、キャッシュのヒット数など）
+- Gauge: その時点の値（ゲートウェイの遅延など）。set_function() で出力時に値を取得することもできる
+- Histogram: 所要時間の分布（コマンド・リスナー・DB操作の所要時間など）
+
+スレッド（db.run）からも呼ばれるため、値の更新はロックで保護する。
+"""
+import math
+import time
+import functools
+import threading
+
+# 所要時間（秒）のヒストグラムの区切り
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+def _format_value(value: float) -> str:
+    if math.isnan(value): return "NaN"
+    if math.isinf(value): return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> dict:
+        """現在の値のコピー { ラベルの値のタプル: 値 }（負荷試験などで前後の差を取るために使う）"""
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self) -> list:
+        """(名前の接尾辞, ラベル文字列, 値) のリスト"""
+        with self._lock:
+            return [("", _format_labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self._samples()]
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        super().__init__(name, help_text, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """出力のたびに function() を呼んで値を取得する（ラベルなしのゲージ用）"""
+        self._function = function
+
+    def _samples(self) -> list:
+        if self._function is not None:
+            try: return [("", "", float(self._function()))]
+            except Exception: return []
+        return super()._samples()
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None: counts = [0] * (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1; break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """with metrics.X.time(label=...): の形で、ブロックの所要時間を記録する"""
+        return _Timer(self, labels)
+
+    def _samples(self) -> list:
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(("_bucket", _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"'), cumulative))
+            samples.append(("_sum", _format_labels(self.labelnames, key), total))
+            samples.append(("_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram, self.labels = histogram, labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+def render() -> str:
+    """登録されている全メトリクスを Prometheus のテキスト形式で返す"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+# --- ボット全体で使うメトリクス ---
+GATEWAY_LATENCY = Gauge("clanbot_gateway_latency_seconds", "Discordゲートウェイのハートビート遅延")
+LOOP_LAG = Histogram("clanbot_event_loop_lag_seconds", "イベントループの遅延（スリープが予定より遅れた時間）")
+COMMAND_LATENCY = Histogram("clanbot_command_duration_seconds", "スラッシュコマンドの受信から完了までの時間", ("command", "status"))
+LISTENER_LATENCY = Histogram("clanbot_listener_duration_seconds", "イベントリスナー1回の実行時間", ("event", "handler"))
+DB_OPERATIONS = Counter("clanbot_db_operations_total", "DB操作の回数", ("operation", "prefix", "status"))
+DB_LATENCY = Histogram("clanbot_db_operation_duration_seconds", "DB操作の所要時間", ("operation", "prefix"))
+MESSAGES_RECEIVED = Counter("clanbot_messages_received_total", "受信したメッセージの数（result=routed/bot/dm）", ("result",))
+MESSAGE_HANDLER_LATENCY = Histogram("clanbot_message_handler_duration_seconds", "メッセージのハンドラー1回の実行時間", ("handler", "status"))
+CACHE_REQUESTS = Counter("clanbot_cache_requests_total", "キャッシュの参照回数（result=hit/miss）", ("cache", "result"))
+SHUFFLE_POOL = Counter("clanbot_shuffle_pool_total", "チーム分けのロール・VCのプールの利用（result=reused/created/released）", ("result",))
+CACHED_MEMBERS = Gauge("clanbot_cached_members", "ボットがメモリ上に保持しているメンバーの数")
+STARTUP_PHASE = Gauge("clanbot_startup_phase_seconds", "起動処理の各段階にかかった時間", ("phase",))
+TASK_DURATION = Histogram("clanbot_task_duration_seconds", "定期タスク1回の実行時間", ("task",), buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0))
+
+def cache_result(cache: str, hit: bool, count: int = 1):
+    if count: CACHE_REQUESTS.inc(count, cache=cache, result="hit" if hit else "miss")
+
+def timed_task(name: str):
+    """tasks.loop に渡すコルーチン関数の1回ごとの実行時間を記録するデコレーター（@tasks.loop の下に付ける）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with TASK_DURATION.time(task=name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
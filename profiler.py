@@ -0,0 +1,107 @@
+"""
+稼働中のボットのイベントループを、再デプロイせずにプロファイルするための機能。
+/debug profile コマンドと、Webサーバーの /debug/profile から使う。
+
+- sampling: 別スレッドから一定間隔でループスレッドのスタックを取得する。オーバーヘッドが小さく、本番でも使える
+  結果は関数ごとの集計（自身の時間 / 呼び出し先を含む時間）と、collapsed stack 形式（flamegraph.pl や speedscope で読める）
+- cprofile: cProfile でループスレッド上の全ての関数呼び出しを記録する。正確だが、計測中はボットが遅くなる
+"""
+import io
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import threading
+from collections import Counter
+
+# サンプリングの間隔（秒）
+SAMPLING_INTERVAL_SECONDS = 0.005
+# 1回のプロファイルの最大秒数
+MAX_PROFILE_SECONDS = 60
+# レポートに載せる関数の数
+REPORT_TOP_N = 25
+MODES = ("sampling", "cprofile")
+
+_PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+# 同時に複数のプロファイルを実行しない（cProfile は1つしか有効にできず、結果も混ざるため）
+_running = threading.Lock()
+
+class ProfilerBusyError(Exception):
+    """他のプロファイルが実行中の場合に送出する"""
+
+class ProfileResult:
+    def __init__(self, mode: str, seconds: float, report: str, attachment: bytes, filename: str):
+        self.mode = mode
+        self.seconds = seconds
+        self.report = report          # 人が読むための上位関数の一覧
+        self.attachment = attachment  # 詳細（collapsed stack / pstats のテキスト）
+        self.filename = filename
+
+def _frame_label(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(_PROJECT_ROOT): filename = os.path.relpath(filename, _PROJECT_ROOT)
+    else: filename = os.path.basename(filename)
+    return f"{filename}:{code.co_name}"
+
+def _sample_stacks(thread_id: int, seconds: float, interval: float) -> tuple:
+    """thread_id のスタックを seconds 秒間サンプリングし、(スタックごとの回数, サンプル数) を返す"""
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stacks[tuple(reversed(labels))] += 1
+            samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def _sampling_report(stacks: Counter, samples: int, seconds: float) -> str:
+    own, inclusive = Counter(), Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for label in set(stack):
+            inclusive[label] += count
+    if not samples: return "サンプルを取得できませんでした。"
+    lines = [f"{seconds:.0f}秒間 / {samples}サンプル（ループ上で実行中だった割合。selectors.py:select はイベント待ちのアイドル時間）", "", "自身の時間:"]
+    lines += [f"{count / samples:6.1%}  {label}" for label, count in own.most_common(REPORT_TOP_N)]
+    lines += ["", "呼び出し先を含む時間:"]
+    lines += [f"{count / samples:6.1%}  {label}" for label, count in inclusive.most_common(REPORT_TOP_N)]
+    return "\n".join(lines)
+
+async def _profile_sampling(seconds: float) -> ProfileResult:
+    loop_thread_id = threading.get_ident()
+    stacks, samples = await asyncio.to_thread(_sample_stacks, loop_thread_id, seconds, SAMPLING_INTERVAL_SECONDS)
+    collapsed = "\n".join(f"{';'.join(stack)} {count}" for stack, count in stacks.most_common())
+    return ProfileResult("sampling", seconds, _sampling_report(stacks, samples, seconds), collapsed.encode("utf-8"), "profile_collapsed.txt")
+
+async def _profile_cprofile(seconds: float) -> ProfileResult:
+    # cProfile は有効にしたスレッドだけを記録するため、ループスレッド上で有効にしてそのまま待つ
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+    report, full = io.StringIO(), io.StringIO()
+    pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(REPORT_TOP_N)
+    pstats.Stats(profile, stream=full).sort_stats("cumulative").print_stats()
+    return ProfileResult("cprofile", seconds, report.getvalue(), full.getvalue().encode("utf-8"), "profile_pstats.txt")
+
+async def profile(seconds: float, mode: str = "sampling") -> ProfileResult:
+    """イベントループ上で seconds 秒間プロファイルを取る（ループスレッドのコルーチンから呼ぶ）"""
+    if mode not in MODES: raise ValueError(f"mode は {' / '.join(MODES)} のいずれかを指定してください。")
+    seconds = max(1, min(float(seconds), MAX_PROFILE_SECONDS))
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusyError("他のプロファイルが実行中です。終わるまでお待ちください。")
+    try:
+        if mode == "cprofile": return await _profile_cprofile(seconds)
+        return await _profile_sampling(seconds)
+    finally:
+        _running.release()
@@ -0,0 +1,33 @@
+"""
+シャード・クラスター（ボットを動かすプロセス）に関する判定。
+
+Discord はギルドを (guild_id >> 22) % SHARD_COUNT でシャードに割り当てる。
+launcher.py が全シャードを CLUSTER_COUNT 個のプロセスに分け、各プロセスは自分のシャードのギルドだけを受け持つ。
+プロセスごとに持っている状態（VCセッション、キャッシュなど）は、そのプロセスのギルドの分だけになる。
+"""
+import config
+
+def is_clustered() -> bool:
+    """ボットが複数のプロセスに分かれて動いているか（プロセス内のキャッシュが他のプロセスの書き込みで古くなりうるか）"""
+    return config.CLUSTER_COUNT > 1
+
+def is_primary() -> bool:
+    """全体で1回だけ行う処理（コマンド同期、集計期間のリセットなど）を、このプロセスが担当するか"""
+    return config.CLUSTER_ID == 0
+
+def shard_for(guild_id: int, shard_count: int | None = None) -> int:
+    """ギルドが割り当てられるシャード番号"""
+    shard_count = shard_count or config.SHARD_COUNT or 1
+    return (int(guild_id) >> 22) % shard_count
+
+def split_shards(shard_count: int, cluster_count: int) -> list[list[int]]:
+    """シャード番号 0..shard_count-1 を、連続した範囲でクラスターごとにほぼ均等に分ける"""
+    if not 1 <= cluster_count <= shard_count:
+        raise ValueError(f"クラスター数は 1 以上、シャード数（{shard_count}）以下にしてください。")
+    base, extra = divmod(shard_count, cluster_count)
+    clusters, start = [], 0
+    for cluster_id in range(cluster_count):
+        size = base + (1 if cluster_id < extra else 0)
+        clusters.append(list(range(start, start + size)))
+        start += size
+    return clusters
@@ -0,0 +1,143 @@
+"""
+チーム分けで使うロールとVCを、作り直さずに使い回すための貸し出し（プール）。
+
+チーム分けのたびにロールとVCを作成・削除すると、1回ごとに何回もの作成APIを呼ぶことになり、
+ロール作成のレート制限にかかりやすい。一度作ったロール・VCはギルドごとに shuffle_pool_<guild_id> に記録しておき、
+チーム分けで貸し出し（lease）、/event cleanup で返却（release）する。返却したロールは付与を外して待機中の名前に戻す。
+空きがなければその場で作成してプールに加える。
+
+    { "items": [{"team": "red", "label": "🔴 赤チーム", "role_id": ..., "vc_id": ..., "leased_by": 貸し出し先のID または None}, ...] }
+
+VCの名前の変更は Discord のレート制限が厳しい（10分に2回）ため、VCの名前は作成時のまま変えない。
+チーム（red / blue / red2 ...）ごとに同じチームの項目を貸し出すので、VCの名前は常にそのチームの名前になる。
+"""
+import discord
+import guilds
+import metrics
+import member_cache
+from db_handler import db
+
+# 控え用のロール（VCなし）のチーム名
+SUB_TEAM = "sub"
+# 返却したロールの名前の末尾
+IDLE_SUFFIX = "（待機中）"
+
+def _key(guild_id: int) -> str:
+    return guilds.key("shuffle_pool", guild_id)
+
+def _alive(guild: discord.Guild, item: dict) -> bool:
+    """ロールとVCがまだギルドに残っているか（手動で削除された項目はプールから外す）"""
+    if guild.get_role(item["role_id"]) is None: return False
+    return item.get("vc_id") is None or guild.get_channel(item["vc_id"]) is not None
+
+async def _delete_broken(guild: discord.Guild, items: list):
+    """
+    ロールかVCの片方だけが手動で削除された項目の、残った方を削除する。
+    その項目はプールから外れるため、残しておくと誰も使わないロール・VCになる。
+    """
+    for item in items:
+        if _alive(guild, item): continue
+        vc = guild.get_channel(item["vc_id"]) if item.get("vc_id") else None
+        role = guild.get_role(item["role_id"])
+        try:
+            if vc: await vc.delete(reason="チーム分けのプールの整理（ロールが削除されていたため）")
+            if role: await role.delete(reason="チーム分けのプールの整理（VCが削除されていたため）")
+        except discord.HTTPException as e:
+            print(f"ERROR: チーム分けのプールの整理に失敗しました: {e}")
+
+async def lease(guild: discord.Guild, category: discord.CategoryChannel, lease_id: str, labels: dict, colors: dict, suffix: str) -> tuple[dict, dict]:
+    """
+    labels の各チーム（{ チーム: 表示名 }、控えは SUB_TEAM）にロール（控え以外はVCも）を1つずつ貸し出し、
+    ({チーム: Role}, {チーム: VoiceChannel}) を返す。ロールの名前は「表示名(suffix)」にする。
+    作成に失敗した場合（権限がないなど）は、貸し出した分を空きに戻してから例外を送出する。
+    """
+    await _delete_broken(guild, (await db.run(db.get, _key(guild.id), {})).get("items", []))
+    def reserve(pool):
+        items = [item for item in pool.get("items", []) if _alive(guild, item)]
+        for team in labels:
+            if any(item["leased_by"] == lease_id and item["team"] == team for item in items): continue
+            item = next((item for item in items if item["team"] == team and item["leased_by"] is None), None)
+            if item: item["leased_by"] = lease_id
+        pool["items"] = items
+    pool = await db.run(db.update, _key(guild.id), reserve, {})
+    leased = {item["team"]: item for item in pool["items"] if item["leased_by"] == lease_id}
+    metrics.SHUFFLE_POOL.inc(len(leased), result="reused")
+
+    roles, vcs, created = {}, {}, []
+    failed = False
+    try:
+        for team, label in labels.items():
+            name = f"{label}({suffix})"
+            item = leased.get(team)
+            if item:
+                role = guild.get_role(item["role_id"])
+                if role.name != name: await role.edit(name=name, reason="チーム分け")
+                roles[team] = role
+                if item.get("vc_id"): vcs[team] = guild.get_channel(item["vc_id"])
+                continue
+            # 空きがないので作成してプールに加える
+            roles[team] = await guild.create_role(name=name, color=colors.get(team, discord.Color.default()), reason="チーム分け")
+            item = {"team": team, "label": label, "role_id": roles[team].id, "vc_id": None, "leased_by": lease_id}
+            created.append(item)
+            if team != SUB_TEAM:
+                same_team = sum(1 for other in pool["items"] + created if other["team"] == team) - 1
+                overwrites = {guild.default_role: discord.PermissionOverwrite(connect=False), roles[team]: discord.PermissionOverwrite(connect=True)}
+                vcs[team] = await category.create_voice_channel(name=f"{label} VC" + (f" ({same_team + 1})" if same_team else ""), overwrites=overwrites)
+                item["vc_id"] = vcs[team].id
+    except Exception:
+        failed = True
+        raise
+    finally:
+        # 途中で失敗しても、作成できた分はプールに記録する（失敗した場合は貸し出した分と合わせて空きに戻す）
+        def record(pool):
+            items = pool.get("items", []) + [{**item, "leased_by": None if failed else lease_id} for item in created]
+            if failed:
+                for item in items:
+                    if item["leased_by"] == lease_id: item["leased_by"] = None
+            pool["items"] = items
+        if created or failed:
+            await db.run(db.update, _key(guild.id), record, {})
+        metrics.SHUFFLE_POOL.inc(len(created), result="created")
+    return roles, vcs
+
+async def release(guild: discord.Guild, lease_id: str, member_ids=()) -> int:
+    """
+    lease_id に貸し出したロール・VCを返却する（ロールの付与を外し、待機中の名前に戻す）。返却した数を返す。
+    member_ids（チーム分けでロールを付与したメンバー）を渡すと、その人たちとキャッシュ済みの role.members だけからロールを外す
+    （全メンバーを調べない）。渡さなければ member_cache.role_members でロールを持つ人を調べる。
+    """
+    items = (await db.run(db.get, _key(guild.id), {})).get("items", [])
+    await _delete_broken(guild, items)
+    leased = [item for item in items if item["leased_by"] == lease_id]
+    known = await member_cache.fetch_members(guild, member_ids) if member_ids else []
+    for item in leased:
+        role = guild.get_role(item["role_id"])
+        if role is None: continue
+        if member_ids: holders = list({member.id: member for member in known + role.members if role in member.roles}.values())
+        else: holders = await member_cache.role_members(guild, role)
+        for member in holders:
+            try: await member.remove_roles(role, reason="チーム分けの片付け")
+            except discord.HTTPException: pass
+        idle_name = f"{item['label']}{IDLE_SUFFIX}"
+        if role.name != idle_name: await role.edit(name=idle_name, reason="チーム分けの片付け")
+    def give_back(pool):
+        items = [item for item in pool.get("items", []) if _alive(guild, item)]
+        for item in items:
+            if item["leased_by"] == lease_id: item["leased_by"] = None
+        pool["items"] = items
+    await db.run(db.update, _key(guild.id), give_back, {})
+    metrics.SHUFFLE_POOL.inc(len(leased), result="released")
+    return len(leased)
+
+async def purge(guild: discord.Guild) -> tuple[int, int]:
+    """貸し出していないロール・VCを削除してプールから外す。(削除したロールの数, 削除したVCの数) を返す"""
+    idle = [item for item in (await db.run(db.get, _key(guild.id), {})).get("items", []) if item["leased_by"] is None]
+    deleted_roles, deleted_vcs = 0, 0
+    for item in idle:
+        vc = guild.get_channel(item["vc_id"]) if item.get("vc_id") else None
+        if vc: await vc.delete(reason="チーム分けのプールの削除"); deleted_vcs += 1
+        role = guild.get_role(item["role_id"])
+        if role: await role.delete(reason="チーム分けのプールの削除"); deleted_roles += 1
+    removed = {item["role_id"] for item in idle}
+    await db.run(db.update, _key(guild.id), lambda pool: {**pool, "items": [item for item in pool.get("items", []) if item["role_id"] not in removed or item["leased_by"] is not None]}, {})
+    return deleted_roles, deleted_vcs
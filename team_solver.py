@@ -0,0 +1,131 @@
+"""
+チーム分け・役割分担の割り当て計算。
+
+参加者をロールの枠（チームごとの gold / mid / ...）に割り当てる問題を、割り当て問題（ハンガリアン法）として解く。
+枠ごとのコストは、参加者の希望ロール順（role_priority）での順位（第1希望 = 0）。希望していないロールには割り当てない。
+Discord のオブジェクトやDBには触れないため、ベンチマークからもそのまま呼べる。
+"""
+import random
+
+# 割り当ててはいけない組み合わせのコスト（希望していないロール）
+FORBIDDEN = 10 ** 6
+# 枠を空けたままにするコスト。希望ロール順の順位（最大でもロール数）よりずっと大きく、FORBIDDEN より小さい
+UNFILLED = 1000
+# 1試合のチーム（赤・青）
+MATCH_TEAMS = ("red", "blue")
+
+def hungarian(cost: list[list[float]]) -> list[int]:
+    """
+    行数 <= 列数のコスト行列で、合計コストが最小になるよう各行に別々の列を割り当て、行ごとの列番号を返す。
+    計算量は O(行数^2 × 列数)。
+    """
+    n = len(cost)
+    if n == 0: return []
+    m = len(cost[0])
+    if n > m: raise ValueError("行数は列数以下にしてください。")
+    inf = float("inf")
+    # 1始まりの添字で扱う（0 は番兵）。u, v はポテンシャル、p[j] は列 j に割り当てた行
+    u, v, p, way = [0.0] * (n + 1), [0.0] * (m + 1), [0] * (m + 1), [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv, used = [inf] * (m + 1), [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0, delta, j1 = p[j0], inf, 0
+            row, u_i0 = cost[i0 - 1], u[i0]
+            for j in range(1, m + 1):
+                if used[j]: continue
+                current = row[j - 1] - u_i0 - v[j]
+                if current < minv[j]: minv[j], way[j] = current, j0
+                if minv[j] < delta: delta, j1 = minv[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta; v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0: break
+        # 見つけた増加路に沿って割り当てを入れ替える
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    result = [-1] * n
+    for j in range(1, m + 1):
+        if p[j]: result[p[j] - 1] = j - 1
+    return result
+
+def role_cost(role_priority: list, role: str) -> float:
+    """希望ロール順での順位（第1希望 = 0）。希望していなければ FORBIDDEN"""
+    return role_priority.index(role) if role in role_priority else FORBIDDEN
+
+def _fixed_picks(priority_picks: dict, roles: list, players) -> dict:
+    """priority_picks のうち有効なもの { ロール: ユーザーID }。1人を複数のロールに指定していたら最初の1つだけ"""
+    fixed, picked = {}, set()
+    for role, user_id in priority_picks.items():
+        if role in roles and user_id in players and user_id not in picked:
+            fixed[role] = user_id; picked.add(user_id)
+    return fixed
+
+def solve_matches(priorities: dict, roles: list, priority_picks: dict | None = None, max_matches: int = 10, rng: random.Random | None = None) -> dict | None:
+    """
+    参加者をできるだけ多くの試合（赤・青のチーム、各チームに roles の全ロール）に分ける。
+    priorities は { ユーザーID: 希望ロール順 }。priority_picks で指定された人は、1試合目の赤チームのそのロールに入れる。
+    希望ロール順の順位の合計が最小になる割り当てのうち、同点のものから無作為に1つを選ぶ。
+    { "matches": [{"red": {ロール: ユーザーID}, "blue": {...}}, ...], "subs": [ユーザーID, ...], "cost": 順位の合計 } を返す。1試合も作れなければ None。
+    """
+    rng = rng or random
+    fixed = _fixed_picks(priority_picks or {}, roles, priorities)
+    pool = [user_id for user_id in priorities if user_id not in fixed.values()]
+    # ロールごとの、そのロールを希望している人数（固定した人を含む）。試合数の上限の見積もりに使う
+    candidates = {role: sum(1 for user_id in pool if role in priorities[user_id]) + (1 if role in fixed else 0) for role in roles}
+    upper = min(max_matches, len(priorities) // (len(MATCH_TEAMS) * len(roles)), min(candidates.values()) // len(MATCH_TEAMS))
+    for matches in range(upper, 0, -1):
+        team_count = matches * len(MATCH_TEAMS)
+        slots = [role for role in roles for _ in range(team_count - (1 if role in fixed else 0))]
+        # 同じ順位の合計になる割り当ての中から無作為に選ぶため、合計しても1未満になる小さな乱数を足す
+        jitter = 1 / (len(slots) + 1)
+        noise = {(user_id, role): rng.random() * jitter for user_id in pool for role in roles}
+        cost = [[role_cost(priorities[user_id], role) + noise[(user_id, role)] for user_id in pool] for role in slots]
+        assigned = hungarian(cost)
+        if any(cost[slot][column] >= FORBIDDEN for slot, column in enumerate(assigned)): continue
+        by_role = {role: [] for role in roles}
+        for slot, column in enumerate(assigned): by_role[slots[slot]].append(pool[column])
+        teams = [{} for _ in range(team_count)]
+        for role in roles:
+            players = by_role[role]
+            rng.shuffle(players)
+            if role in fixed: players.insert(0, fixed[role])
+            for team, user_id in zip(teams, players): team[role] = user_id
+        in_teams = {user_id for team in teams for user_id in team.values()}
+        total = sum(int(role_cost(priorities[user_id], role)) for team in teams for role, user_id in team.items() if role_cost(priorities[user_id], role) < FORBIDDEN)
+        return {
+            "matches": [dict(zip(MATCH_TEAMS, teams[i:i + len(MATCH_TEAMS)])) for i in range(0, team_count, len(MATCH_TEAMS))],
+            "subs": [user_id for user_id in priorities if user_id not in in_teams],
+            "cost": total,
+        }
+    return None
+
+def solve_roles(priorities: dict, roles: list, priority_picks: dict | None = None) -> dict:
+    """
+    ロールごとに1人ずつ割り当てる（役割分担）。priorities は { ユーザーID: 希望ロール順 } で、参加表明の早い順に並べておく。
+    埋まる枠の数を最大にし、その中で希望ロール順の順位の合計を最小にし、さらに同点なら参加表明の早い人を優先する。
+    { "assignments": {ロール: ユーザーID または None}, "filled": 埋まった枠の数, "cost": 順位の合計 } を返す。
+    """
+    fixed = _fixed_picks(priority_picks or {}, roles, priorities)
+    pool = [user_id for user_id in priorities if user_id not in fixed.values()]
+    slots = [role for role in roles if role not in fixed]
+    # 参加表明順の差は、全ての枠で合計しても1未満（順位の差より小さい）
+    tie_break = 1 / (len(slots) + 1) / (len(pool) + 1)
+    # 空けたままにする枠の分、どのロールにも使える「空き」の列を足す
+    cost = [[role_cost(priorities[user_id], role) + order * tie_break for order, user_id in enumerate(pool)] + [UNFILLED] * len(slots) for role in slots]
+    assignments = {role: fixed.get(role) for role in roles}
+    for slot, column in enumerate(hungarian(cost)):
+        if column < len(pool) and cost[slot][column] < FORBIDDEN: assignments[slots[slot]] = pool[column]
+    return {"assignments": assignments, **evaluate_roles(assignments, priorities)}
+
+def evaluate_roles(assignments: dict, priorities: dict) -> dict:
+    """役割分担の結果の { "filled": 埋まった枠の数, "cost": 希望ロール順の順位の合計（指定で割り当てた希望外のロールは数えない） }"""
+    filled = [(role, user_id) for role, user_id in assignments.items() if user_id is not None]
+    ranks = [role_cost(priorities.get(user_id, []), role) for role, user_id in filled]
+    return {"filled": len(filled), "cost": int(sum(rank for rank in ranks if rank < FORBIDDEN))}
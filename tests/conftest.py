@@ -0,0 +1,12 @@
+"""
+テスト共通の設定。config.py / db_handler.py を読み込む前に、本番のデータベースに接続しない設定にしておく
+（DBはメモリ上の SQLite。テストごとに必要なハンドラーは各テストで作る）。
+"""
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ.setdefault("GUILD_ID", "0")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,113 @@
+"""
+テスト用の、ネットワークに接続しない Replit DB / MongoDB の代替品。
+ハンドラーが実際に呼ぶメソッドだけを実装し、値はメモリ上に保持する。
+"""
+import json
+import sys
+import threading
+import types
+from collections import deque
+
+import pymongo
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError
+
+import db_handler
+
+class FakeReplitDB:
+    """replit.db の代替品（値はJSON文字列で保持する）"""
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get_raw(self, key):
+        with self.lock: return self.data[key]
+
+    def set_bulk(self, values: dict):
+        with self.lock: self.data.update({key: json.dumps(value) for key, value in values.items()})
+
+    def __delitem__(self, key):
+        with self.lock: del self.data[key]
+
+    def prefix(self, p_str):
+        with self.lock: return tuple(sorted(key for key in self.data if key.startswith(p_str)))
+
+def replit_handler(monkeypatch) -> db_handler.ReplitDBHandler:
+    fake = FakeReplitDB()
+    monkeypatch.setitem(sys.modules, "replit", types.SimpleNamespace(db=fake))
+    return db_handler.ReplitDBHandler()
+
+def _set_path(data: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents: data = data.setdefault(part, {})
+    data[last] = value
+
+def _get_path(data: dict, path: str, default=0):
+    for part in path.split("."):
+        if not isinstance(data, dict) or part not in data: return default
+        data = data[part]
+    return data
+
+class FakeCollection:
+    """
+    pymongo の Collection の代替品。_id での検索と、$set / $inc による更新だけを扱う。
+    fail_next に動作を積むと、次の bulk_write を失敗させる（"down" は接続障害、整数 n は n 番目のリクエストで BulkWriteError）。
+    """
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.RLock()
+        self.fail_next = deque()
+        self.bulk_calls = 0
+
+    def _matches(self, document, condition: dict) -> bool:
+        for field, expected in condition.items():
+            if isinstance(expected, dict) and "$exists" in expected:
+                if (field in document) != expected["$exists"]: return False
+            elif document.get(field) != expected:
+                return False
+        return True
+
+    def find_one(self, condition: dict):
+        with self.lock:
+            document = self.documents.get(condition["_id"])
+            return json.loads(json.dumps(document)) if document is not None and self._matches(document, condition) else None
+
+    def insert_one(self, document: dict):
+        with self.lock:
+            if document["_id"] in self.documents: raise DuplicateKeyError("duplicate key")
+            self.documents[document["_id"]] = json.loads(json.dumps(document))
+
+    def update_one(self, condition: dict, update: dict, upsert: bool = False):
+        with self.lock:
+            document = self.documents.get(condition["_id"])
+            if document is None or not self._matches(document, condition):
+                if not upsert: return types.SimpleNamespace(matched_count=0)
+                document = self.documents[condition["_id"]] = {"_id": condition["_id"]}
+            for path, value in update.get("$set", {}).items(): _set_path(document, path, json.loads(json.dumps(value)))
+            for path, amount in update.get("$inc", {}).items(): _set_path(document, path, _get_path(document, path) + amount)
+            return types.SimpleNamespace(matched_count=1)
+
+    def bulk_write(self, requests: list, ordered: bool = True):
+        with self.lock:
+            self.bulk_calls += 1
+            action = self.fail_next.popleft() if self.fail_next else None
+            if action == "down": raise AutoReconnect("connection refused")
+            for index, request in enumerate(requests):
+                if index == action:
+                    raise BulkWriteError({"writeErrors": [{"index": index, "code": 2, "errmsg": "bad update"}], "nInserted": 0, "nModified": index})
+                if isinstance(request, pymongo.DeleteOne): self.documents.pop(request._filter["_id"], None)
+                else: self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    def data(self, key: str):
+        document = self.documents.get(key)
+        return None if document is None else document.get("data")
+
+def mongo_handler() -> db_handler.MongoDBHandler:
+    """接続済みの状態の MongoDBHandler（collection は FakeCollection）"""
+    handler = db_handler.MongoDBHandler.__new__(db_handler.MongoDBHandler)
+    handler.client = object()
+    handler.collection = FakeCollection()
+    handler._indexed_fields = set()
+    handler.breaker = db_handler._CircuitBreaker(db_handler.MONGO_FAILURE_THRESHOLD, db_handler.MONGO_RETRY_AFTER_SECONDS)
+    handler._pending_writes = deque()
+    handler._write_lock = threading.RLock()
+    return handler
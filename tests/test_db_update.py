@@ -0,0 +1,75 @@
+"""DatabaseHandler.update()（バージョン番号による楽観的排他制御）を、3つのバックエンドで同じように確かめる"""
+import threading
+
+import pytest
+
+import db_handler
+from fake_backends import mongo_handler, replit_handler
+
+@pytest.fixture(params=["sqlite", "replit", "mongo"])
+def backend(request, tmp_path, monkeypatch):
+    """(ハンドラー, 同じデータを別に書き込むハンドラー)。SQLite は同じファイルを開いた別の接続（別プロセスに相当）"""
+    if request.param == "sqlite":
+        path = str(tmp_path / "test.db")
+        return db_handler.SQLiteDBHandler(path), db_handler.SQLiteDBHandler(path)
+    if request.param == "replit":
+        handler = replit_handler(monkeypatch)
+        return handler, handler
+    handler = mongo_handler()
+    return handler, handler
+
+def test_update_creates_from_default_without_touching_it(backend):
+    handler, _ = backend
+    default = {"items": []}
+    assert handler.update("k", lambda value: value["items"].append(1), default) == {"items": [1]}
+    assert default == {"items": []}
+    assert handler.get("k") == {"items": [1]}
+    # 新しい値を返す mutator
+    assert handler.update("k", lambda value: {"items": value["items"] + [2]}, {}) == {"items": [1, 2]}
+    assert handler.get("k") == {"items": [1, 2]}
+
+def test_update_skips_unchanged_and_failed_mutators(backend):
+    handler, _ = backend
+    handler.set("k", {"n": 1})
+    version = handler._read_versioned("k")[1]
+    assert handler.update("k", lambda value: None, {}) == {"n": 1}
+    assert handler._read_versioned("k")[1] == version
+    def broken(value):
+        value["n"] = 2
+        raise RuntimeError("mutator failed")
+    with pytest.raises(RuntimeError):
+        handler.update("k", broken, {})
+    assert handler.get("k") == {"n": 1}
+
+def test_update_retries_after_concurrent_write(backend):
+    handler, other = backend
+    handler.set("k", {"a": 1})
+    calls = []
+    def mutator(value):
+        # 1回目の読み込みの後に、別の書き込みが割り込む
+        if not calls: other.set("k", {**value, "b": 2})
+        calls.append(dict(value))
+        value["c"] = 3
+    assert handler.update("k", mutator, {}) == {"a": 1, "b": 2, "c": 3}
+    assert calls == [{"a": 1}, {"a": 1, "b": 2}]
+    assert handler.get("k") == {"a": 1, "b": 2, "c": 3}
+
+def test_update_from_many_threads_loses_nothing(backend):
+    handler, other = backend
+    def work(h, count):
+        for _ in range(count): h.update("counter", lambda value: {"n": value["n"] + 1}, {"n": 0})
+    threads = [threading.Thread(target=work, args=(h, 50)) for h in (handler, other, handler, other)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert handler.get("counter") == {"n": 200}
+
+def test_update_gives_up_on_endless_conflicts(backend, monkeypatch):
+    handler, other = backend
+    monkeypatch.setattr(db_handler.time, "sleep", lambda seconds: None)
+    handler.set("k", {"n": 0})
+    def mutator(value):
+        other.set("k", {"n": value["n"] + 1})
+        value["mine"] = True
+    with pytest.raises(db_handler.UpdateConflictError):
+        handler.update("k", mutator, {})
+    assert "mine" not in handler.get("k")
@@ -0,0 +1,32 @@
+"""募集メッセージのEmbedの分割（Discord の文字数・フィールド数の制限）"""
+from discord import Embed
+
+from cogs.events import EMBED_FIELD_LIMIT, FIELD_VALUE_LIMIT, MESSAGE_TEXT_LIMIT, build_event_embeds, chunk_lines
+
+def test_chunk_lines_keeps_every_line_within_the_limit():
+    lines = [f"- <@{100000000000000000 + i}> 名前{i}" for i in range(200)]
+    chunks = chunk_lines(lines)
+    assert all(len(chunk) <= FIELD_VALUE_LIMIT for chunk in chunks)
+    assert "\n".join(chunks).split("\n") == lines
+    assert chunk_lines([]) == []
+    # 1行だけで制限を超える行は切り詰める
+    assert chunk_lines(["x" * (FIELD_VALUE_LIMIT + 10)]) == ["x" * FIELD_VALUE_LIMIT]
+
+def _sections(count):
+    return {"参加": [f"- <@{100000000000000000 + i}>" for i in range(count)], "一時的に参加": [], "空いていれば参加": ["- <@1>"]}
+
+def test_build_event_embeds_lists_everyone_when_it_fits():
+    embeds, truncated = build_event_embeds(Embed(title="募集"), "見出し", _sections(100))
+    assert not truncated
+    values = "\n".join(field.value for embed in embeds for field in embed.fields)
+    assert all(f"<@{100000000000000000 + i}>" in values for i in range(100))
+    assert "まだいません" in values
+    assert all(len(embed.fields) <= EMBED_FIELD_LIMIT for embed in embeds)
+    assert embeds[0].footer.text is None
+
+def test_build_event_embeds_truncates_over_the_message_limit():
+    embeds, truncated = build_event_embeds(Embed(title="募集"), "見出し", _sections(1000))
+    assert truncated
+    assert sum(len(field.name) + len(field.value) for embed in embeds for field in embed.fields) <= MESSAGE_TEXT_LIMIT
+    assert any("ほか" in field.value for field in embeds[0].fields)
+    assert embeds[0].footer.text
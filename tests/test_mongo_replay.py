@@ -0,0 +1,72 @@
+"""MongoDBHandler の、障害中に保留した書き込みの再送"""
+import pytest
+
+import db_handler
+from fake_backends import mongo_handler
+
+@pytest.fixture
+def handler():
+    return mongo_handler()
+
+def test_outage_keeps_writes_queued_in_order(handler):
+    handler.collection.fail_next.append("down")
+    handler.bulk_write([("update", "a", {"n": 1}, {})])
+    assert list(handler._pending_writes) == [("update", "a", {"n": 1}, {})]
+    assert handler.collection.data("a") is None
+    handler.set("b", {"x": 1})
+    # 2回目は接続できたので、保留していた分から順に送る
+    assert list(handler._pending_writes) == []
+    assert handler.collection.data("a") == {"n": 1}
+    assert handler.collection.data("b") == {"x": 1}
+    assert handler.breaker.failures == 0
+
+def test_partial_bulk_failure_does_not_reapply_increments(handler):
+    handler.bulk_write([("update", "a", {"n": 1}, {})])
+    # 2番目のリクエスト（1つ目の set c）で失敗する。空の update（b）は送らないため、リクエストの位置と操作の位置はずれる
+    handler.collection.fail_next.append(1)
+    operations = [("update", "b", {}, {}), ("update", "a", {"n": 1}, {}), ("set", "c", {"x": 1}), ("set", "c", {"x": 2}), ("update", "a", {"n": 1}, {})]
+    handler.bulk_write(operations)
+    # 失敗した set c {"x": 1} だけを破棄し、反映済みの $inc は再送しない
+    assert handler.collection.data("a") == {"n": 3}
+    assert handler.collection.data("c") == {"x": 2}
+    assert list(handler._pending_writes) == []
+
+def test_permanent_failure_is_dropped_instead_of_blocking(handler):
+    # 障害中に保留した書き込みのうち、先頭の1件がデータの問題で失敗し続けるもの
+    handler.collection.fail_next.extend(["down", 0])
+    handler.bulk_write([("set", "bad", {"x": 1})])
+    handler.set("good", {"y": 1})
+    assert handler.collection.data("bad") is None
+    assert handler.collection.data("good") == {"y": 1}
+    assert list(handler._pending_writes) == []
+
+def test_reads_replay_pending_writes_first(handler):
+    handler.collection.fail_next.append("down")
+    handler.bulk_write([("update", "a", {"n": 5}, {})])
+    # 読み込みの前に保留分を送るため、自分の書き込みが読める
+    assert handler.get("a") == {"n": 5}
+    # 送れない間は古い値ではなく default を返す
+    handler.collection.fail_next.append("down")
+    handler.bulk_write([("update", "a", {"n": 1}, {})])
+    handler.collection.find_one = lambda condition: pytest.fail("保留中の書き込みを送る前に読み込んだ")
+    handler.collection.fail_next.append("down")
+    assert handler.get("a", "default") == "default"
+
+def test_outages_open_the_breaker(handler):
+    for _ in range(db_handler.MONGO_FAILURE_THRESHOLD):
+        handler.collection.fail_next.append("down")
+        handler.bulk_write([("update", "a", {"n": 1}, {})])
+    assert handler.breaker.state == "open"
+    calls = handler.collection.bulk_calls
+    # open の間はDBにアクセスせず、書き込みは保留したままにする
+    handler.bulk_write([("update", "a", {"n": 1}, {})])
+    assert handler.collection.bulk_calls == calls
+    assert len(handler._pending_writes) == db_handler.MONGO_FAILURE_THRESHOLD + 1
+    with pytest.raises(db_handler.DatabaseUnavailableError):
+        handler.update("a", lambda value: None, {})
+
+def test_patch_sets_existing_documents_only(handler):
+    handler.set("trial", {"notified": {}, "name": "a"})
+    handler.bulk_write([("patch", "trial", {"notified.day3": True}), ("patch", "missing", {"notified.day3": True})])
+    assert handler.collection.data("trial") == {"notified": {"day3": True}, "name": "a"}
+    assert "missing" not in handler.collection.documents
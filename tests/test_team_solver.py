@@ -0,0 +1,78 @@
+import itertools
+import random
+
+import pytest
+
+import team_solver
+
+ROLES = ["top", "jg", "mid", "adc", "sup"]
+
+def _brute_force(cost):
+    """行数 <= 列数の割り当ての最小コスト（全探索）"""
+    return min(sum(cost[i][j] for i, j in enumerate(columns)) for columns in itertools.permutations(range(len(cost[0])), len(cost)))
+
+@pytest.mark.parametrize("rows, columns", [(1, 1), (3, 3), (3, 5), (5, 6)])
+def test_hungarian_matches_brute_force(rows, columns):
+    rng = random.Random(rows * 10 + columns)
+    for _ in range(20):
+        cost = [[rng.randint(0, 9) for _ in range(columns)] for _ in range(rows)]
+        assigned = team_solver.hungarian(cost)
+        assert len(set(assigned)) == rows
+        assert sum(cost[i][j] for i, j in enumerate(assigned)) == _brute_force(cost)
+
+def test_hungarian_rejects_more_rows_than_columns():
+    with pytest.raises(ValueError):
+        team_solver.hungarian([[0], [0]])
+    assert team_solver.hungarian([]) == []
+
+def _players(count, rng):
+    """全員が全ロールを希望する（順番は無作為な）参加者"""
+    return {f"p{i}": rng.sample(ROLES, len(ROLES)) for i in range(count)}
+
+def test_solve_matches_fills_every_team():
+    priorities = _players(23, random.Random(1))
+    result = team_solver.solve_matches(priorities, ROLES, rng=random.Random(2))
+    assert len(result["matches"]) == 2
+    placed = [user_id for match in result["matches"] for team in match.values() for user_id in team.values()]
+    assert len(placed) == len(set(placed)) == 20
+    assert sorted(placed + result["subs"]) == sorted(priorities)
+    for match in result["matches"]:
+        for team in match.values():
+            assert set(team) == set(ROLES)
+
+def test_solve_matches_is_optimal_and_respects_wishes():
+    # 各ロールを第1希望にする人がちょうど2人ずつ → 順位の合計は0
+    priorities = {f"p{i}": [ROLES[i % 5]] + [role for role in ROLES if role != ROLES[i % 5]] for i in range(10)}
+    result = team_solver.solve_matches(priorities, ROLES, rng=random.Random(0))
+    assert result["cost"] == 0
+    # 希望していないロールには割り当てない
+    only_top = {f"p{i}": ["top"] for i in range(10)}
+    assert team_solver.solve_matches(only_top, ROLES) is None
+
+def test_solve_matches_places_priority_pick_in_first_red_team():
+    priorities = _players(10, random.Random(3))
+    result = team_solver.solve_matches(priorities, ROLES, priority_picks={"mid": "p7"}, rng=random.Random(4))
+    assert result["matches"][0]["red"]["mid"] == "p7"
+
+def test_solve_matches_respects_max_matches():
+    priorities = _players(30, random.Random(5))
+    result = team_solver.solve_matches(priorities, ROLES, max_matches=1)
+    assert len(result["matches"]) == 1 and len(result["subs"]) == 20
+    assert team_solver.solve_matches(_players(9, random.Random(6)), ROLES) is None
+
+def test_solve_roles_prefers_filling_then_rank_then_signup_order():
+    priorities = {
+        "a": ["mid", "top"],
+        "b": ["mid"],
+        "c": ["top"],
+    }
+    result = team_solver.solve_roles(priorities, ["top", "mid", "sup"])
+    # 埋まる枠の数（2）が最大で順位の合計が0になる割り当ては、mid が a か b の2通り。同点なので先に参加表明した a を選ぶ
+    assert result["filled"] == 2 and result["cost"] == 0
+    assert result["assignments"] == {"top": "c", "mid": "a", "sup": None}
+
+def test_solve_roles_keeps_priority_picks_and_evaluate_roles_ignores_unwished():
+    priorities = {"a": ["top"], "b": ["top", "mid"]}
+    result = team_solver.solve_roles(priorities, ["top", "mid"], priority_picks={"top": "b"})
+    assert result["assignments"] == {"top": "b", "mid": None}
+    assert team_solver.evaluate_roles({"top": "a", "mid": "a"}, priorities) == {"filled": 2, "cost": 0}